@@ -0,0 +1,117 @@
+#pylint: disable=C,R,W1203
+
+import os
+import json
+import zlib
+import logging
+import sqlite3
+import tempfile
+import threading
+import collections
+from lib.smugmugapi import Image, sizeFormat
+
+# Bounds the memory used by the images of the remote albums. Albums with
+# loaded images are kept in LRU order, and once their estimated size exceeds
+# the limit the least recently used are evicted: albums read from the content
+# cache snapshot drop their images, which are read again from the snapshot on
+# demand; modified albums are written to a spill file first. The spill file
+# is created in the local temporary directory, as the gallery may be on a
+# shared filesystem.
+
+class SpillStore:
+
+    def __init__(self, path):
+        self.path = path
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), check_same_thread=False)
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS images (id INTEGER PRIMARY KEY, body BLOB)")
+        self.spilled = 0
+
+    def write(self, images):
+        body = zlib.compress(json.dumps([image._resp for image in images], separators=(",", ":")).encode("utf-8"))
+        with self._lock, self._db:
+            self.spilled += 1
+            return self._db.execute("INSERT INTO images (body) VALUES (?)", (body,)).lastrowid
+
+    def _read(self, index):
+        with self._lock:
+            row = self._db.execute("SELECT body FROM images WHERE id = ?", (index,)).fetchone()
+        return json.loads(zlib.decompress(row[0]))
+
+    # Same interface as lib.snapshot.Snapshot, used as album._snapshot
+
+    def readImages(self, index):
+        return [Image(resp) for resp in self._read(index)]
+
+    def readImageFields(self, index):
+        fields = []
+        for resp in self._read(index):
+            extra = dict((k, v) for k, v in resp.items() if k not in ("FileName", "Uri"))
+            fields.append((resp["FileName"], resp.get("Uri", ""), json.dumps(extra) if extra else ""))
+        return fields
+
+    def readNameHashes(self, index):
+        return None
+
+    def close(self):
+        self._db.close()
+        if os.path.exists(self.path):
+            os.unlink(self.path)
+
+class AlbumCache:
+
+    def __init__(self, maxBytes, spillPath=None):
+        self.maxBytes = maxBytes
+        self._lock = threading.Lock()
+        self._albums = collections.OrderedDict()
+        self._size = 0
+        self._spillPath = spillPath
+        self._spillStore = None
+        self.peak = 0
+        self.evictions = 0
+
+    def _spill(self):
+        if not self._spillStore:
+            spillPath = self._spillPath
+            if spillPath is None:
+                fd, spillPath = tempfile.mkstemp(prefix="smugler-spill-", suffix=".sqlite")
+                os.close(fd)
+            self._spillStore = SpillStore(spillPath)
+        return self._spillStore
+
+    def touch(self, album):
+        # Called after the images of an album were used or changed.
+        size = album.memorySize()
+        victims = []
+        with self._lock:
+            self._size += size - self._albums.pop(id(album), (None, 0))[1]
+            self._albums[id(album)] = (album, size)
+            self.peak = max(self.peak, self._size)
+            while self._size > self.maxBytes and len(self._albums) > 1:
+                _, (victim, victimSize) = self._albums.popitem(last=False)
+                self._size -= victimSize
+                victims.append(victim)
+            if victims:
+                spillStore = self._spill()
+        # Evicted outside of the lock, as the album may be in use
+        for victim in victims:
+            logging.debug(f"Evicting images of {victim.getName()}")
+            victim.evict(spillStore)
+            self.evictions += 1
+
+    def report(self):
+        logging.info("Album cache: %s of %s used at most, %d evictions, %d albums spilled",
+            sizeFormat(self.peak), sizeFormat(self.maxBytes), self.evictions,
+            self._spillStore.spilled if self._spillStore else 0)
+        try:
+            import resource
+            # kB on Linux
+            logging.info("Peak memory: %s", sizeFormat(resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024))
+        except ImportError:
+            pass
+
+    def close(self):
+        if self._spillStore:
+            self._spillStore.close()
+            self._spillStore = None
@@ -0,0 +1,125 @@
+#pylint: disable=C,R,W1203
+
+import abc
+import threading
+
+# Storage backend of the remote folders and albums. Folder and Album
+# (lib.smugmugapi) hold the responses of the backend and call these methods
+# with them; responses are dicts with at least Name, UrlName and Uri, albums
+# optionally with ImagesLastUpdated, images with FileName and Uri. Missing
+# nodes are reported as SmugMugException with errCode 404, like SmugMug
+# does.
+#
+# Implementations: lib.smugmugapi.SmugMug and lib.localbackend.LocalBackend.
+class Backend(abc.ABC):
+
+    # Name of the content cache in the gallery
+    contentName = ".smugmugContent"
+
+    def __init__(self, config, albumCache=None):
+        self.config = config
+        self.albumCache = albumCache
+        self.apiLimiter = None
+
+        # Image count of the account, and the changes of this client to it
+        # since the count was verified. None if unknown.
+        self.changeDetection = config.get("ChangeDetection", {}).get("Enabled", False)
+        self.imageCount = None
+        self.verifiedImageCount = None
+        self.imageDelta = 0
+        self._countLock = threading.Lock()
+
+        # Set by Folder and Album when the content changed since it was
+        # loaded or saved, so unchanged content is not written again.
+        self.contentDirty = False
+
+    def countImages(self, delta):
+        with self._countLock:
+            if delta is None or self.imageDelta is None:
+                self.imageDelta = None
+            else:
+                self.imageDelta += delta
+
+    def isConnected(self):
+        return True
+
+    def close(self):
+        pass
+
+    @abc.abstractmethod
+    def getImageCount(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def getDateModified(self):
+        # Timestamp of the last change of the folders, None if unknown.
+        raise NotImplementedError
+
+    # Folders
+
+    @abc.abstractmethod
+    def getRootFolder(self):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def getFolder(self, folder):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def listFolders(self, folder):
+        # Iterates over the subfolders
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def listAlbums(self, folder):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def createFolder(self, parent, name):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def renameFolder(self, folder, name):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def moveAlbum(self, folder, album):
+        raise NotImplementedError
+
+    # Albums
+
+    @abc.abstractmethod
+    def getAlbum(self, album):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def listImages(self, album, details=False):
+        # Iterates over the images, with ArchivedMD5 and ArchivedSize if
+        # details are requested.
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def createAlbum(self, parent, name, **params):
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def renameAlbum(self, album, name):
+        raise NotImplementedError
+
+    # Images
+
+    @abc.abstractmethod
+    def upload(self, album, image, replaceUri=None):
+        # Uploads the file image into the album with the Uri album, or in
+        # place of the image replaceUri. Returns the response of the image.
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def collectImage(self, album, imageUri, fileName):
+        # Links the image imageUri with the name fileName into album. Returns
+        # the response of the image in album, or None if unknown.
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def deleteImage(self, imageUri):
+        raise NotImplementedError
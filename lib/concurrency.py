@@ -0,0 +1,166 @@
+#pylint: disable=C,R,W1203
+
+import time
+import logging
+import threading
+import contextlib
+import email.utils
+
+# Longest Retry-After honoured, in seconds
+MaxRetryAfter = 300
+
+def parseRetryAfter(value):
+    # Retry-After is either a number of seconds or an HTTP date.
+    if not value:
+        return None
+    try:
+        seconds = float(value)
+    except ValueError:
+        try:
+            seconds = email.utils.parsedate_to_datetime(value).timestamp() - time.time()
+        except (TypeError, ValueError):
+            return None
+    return min(max(seconds, 0.0), MaxRetryAfter)
+
+def isOverloaded(e):
+    # Connection errors and status codes of an overloaded server lower the
+    # concurrency.
+    if isinstance(e, OSError):
+        return True
+    errCode = getattr(e, "errCode", 0)
+    return errCode == 429 or errCode >= 500
+
+# AIMD limit of concurrent requests. Used as a semaphore whose limit is
+# adapted to the completed requests:
+# - After a window of `limit` successful requests, the limit is increased by
+#   one if their latency (per byte, if sizes are given) stayed within
+#   `tolerance` of the best latency seen. Stable latency at a higher limit
+#   means the throughput improved.
+# - If the latency rose above that, the limit is decreased by one.
+# - Errors halve the limit, once for all requests started at the same limit.
+#   A Retry-After delays all new requests.
+class AdaptiveLimiter:
+
+    _maxDecisions = 50
+
+    def __init__(self, name, maxLimit, minLimit=1, initial=1, tolerance=1.5):
+        self.name = name
+        self.minLimit = max(1, minLimit)
+        self.maxLimit = max(self.minLimit, maxLimit)
+        self.limit = min(max(initial, self.minLimit), self.maxLimit)
+        self.tolerance = tolerance
+        self._condition = threading.Condition()
+        self._inFlight = 0
+        self._epoch = 0
+        self._holdUntil = 0.0
+        self._baseline = None
+        self._window = []
+        self.increases = 0
+        self.decreases = 0
+        self.retryAfterCount = 0
+        self.decisions = []
+
+    @classmethod
+    def fromConfig(cls, name, maxLimit, config):
+        return cls(name, maxLimit,
+            minLimit=config.get("Min", 1),
+            initial=config.get("Initial", 1),
+            tolerance=config.get("Tolerance", 1.5))
+
+    def acquire(self):
+        with self._condition:
+            while True:
+                wait = self._holdUntil - time.time()
+                if wait <= 0 and self._inFlight < self.limit:
+                    break
+                self._condition.wait(wait if wait > 0 else None)
+            self._inFlight += 1
+            return self._epoch
+
+    def release(self):
+        with self._condition:
+            self._inFlight -= 1
+            self._condition.notify_all()
+
+    def __enter__(self):
+        self.acquire()
+        return self
+
+    def __exit__(self, *exc):
+        self.release()
+
+    @contextlib.contextmanager
+    def track(self, size=None):
+        # Runs a request in a slot. SmugMugExceptions of an overloaded server
+        # and connection errors count as failure.
+        epoch = self.acquire()
+        start = time.time()
+        try:
+            yield
+        except Exception as e:
+            if isOverloaded(e):
+                self.failure(epoch, getattr(e, "retryAfter", None))
+            raise
+        else:
+            self.success(time.time() - start, size)
+        finally:
+            self.release()
+
+    def _decide(self, limit, reason):
+        # Called with the condition held
+        if limit == self.limit:
+            return
+        logging.debug(f"Concurrency of {self.name}: {self.limit} -> {limit} ({reason})")
+        if limit > self.limit:
+            self.increases += 1
+        else:
+            self.decreases += 1
+            self._epoch += 1
+        self.limit = limit
+        self._window = []
+        self.decisions.append((round(time.time(), 3), limit, reason))
+        del self.decisions[:-self._maxDecisions]
+        self._condition.notify_all()
+
+    def success(self, latency, size=None):
+        cost = latency / size if size else latency
+        with self._condition:
+            self._window.append(cost)
+            if len(self._window) < self.limit:
+                return
+            mean = sum(self._window) / len(self._window)
+            self._window = []
+            if self._baseline is None or mean < self._baseline:
+                self._baseline = mean
+            if mean <= self._baseline * self.tolerance:
+                self._decide(min(self.limit + 1, self.maxLimit), "stable latency")
+            else:
+                self._decide(max(self.limit - 1, self.minLimit), "rising latency")
+                # Adapt to lasting changes of the connection
+                self._baseline = min(mean, self._baseline * 1.1)
+
+    def failure(self, epoch=None, retryAfter=None):
+        with self._condition:
+            if retryAfter:
+                self.retryAfterCount += 1
+                self._holdUntil = max(self._holdUntil, time.time() + retryAfter)
+                self._condition.notify_all()
+            # Requests started before the last decrease don't decrease it again
+            if epoch is None or epoch == self._epoch:
+                self._decide(max(self.limit // 2, self.minLimit), "retry after" if retryAfter else "error")
+
+    def metrics(self):
+        with self._condition:
+            return {
+                "limit": self.limit,
+                "min": self.minLimit,
+                "max": self.maxLimit,
+                "increases": self.increases,
+                "decreases": self.decreases,
+                "retryAfter": self.retryAfterCount,
+                "decisions": list(self.decisions),
+            }
+
+    def logSummary(self):
+        logging.info("Concurrency of %s: %d (%d increases, %d decreases, %d Retry-After)",
+            self.name, self.limit, self.increases, self.decreases, self.retryAfterCount)
@@ -0,0 +1,91 @@
+#pylint: disable=C,R,W1203
+
+import os
+import json
+import socket
+import logging
+import http.server
+
+# Local HTTP API of the serve action. Requests are dispatched to the
+# methods of a service:
+#   GET  /status   service.status()
+#   POST /sync     service.sync(path), body {"path": "..."}, default the whole gallery
+#   POST /pause    service.pause()
+#   POST /resume   service.resume()
+#   POST /stop     service.stop()
+# Responses are JSON. ValueErrors of the service are returned as 400.
+
+class ControlHandler(http.server.BaseHTTPRequestHandler):
+
+    def _reply(self, code, body):
+        data = json.dumps(body).encode("utf-8")
+        self.send_response(code)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _dispatch(self, method):
+        service = self.server.service
+        route = (method, self.path.rstrip("/"))
+        try:
+            if route == ("GET", "/status"):
+                self._reply(200, service.status())
+            elif route == ("POST", "/sync"):
+                length = int(self.headers.get("Content-Length") or 0)
+                body = json.loads(self.rfile.read(length) or b"{}")
+                if not isinstance(body, dict):
+                    raise ValueError("Expected a JSON object")
+                self._reply(202, service.sync(body.get("path", "")))
+            elif route == ("POST", "/pause"):
+                self._reply(200, service.pause())
+            elif route == ("POST", "/resume"):
+                self._reply(200, service.resume())
+            elif route == ("POST", "/stop"):
+                self._reply(200, service.stop())
+            else:
+                self._reply(404, {"error": f"Unknown request {method} {self.path}"})
+        except ValueError as e:
+            self._reply(400, {"error": str(e)})
+
+    def do_GET(self):
+        self._dispatch("GET")
+
+    def do_POST(self):
+        self._dispatch("POST")
+
+    def address_string(self):
+        # Unix sockets have no client address
+        return self.client_address[0] if self.client_address else "local"
+
+    def log_message(self, format, *args): #pylint: disable=W0622
+        logging.debug("Control: " + format, *args)
+
+class ControlServer(http.server.ThreadingHTTPServer):
+
+    daemon_threads = True
+
+    def __init__(self, service, address):
+        self.service = service
+        super().__init__(address, ControlHandler)
+
+class UnixControlServer(ControlServer):
+
+    address_family = socket.AF_UNIX
+
+    def server_bind(self):
+        if os.path.exists(self.server_address):
+            os.unlink(self.server_address)
+        self.socket.bind(self.server_address)
+        self.server_name = "localhost"
+        self.server_port = 0
+
+def createServer(service, listen):
+    # listen is host:port, or the path of a Unix socket
+    host, sep, port = listen.rpartition(":")
+    if sep and port.isdigit():
+        server = ControlServer(service, (host or "127.0.0.1", int(port)))
+    else:
+        server = UnixControlServer(service, listen)
+    logging.info(f"Listening on {listen}")
+    return server
@@ -0,0 +1,65 @@
+#pylint: disable=C,R
+
+import logging
+import threading
+
+def fileIdentity(path, stat=None):
+    # A file is identified by its inode, size and modification time. The
+    # information stays valid as long as the file isn't modified, no matter
+    # under which path it is found.
+    if stat is None:
+        stat = path.stat()
+    return (stat.st_dev, stat.st_ino, stat.st_size, stat.st_mtime_ns)
+
+# Persistent cache of information derived from local files (capture dates,
+# hashes, ...), keyed by the file identity.
+class FileInfoCache:
+
+    def __init__(self, cacheFile):
+        self._cacheFile = cacheFile
+        self._entries = {}
+        self._lock = threading.Lock()
+        self._dirty = False
+
+        if cacheFile.exists():
+            self._entries = self._read()
+
+    def get(self, path, field, stat=None):
+        entry = self._entries.get(fileIdentity(path, stat))
+        if entry:
+            return entry.get(field)
+        return None
+
+    def set(self, path, field, value, stat=None):
+        key = fileIdentity(path, stat)
+        with self._lock:
+            self._entries.setdefault(key, {})[field] = value
+            self._dirty = True
+
+    def __len__(self):
+        return len(self._entries)
+
+    def _read(self):
+        import pickle
+        try:
+            with self._cacheFile.open("rb") as fp:
+                return pickle.load(fp)
+        except (OSError, EOFError, pickle.UnpicklingError) as e:
+            logging.warning("Ignoring unreadable file cache %s: %r", self._cacheFile, e)
+            return {}
+
+    def save(self, merge=False):
+        # With merge, entries other processes saved meanwhile are kept.
+        if not self._dirty:
+            return
+        import pickle
+        with self._lock:
+            if merge and self._cacheFile.exists():
+                entries = self._read()
+                entries.update(self._entries)
+                self._entries = entries
+            tmpFile = self._cacheFile.with_name(self._cacheFile.name + ".tmp")
+            with tmpFile.open("wb") as fp:
+                pickle.dump(self._entries, fp)
+            tmpFile.replace(self._cacheFile)
+            self._dirty = False
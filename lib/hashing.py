@@ -0,0 +1,45 @@
+#pylint: disable=C,R,W1203
+
+import logging
+import hashlib
+from lib.pool import mapFiles
+
+# Below this number of files the hashes are computed in-process
+MinFilesForPool = 16
+
+_chunkSize = 1024 * 1024
+
+def md5File(path):
+    md5 = hashlib.md5()
+    with open(path, "rb") as fp:
+        while True:
+            chunk = fp.read(_chunkSize)
+            if not chunk:
+                break
+            md5.update(chunk)
+    return md5.hexdigest()
+
+def md5Files(paths, fileCache, workers):
+    # Returns the MD5 of every path. Hashes are cached by file identity, so
+    # only new or modified files are read.
+    result = {}
+    missing = []
+    for p in paths:
+        stat = p.stat()
+        md5 = fileCache.get(p, "md5", stat)
+        if md5:
+            result[p] = md5
+        else:
+            missing.append((p, stat))
+
+    if not missing:
+        return result
+
+    logging.info(f"Hashing {len(missing)} files")
+    missingPaths = [p for p, _ in missing]
+    hashes = mapFiles(md5File, missingPaths, workers, MinFilesForPool, 4)
+
+    for (p, stat), md5 in zip(missing, hashes):
+        fileCache.set(p, "md5", md5, stat)
+        result[p] = md5
+    return result
@@ -0,0 +1,109 @@
+#pylint: disable=C,R,W1203
+
+import json
+import time
+import zlib
+import logging
+import sqlite3
+import threading
+
+# On-disk cache of API GET responses, keyed by URL and parameters (which
+# include the filters). Entries are revalidated with the ETag and
+# Last-Modified of the response. Listings which carry a modification time
+# of their own (the images of an album and its ImagesLastUpdated) are
+# stored with it as version, and used without a request while the version
+# is unchanged. The size is bounded, the least recently used entries are
+# evicted first.
+
+class CachedResponse:
+
+    def __init__(self, etag, lastModified, version, body):
+        self.etag = etag
+        self.lastModified = lastModified
+        self.version = version
+        self._body = body
+
+    @property
+    def response(self):
+        return json.loads(zlib.decompress(self._body))
+
+    def conditionalHeaders(self):
+        headers = {}
+        if self.etag:
+            headers["If-None-Match"] = self.etag
+        if self.lastModified:
+            headers["If-Modified-Since"] = self.lastModified
+        return headers
+
+class ResponseCache:
+
+    def __init__(self, path, maxBytes=64 * 1024 * 1024):
+        self.path = path
+        self.maxBytes = maxBytes
+        self._lock = threading.Lock()
+        self._db = sqlite3.connect(str(path), timeout=60, check_same_thread=False)
+        with self._db:
+            self._db.execute("CREATE TABLE IF NOT EXISTS responses (key TEXT PRIMARY KEY, "
+                "etag TEXT, lastModified TEXT, version TEXT, body BLOB, size INTEGER, accessed REAL)")
+            self._db.execute("CREATE INDEX IF NOT EXISTS responsesAccessed ON responses (accessed)")
+        self._size = self._db.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        self.hits = 0
+        self.revalidated = 0
+        self.misses = 0
+
+    @staticmethod
+    def key(url, params):
+        return url + "?" + "&".join(f"{k}={params[k]}" for k in sorted(params))
+
+    def get(self, key):
+        with self._lock:
+            row = self._db.execute("SELECT etag, lastModified, version, body FROM responses WHERE key = ?",
+                (key,)).fetchone()
+        if not row:
+            return None
+        return CachedResponse(*row)
+
+    def hit(self, key, revalidated):
+        # Records the use of an entry for the LRU eviction.
+        if revalidated:
+            self.revalidated += 1
+        else:
+            self.hits += 1
+        with self._lock, self._db:
+            self._db.execute("UPDATE responses SET accessed = ? WHERE key = ?", (time.time(), key))
+
+    def store(self, key, etag, lastModified, version, response):
+        self.misses += 1
+        if not etag and not lastModified and version is None:
+            # Nothing to revalidate it with
+            return
+        body = zlib.compress(json.dumps(response, separators=(",", ":")).encode("utf-8"))
+        with self._lock, self._db:
+            old = self._db.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            if old:
+                self._size -= old[0]
+            self._db.execute("INSERT OR REPLACE INTO responses VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (key, etag, lastModified, version, body, len(body), time.time()))
+            self._size += len(body)
+            self._evict()
+
+    def _evict(self):
+        # Called with the lock held, in a transaction
+        while self._size > self.maxBytes:
+            rows = self._db.execute("SELECT key, size FROM responses ORDER BY accessed LIMIT 100").fetchall()
+            if not rows:
+                self._size = 0
+                return
+            for key, size in rows:
+                self._db.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self._size -= size
+                if self._size <= self.maxBytes:
+                    return
+
+    def logStats(self):
+        logging.debug("HTTP cache: %d hits, %d revalidated, %d misses, %d bytes",
+            self.hits, self.revalidated, self.misses, self._size)
+
+    def close(self):
+        self.logStats()
+        self._db.close()
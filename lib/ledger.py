@@ -0,0 +1,170 @@
+#pylint: disable=C,R,W1203
+
+import time
+import os
+import uuid
+import socket
+import logging
+import sqlite3
+import threading
+import contextlib
+
+def defaultWorkerName():
+    return f"{socket.gethostname()}-{os.getpid()}"
+
+# Work ledger shared by several smugler processes (possibly on different
+# machines) syncing the same gallery. Albums are leased to one worker at a
+# time, and the creation of folders/albums and writes of the shared caches
+# are serialised with named locks. Leases and locks expire, so a crashed
+# worker doesn't block the others; held leases are renewed in the background.
+class Ledger:
+
+    _pollInterval = 0.2
+
+    def __init__(self, path, imageDir, worker=None, leaseSeconds=600):
+        self.path = path
+        self.imageDir = imageDir
+        self.worker = worker or defaultWorkerName()
+        self.leaseSeconds = leaseSeconds
+        self._lock = threading.Lock()
+        self._held = set()
+        # Albums leased at any time by this worker, whose content it saves
+        self._leased = set()
+        # Held locks by their token
+        self._locks = {}
+        self._closed = threading.Event()
+
+        # No WAL, as it doesn't work on network filesystems
+        self._db = sqlite3.connect(str(path), timeout=60, isolation_level=None, check_same_thread=False)
+        with self._transaction():
+            self._db.execute("CREATE TABLE IF NOT EXISTS leases (album TEXT PRIMARY KEY, worker TEXT, expires REAL)")
+            self._db.execute("CREATE TABLE IF NOT EXISTS locks (name TEXT PRIMARY KEY, worker TEXT, expires REAL)")
+
+        self._renewer = threading.Thread(target=self._renew, daemon=True)
+        self._renewer.start()
+        logging.info(f"Using ledger {path} as worker {self.worker}")
+
+    @contextlib.contextmanager
+    def _transaction(self):
+        with self._lock:
+            self._db.execute("BEGIN IMMEDIATE")
+            try:
+                yield
+            except BaseException:
+                self._db.execute("ROLLBACK")
+                raise
+            self._db.execute("COMMIT")
+
+    def key(self, path):
+        return path.relative_to(self.imageDir).as_posix()
+
+    def _acquire(self, table, column, name, owner=None):
+        owner = owner or self.worker
+        now = time.time()
+        with self._transaction():
+            row = self._db.execute(f"SELECT worker, expires FROM {table} WHERE {column} = ?", (name,)).fetchone()
+            if row and row[0] != owner and row[1] > now:
+                return False
+            self._db.execute(f"INSERT OR REPLACE INTO {table} ({column}, worker, expires) VALUES (?, ?, ?)",
+                (name, owner, now + self.leaseSeconds))
+            return True
+
+    def _release(self, table, column, name, owner=None):
+        with self._transaction():
+            self._db.execute(f"DELETE FROM {table} WHERE {column} = ? AND worker = ?", (name, owner or self.worker))
+
+    def tryLease(self, albumPath):
+        # Returns False if another worker holds the album.
+        key = self.key(albumPath)
+        if not self._acquire("leases", "album", key):
+            logging.info(f"Skipping {key}, it is leased by another worker")
+            return False
+        self._held.add(key)
+        self._leased.add(key)
+        return True
+
+    def leasedByOther(self, albumPath):
+        # Checks the lease of another worker without leasing the album.
+        key = self.key(albumPath)
+        with self._lock:
+            row = self._db.execute("SELECT worker, expires FROM leases WHERE album = ?", (key,)).fetchone()
+        if row and row[0] != self.worker and row[1] > time.time():
+            logging.info(f"Skipping {key}, it is leased by another worker")
+            return True
+        return False
+
+    def leasedKeys(self):
+        return sorted(self._leased)
+
+    def albumLease(self, albumPath, album):
+        return AlbumLease(self, albumPath, album)
+
+    def release(self, albumPath):
+        key = self.key(albumPath)
+        self._held.discard(key)
+        self._release("leases", "album", key)
+
+    def releaseAll(self):
+        for key in list(self._held):
+            self._release("leases", "album", key)
+        self._held.clear()
+
+    @contextlib.contextmanager
+    def lock(self, name):
+        # Each hold has its own token, so threads of this worker exclude
+        # each other as well.
+        token = f"{self.worker}/{uuid.uuid4().hex}"
+        while not self._acquire("locks", "name", name, token):
+            time.sleep(self._pollInterval)
+        self._locks[token] = name
+        try:
+            yield
+        finally:
+            del self._locks[token]
+            self._release("locks", "name", name, token)
+
+    def _renew(self):
+        while not self._closed.wait(max(1, self.leaseSeconds / 3)):
+            held = list(self._held)
+            locks = list(self._locks.items())
+            if held or locks:
+                expires = time.time() + self.leaseSeconds
+                with self._transaction():
+                    self._db.executemany("UPDATE leases SET expires = ? WHERE album = ? AND worker = ?",
+                        [(expires, key, self.worker) for key in held])
+                    self._db.executemany("UPDATE locks SET expires = ? WHERE name = ? AND worker = ?",
+                        [(expires, name, token) for token, name in locks])
+
+    def close(self):
+        self._closed.set()
+        self._renewer.join()
+        self.releaseAll()
+        self._db.close()
+
+# Lease of an album taken by the upload scheduler when a slot starts the
+# first upload into the album, and released after the last one, so workers
+# only hold the albums they are uploading. The scheduler keeps its state in
+# held and pending.
+class AlbumLease:
+
+    def __init__(self, ledger, albumPath, album):
+        self.ledger = ledger
+        self.albumPath = albumPath
+        self.album = album
+        self.lock = threading.Lock()
+        self.held = None
+        self.pending = 0
+
+    def acquire(self):
+        if not self.ledger.tryLease(self.albumPath):
+            return False
+        try:
+            # Another worker may have uploaded files since the refresh
+            self.album.reload()
+        except BaseException:
+            self.release()
+            raise
+        return True
+
+    def release(self):
+        self.ledger.release(self.albumPath)
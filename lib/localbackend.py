@@ -0,0 +1,219 @@
+#pylint: disable=C,R,W1203
+
+import os
+import json
+import uuid
+import shutil
+import hashlib
+import logging
+import threading
+from pathlib import Path
+from lib.backend import Backend
+from lib.smugmugapi import SmugMugException, urlTransTab, sizeFormat
+
+# Backend storing the gallery in a local directory, for offline staging and
+# to measure the sync engine without the network. Folders and albums are
+# directories, albums are marked by a file with their id and a version which
+# is increased with every change of the images. Images are copies of the
+# uploaded files.
+#
+# Uris: /folder/<path>, /album/<id> and /album/<id>/image/<FileName>
+
+AlbumMarker = ".smuglerAlbum"
+
+CopyBufferSize = 1024 * 1024
+
+class LocalBackend(Backend):
+
+    contentName = ".smugmugContent-local"
+
+    def __init__(self, path, config, albumCache=None):
+        super().__init__(config, albumCache)
+        self.path = Path(path)
+        self.path.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        # Album ids to their directory, found on first use
+        self._albums = None
+        self.copiedBytes = 0
+        logging.info(f"Using local backend {self.path}")
+
+    def _albumIndex(self):
+        if self._albums is None:
+            albums = {}
+            for marker in self.path.rglob(AlbumMarker):
+                albums[self._readMarker(marker.parent)["Id"]] = marker.parent
+            self._albums = albums
+        return self._albums
+
+    def _readMarker(self, albumDir):
+        with (albumDir / AlbumMarker).open(encoding="utf-8") as fp:
+            return json.load(fp)
+
+    def _writeMarker(self, albumDir, marker):
+        tmpFile = albumDir / (AlbumMarker + ".tmp")
+        with tmpFile.open("w", encoding="utf-8") as fp:
+            json.dump(marker, fp)
+        tmpFile.replace(albumDir / AlbumMarker)
+
+    def _changed(self, albumDir):
+        with self._lock:
+            marker = self._readMarker(albumDir)
+            marker["Version"] += 1
+            self._writeMarker(albumDir, marker)
+
+    def _folderDir(self, folder):
+        folderDir = self.path / folder["Uri"][len("/folder/"):]
+        if not folderDir.is_dir() or (folderDir / AlbumMarker).exists():
+            raise SmugMugException(404, f"Folder {folder['Uri']} not found")
+        return folderDir
+
+    def _albumDir(self, albumUri):
+        albumId = albumUri.split("/")[2]
+        with self._lock:
+            albumDir = self._albumIndex().get(albumId)
+        if not albumDir or not (albumDir / AlbumMarker).exists():
+            raise SmugMugException(404, f"Album {albumUri} not found")
+        return albumDir
+
+    def _imageFile(self, imageUri):
+        # /album/<id>/image/<FileName>
+        albumUri, _, fileName = imageUri.partition("/image/")
+        imageFile = self._albumDir(albumUri) / fileName
+        if not imageFile.is_file():
+            raise SmugMugException(404, f"Image {imageUri} not found")
+        return imageFile
+
+    def _folderResp(self, folderDir):
+        if folderDir == self.path:
+            return {"Name": "", "UrlName": "", "Uri": "/folder/"}
+        return {"Name": folderDir.name, "UrlName": folderDir.name.translate(urlTransTab),
+            "Uri": "/folder/" + folderDir.relative_to(self.path).as_posix()}
+
+    def _albumResp(self, albumDir):
+        marker = self._readMarker(albumDir)
+        # Changes by this backend increase the version, others the mtime
+        return {"Name": albumDir.name, "UrlName": albumDir.name.translate(urlTransTab),
+            "Uri": "/album/" + marker["Id"],
+            "ImagesLastUpdated": "%d-%d" % (albumDir.stat().st_mtime_ns, marker["Version"]),
+            "ImageCount": len(self._images(albumDir))}
+
+    def _imageResp(self, albumUri, imageFile):
+        return {"FileName": imageFile.name, "Uri": albumUri + "/image/" + imageFile.name}
+
+    def _subdirs(self, folderDir):
+        return sorted(p for p in folderDir.iterdir() if p.is_dir() and not p.name.startswith("."))
+
+    def _images(self, albumDir):
+        # Hidden files are the marker and uploads in progress
+        return sorted(p for p in albumDir.iterdir() if p.is_file() and not p.name.startswith("."))
+
+    def getImageCount(self):
+        with self._lock:
+            albumDirs = list(self._albumIndex().values())
+        return sum(len(self._images(albumDir)) for albumDir in albumDirs)
+
+    def getDateModified(self):
+        # Renames and new or deleted albums change the mtime of the parent
+        # directory, changed images the one of the album directory.
+        return str(max(os.stat(dirPath).st_mtime_ns for dirPath, _, _ in os.walk(self.path)))
+
+    def getRootFolder(self):
+        return self._folderResp(self.path)
+
+    def getFolder(self, folder):
+        return self._folderResp(self._folderDir(folder))
+
+    def listFolders(self, folder):
+        for p in self._subdirs(self._folderDir(folder)):
+            if not (p / AlbumMarker).exists():
+                yield self._folderResp(p)
+
+    def listAlbums(self, folder):
+        for p in self._subdirs(self._folderDir(folder)):
+            if (p / AlbumMarker).exists():
+                yield self._albumResp(p)
+
+    def createFolder(self, parent, name):
+        folderDir = self._folderDir(parent) / name
+        folderDir.mkdir(exist_ok=True)
+        return self._folderResp(folderDir)
+
+    def renameFolder(self, folder, name):
+        folderDir = self._folderDir(folder)
+        folderDir = folderDir.rename(folderDir.with_name(name))
+        with self._lock:
+            # The paths of all albums below changed
+            self._albums = None
+        return self._folderResp(folderDir)
+
+    def moveAlbum(self, folder, album):
+        albumDir = self._albumDir(album["Uri"])
+        target = self._folderDir(folder) / albumDir.name
+        albumDir.rename(target)
+        with self._lock:
+            self._albumIndex()[album["Uri"].split("/")[2]] = target
+
+    def getAlbum(self, album):
+        return self._albumResp(self._albumDir(album["Uri"]))
+
+    def listImages(self, album, details=False):
+        albumDir = self._albumDir(album["Uri"])
+        for imageFile in self._images(albumDir):
+            resp = self._imageResp(album["Uri"], imageFile)
+            if details:
+                md5 = hashlib.md5()
+                with imageFile.open("rb") as fp:
+                    for chunk in iter(lambda: fp.read(CopyBufferSize), b""):
+                        md5.update(chunk)
+                resp["ArchivedMD5"] = md5.hexdigest()
+                resp["ArchivedSize"] = imageFile.stat().st_size
+            yield resp
+
+    def createAlbum(self, parent, name, **params):
+        albumDir = self._folderDir(parent) / name
+        albumDir.mkdir()
+        albumId = uuid.uuid4().hex[:12]
+        self._writeMarker(albumDir, {"Id": albumId, "Version": 0})
+        with self._lock:
+            self._albumIndex()[albumId] = albumDir
+        return self._albumResp(albumDir)
+
+    def renameAlbum(self, album, name):
+        albumDir = self._albumDir(album["Uri"])
+        albumDir = albumDir.rename(albumDir.with_name(name))
+        with self._lock:
+            self._albumIndex()[album["Uri"].split("/")[2]] = albumDir
+        return self._albumResp(albumDir)
+
+    def upload(self, album, image, replaceUri=None):
+        # Streams the file into a temporary file, which replaces the image
+        # when complete.
+        albumDir = self._albumDir(album)
+        target = self._imageFile(replaceUri) if replaceUri else albumDir / image.name
+        tmpFile = target.with_name("." + target.name + ".upload")
+        with open(image, "rb") as src, tmpFile.open("wb") as dst:
+            shutil.copyfileobj(src, dst, CopyBufferSize)
+        tmpFile.replace(target)
+        with self._lock:
+            self.copiedBytes += target.stat().st_size
+        self._changed(albumDir)
+        return self._imageResp(album, target)
+
+    def collectImage(self, album, imageUri, fileName):
+        source = self._imageFile(imageUri)
+        albumDir = self._albumDir(album["Uri"])
+        target = albumDir / fileName
+        try:
+            os.link(source, target)
+        except OSError:
+            shutil.copyfile(source, target)
+        self._changed(albumDir)
+        return self._imageResp(album["Uri"], target)
+
+    def deleteImage(self, imageUri):
+        imageFile = self._imageFile(imageUri)
+        imageFile.unlink()
+        self._changed(imageFile.parent)
+
+    def close(self):
+        logging.info(f"Local backend: copied {sizeFormat(self.copiedBytes)}")
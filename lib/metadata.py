@@ -0,0 +1,117 @@
+#pylint: disable=C,R
+
+import struct
+import datetime
+import logging
+
+# Capture dates are read with a few small reads from the file header, so
+# no imaging library is needed.
+
+_exifHeader = b"Exif\x00\x00"
+_exifScanSize = 256 * 1024
+
+_tagExifIfd = 0x8769
+_tagDateTime = 0x0132
+_tagDateTimeOriginal = 0x9003
+
+_quickTimeEpoch = datetime.datetime(1904, 1, 1, tzinfo=datetime.timezone.utc).timestamp()
+
+def _readIfd(tiff, offset, endian):
+    entries = {}
+    if offset + 2 > len(tiff):
+        return entries
+    count = struct.unpack_from(endian + "H", tiff, offset)[0]
+    for i in range(count):
+        entryOffset = offset + 2 + i * 12
+        if entryOffset + 12 > len(tiff):
+            break
+        tag, fieldType, valueCount = struct.unpack_from(endian + "HHI", tiff, entryOffset)
+        if fieldType == 2 and valueCount > 4:
+            # ASCII value stored at an offset
+            valueOffset = struct.unpack_from(endian + "I", tiff, entryOffset + 8)[0]
+            entries[tag] = tiff[valueOffset:valueOffset + valueCount].rstrip(b"\x00")
+        elif fieldType == 4:
+            entries[tag] = struct.unpack_from(endian + "I", tiff, entryOffset + 8)[0]
+    return entries
+
+def _parseExifDate(value):
+    try:
+        return datetime.datetime.strptime(value.decode("ascii").strip(), "%Y:%m:%d %H:%M:%S").timestamp()
+    except (ValueError, UnicodeDecodeError):
+        return None
+
+def exifDate(path):
+    with open(path, "rb") as fp:
+        data = fp.read(_exifScanSize)
+
+    pos = data.find(_exifHeader)
+    if pos < 0:
+        return None
+    tiff = data[pos + len(_exifHeader):]
+    if tiff[:2] == b"II":
+        endian = "<"
+    elif tiff[:2] == b"MM":
+        endian = ">"
+    else:
+        return None
+
+    ifd0 = _readIfd(tiff, struct.unpack_from(endian + "I", tiff, 4)[0], endian)
+    if _tagExifIfd in ifd0:
+        exifIfd = _readIfd(tiff, ifd0[_tagExifIfd], endian)
+        if _tagDateTimeOriginal in exifIfd:
+            return _parseExifDate(exifIfd[_tagDateTimeOriginal])
+    if _tagDateTime in ifd0:
+        return _parseExifDate(ifd0[_tagDateTime])
+    return None
+
+def _iterBoxes(fp, end):
+    while fp.tell() + 8 <= end:
+        start = fp.tell()
+        size, boxType = struct.unpack(">I4s", fp.read(8))
+        if size == 1:
+            size = struct.unpack(">Q", fp.read(8))[0]
+        elif size == 0:
+            size = end - start
+        if size < 8:
+            return
+        yield boxType, start, fp.tell(), start + size
+        fp.seek(start + size)
+
+def quickTimeDate(path):
+    with open(path, "rb") as fp:
+        fp.seek(0, 2)
+        fileSize = fp.tell()
+        fp.seek(0)
+        for boxType, _, dataStart, end in _iterBoxes(fp, fileSize):
+            if boxType != b"moov":
+                continue
+            fp.seek(dataStart)
+            for subType, _, subStart, _ in _iterBoxes(fp, end):
+                if subType == b"mvhd":
+                    fp.seek(subStart)
+                    version = fp.read(4)[0]
+                    if version == 1:
+                        created = struct.unpack(">Q", fp.read(8))[0]
+                    else:
+                        created = struct.unpack(">I", fp.read(4))[0]
+                    if created:
+                        return _quickTimeEpoch + created
+                    return None
+    return None
+
+_readers = {
+    "jpg": exifDate, "jpeg": exifDate, "heic": exifDate,
+    "mp4": quickTimeDate, "mov": quickTimeDate, "m4v": quickTimeDate,
+}
+
+def captureDate(path):
+    # Returns the capture date as timestamp or None if the file doesn't
+    # contain one.
+    reader = _readers.get(path.suffix.lower().lstrip("."))
+    if not reader:
+        return None
+    try:
+        return reader(path)
+    except (OSError, struct.error, IndexError) as e:
+        logging.debug("Failed to read capture date of %s: %r", path, e)
+        return None
@@ -0,0 +1,19 @@
+#pylint: disable=C,R,W1203
+
+import concurrent.futures
+
+def processPool(workers):
+    # Forked workers would inherit the locks of the upload and server
+    # threads in whatever state they are, so they are started fresh.
+    import multiprocessing
+    method = "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+    return concurrent.futures.ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context(method))
+
+def mapFiles(func, paths, workers, minFiles, chunksize):
+    # Returns func(path) for every path, computed in a process pool. Below
+    # minFiles paths they are computed in-process, as starting a process
+    # pool would take longer.
+    if workers > 1 and len(paths) >= minFiles:
+        with processPool(workers) as executor:
+            return list(executor.map(func, paths, chunksize=chunksize))
+    return [func(p) for p in paths]
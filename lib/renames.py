@@ -0,0 +1,181 @@
+#pylint: disable=C,R,W1203
+
+import logging
+from lib.smugmugapi import normalizeName, SmugMugException
+from lib.hashing import md5File, md5Files
+
+def similarity(common, sizeA, sizeB):
+    union = sizeA + sizeB - common
+    return common / union if union else 0.0
+
+def canMatch(countA, countB, minSimilarity):
+    # Upper bound of the similarity of sets of these sizes
+    return min(countA, countB) >= minSimilarity * max(countA, countB)
+
+# Matches local folders/albums without a remote counterpart against remote
+# nodes whose local directory doesn't exist anymore, so a renamed or moved
+# directory is renamed/moved on Smugmug instead of being uploaded again.
+# Albums are matched by the names of their images and then confirmed by the
+# size and MD5 of the local files.
+class RenameDetector:
+
+    def __init__(self, imageDir, root, router=None, minSimilarity=0.8, fileCache=None):
+        self.imageDir = imageDir
+        self.root = root
+        self.router = router
+        self.minSimilarity = minSimilarity
+        self.fileCache = fileCache
+        self._orphanAlbums = None
+        self._orphanFolders = None
+        self._nameIndex = None
+        self._unloaded = None
+
+    def _findOrphans(self, path, folder, container):
+        if self.router and self.router.isRouted(path):
+            return
+        for c in folder.getChildren():
+            subPath = path / c.getName()
+            orphanContainer = container
+            if not container and not subPath.is_dir():
+                orphanContainer = c
+            if c.isAlbum():
+                if orphanContainer:
+                    self._orphanAlbums[c] = (folder, orphanContainer)
+            else:
+                if orphanContainer is c:
+                    self._orphanFolders[c] = folder
+                self._findOrphans(subPath, c, orphanContainer)
+
+    def _buildIndex(self):
+        self._orphanAlbums = {}
+        self._orphanFolders = {}
+        self._findOrphans(self.imageDir, self.root, None)
+
+        # Index of normalized image names to the orphaned albums containing
+        # them, so matching an album only touches albums sharing names.
+        # Albums are only added (and their images loaded) once an album of
+        # about their image count is matched.
+        self._nameIndex = {}
+        self._albumSizes = {}
+        self._unloaded = list(self._orphanAlbums)
+
+        logging.debug(f"Found {len(self._orphanAlbums)} albums and {len(self._orphanFolders)} folders without local directory")
+
+    def _indexAlbum(self, album):
+        names = set(img.getNormalizedName() for img in album.getImages())
+        self._albumSizes[album] = len(names)
+        for name in names:
+            self._nameIndex.setdefault(name, []).append(album)
+
+    def _loadCandidates(self, count):
+        unloaded = []
+        for album in self._unloaded:
+            if album not in self._orphanAlbums:
+                continue
+            imageCount = album.getImageCount()
+            if imageCount is not None and not canMatch(imageCount, count, self.minSimilarity):
+                unloaded.append(album)
+                continue
+            if not album.getImages():
+                try:
+                    album.reload()
+                except SmugMugException as e:
+                    logging.debug(f"Ignoring album {album.getName()}: {e!r}")
+                    del self._orphanAlbums[album]
+                    continue
+            self._indexAlbum(album)
+        self._unloaded = unloaded
+
+    def _removeOrphan(self, node):
+        if node in self._orphanFolders:
+            del self._orphanFolders[node]
+            for album, (_, container) in list(self._orphanAlbums.items()):
+                if container is node:
+                    del self._orphanAlbums[album]
+        else:
+            del self._orphanAlbums[node]
+
+    def _matchAlbum(self, files):
+        localNames = set(normalizeName(f.name) for f in files)
+        self._loadCandidates(len(localNames))
+        commonCount = {}
+        for name in localNames:
+            for album in self._nameIndex.get(name, ()):
+                if album in self._orphanAlbums:
+                    commonCount[album] = commonCount.get(album, 0) + 1
+
+        candidates = []
+        for album, common in commonCount.items():
+            s = similarity(common, len(localNames), self._albumSizes[album])
+            if s >= self.minSimilarity:
+                candidates.append((s, album))
+        candidates.sort(key=lambda candidate: -candidate[0])
+
+        for _, album in candidates:
+            if self._confirmAlbum(album, files):
+                return album
+        return None
+
+    def _confirmAlbum(self, album, files):
+        # Counts the local files whose size and MD5 match the remote image of
+        # the same name.
+        try:
+            details = album.getArchivedDetails()
+        except SmugMugException as e:
+            logging.debug(f"Ignoring album {album.getName()}: {e!r}")
+            return False
+        localFiles = dict((normalizeName(f.name), f) for f in files)
+        sizeMatches = {}
+        for detail in details:
+            f = localFiles.get(normalizeName(detail["FileName"]))
+            if f and detail.get("ArchivedSize") == f.stat().st_size:
+                sizeMatches[f] = detail.get("ArchivedMD5")
+
+        if self.fileCache is not None:
+            hashes = md5Files(list(sizeMatches), self.fileCache, 1)
+        else:
+            hashes = dict((f, md5File(f)) for f in sizeMatches)
+        common = sum(1 for f, md5 in sizeMatches.items() if hashes[f] == md5)
+
+        if similarity(common, len(localFiles), self._albumSizes[album]) < self.minSimilarity:
+            logging.info(f"Not adopting {album.getName()}, only {common} of {len(localFiles)} files have the same content")
+            return False
+        return True
+
+    def _matchFolder(self, parent, childNames):
+        best = None
+        bestSimilarity = self.minSimilarity
+        for folder, folderParent in self._orphanFolders.items():
+            if folderParent is not parent:
+                continue
+            remoteNames = set(c.getName() for c in folder.getChildren())
+            s = similarity(len(remoteNames & childNames), len(remoteNames), len(childNames))
+            if s >= bestSimilarity:
+                best = folder
+                bestSimilarity = s
+        return best
+
+    def adopt(self, name, changes, parent):
+        # Returns an existing remote node renamed/moved to parent/name or
+        # None if no matching node was found.
+        if self._nameIndex is None:
+            self._buildIndex()
+
+        if isinstance(changes, list):
+            album = self._matchAlbum(changes)
+            if not album:
+                return None
+            oldParent = self._orphanAlbums[album][0]
+            self._removeOrphan(album)
+            if oldParent is not parent:
+                parent.moveAlbum(album, oldParent)
+            if album.getName() != name:
+                album.rename(name)
+            return album
+
+        folder = self._matchFolder(parent, set(changes))
+        if not folder:
+            return None
+        self._removeOrphan(folder)
+        folder.rename(name)
+        return folder
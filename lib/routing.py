@@ -0,0 +1,80 @@
+#pylint: disable=C,R,W1203
+
+import os
+import logging
+import datetime
+from pathlib import Path
+from lib.metadata import captureDate
+from lib.pool import mapFiles
+
+# Below this number of files the capture dates are read in-process
+MinFilesForPool = 64
+
+def readCaptureDates(paths, workers):
+    return mapFiles(captureDate, paths, workers, MinFilesForPool, 64)
+
+# Splits the files of configured local folders into albums by capture date,
+# instead of mapping the directory structure one-to-one onto albums.
+class DateRouter:
+
+    def __init__(self, imageDir, config, fileCache):
+        self.imageDir = imageDir
+        self.folders = set(Path(f) for f in config.get("Folders", []))
+        self.albumFormat = config.get("Album", "%Y-%m")
+        self.workers = config.get("Workers") or os.cpu_count() or 1
+        self.fileCache = fileCache
+        self._routes = {}
+
+    def isRouted(self, path):
+        try:
+            return path.relative_to(self.imageDir) in self.folders
+        except ValueError:
+            return False
+
+    def _listFiles(self, path, fileFilter):
+        for p in path.iterdir():
+            if p.is_dir():
+                if not p.name.startswith("_"):
+                    yield from self._listFiles(p, fileFilter)
+            elif fileFilter(p):
+                yield p
+
+    def reset(self):
+        # Called before each sync of a long running process, to see files
+        # added since the last one.
+        self._routes = {}
+
+    def route(self, path, fileFilter):
+        # The routing is only done once per sync, later scans of the same
+        # folder reuse it.
+        if path not in self._routes:
+            self._routes[path] = self._route(path, fileFilter)
+        return self._routes[path]
+
+    def _route(self, path, fileFilter):
+        files = []
+        missing = []
+        for f in self._listFiles(path, fileFilter):
+            stat = f.stat()
+            date = self.fileCache.get(f, "captureDate", stat)
+            files.append((f, stat, date))
+            if date is None:
+                missing.append(f)
+
+        if missing:
+            logging.info(f"Reading capture dates of {len(missing)} files in {path}")
+            dates = dict(zip(missing, readCaptureDates(missing, self.workers)))
+        else:
+            dates = {}
+
+        albums = {}
+        for f, stat, date in files:
+            if date is None:
+                date = dates.get(f)
+                if date is None:
+                    date = stat.st_mtime
+                self.fileCache.set(f, "captureDate", date, stat)
+            albumName = datetime.datetime.fromtimestamp(date).strftime(self.albumFormat)
+            albums.setdefault(albumName, []).append(f)
+
+        return dict((name, sorted(albums[name])) for name in sorted(albums))
@@ -0,0 +1,445 @@
+#pylint: disable=C,R,W1203
+
+import logging
+import threading
+import time
+import heapq
+import functools
+from lib.smugmugapi import sizeFormat, normalizeName, SmugMugException
+from lib.filecache import fileIdentity
+
+class UploadItem:
+
+    def __init__(self, album, path, albumIndex, albumAge):
+        self.album = album
+        self.path = path
+        self.stat = path.stat()
+        self.size = self.stat.st_size
+        self.albumIndex = albumIndex
+        self.albumAge = albumAge
+        self.linkUri = None
+        self.replaceUri = None
+        self.uploadPath = path
+        self.taken = False
+        self.lease = None
+
+def orderByName(item):
+    return (item.albumIndex, item.path)
+
+def orderBySize(item):
+    return (item.size, item.path)
+
+def orderByAlbumAge(item):
+    return (item.albumAge, item.albumIndex, item.path)
+
+# Maps the configured Upload: Order to a sort key and whether the queue
+# is taken from the end (largest first).
+Policies = {
+    "name": (orderByName, False),
+    "smallFirst": (orderBySize, False),
+    "largestFirst": (orderBySize, True),
+    "mixed": (orderBySize, False),
+    "oldestAlbum": (orderByAlbumAge, False),
+}
+
+def formatDuration(seconds):
+    seconds = int(seconds)
+    return "%d:%02d:%02d" % (seconds // 3600, (seconds // 60) % 60, seconds % 60)
+
+# Totals of a scheduler over all its runs. Files queued again by a retry
+# pass are only counted once.
+class Progress:
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.totalFiles = 0
+        self.totalBytes = 0
+        self.doneFiles = 0
+        self.doneBytes = 0
+        self.startTime = None
+        self.firstUploadTime = None
+        self._counted = set()
+        self._done = set()
+
+    def add(self, path, size):
+        with self._lock:
+            if path in self._counted:
+                return
+            self._counted.add(path)
+            self.totalFiles += 1
+            self.totalBytes += size
+
+    def start(self):
+        if not self.startTime:
+            self.startTime = time.time()
+
+    def started(self):
+        # Records the time to the first upload
+        if self.firstUploadTime is None:
+            self.firstUploadTime = time.time()
+            logging.debug("First upload started after %.1fs", self.firstUploadTime - self.startTime)
+
+    def done(self, path, size):
+        with self._lock:
+            if path in self._done:
+                return
+            self._done.add(path)
+            self.doneFiles += 1
+            self.doneBytes += size
+
+    def skipped(self, path, size):
+        with self._lock:
+            if path not in self._counted or path in self._done:
+                return
+            self._counted.discard(path)
+            self.totalFiles -= 1
+            self.totalBytes -= size
+
+    def rate(self):
+        if not self.startTime:
+            return 0.0
+        elapsed = time.time() - self.startTime
+        return self.doneBytes / elapsed if elapsed > 0 else 0.0
+
+    def eta(self):
+        rate = self.rate()
+        if not rate:
+            return None
+        return (self.totalBytes - self.doneBytes) / rate
+
+    def __str__(self):
+        eta = self.eta()
+        return "%d/%d files, %s/%s, %s/s, ETA %s" % (
+            self.doneFiles, self.totalFiles,
+            sizeFormat(self.doneBytes), sizeFormat(self.totalBytes),
+            sizeFormat(self.rate()),
+            formatDuration(eta) if eta is not None else "unknown")
+
+class _Reversed:
+
+    __slots__ = ("key",)
+
+    def __init__(self, key):
+        self.key = key
+
+    def __lt__(self, other):
+        return other.key < self.key
+
+    def __eq__(self, other):
+        return self.key == other.key
+
+# Priority queue of upload items. For the mixed order a second heap allows
+# taking the largest items as well, items taken from one heap are skipped
+# in the other.
+class UploadQueue:
+
+    def __init__(self, key, reverse=False, bothEnds=False):
+        self._key = key
+        self._reverse = reverse
+        self._bothEnds = bothEnds
+        self._heap = []
+        self._largestHeap = []
+        self._count = 0
+        self._seq = 0
+
+    def push(self, item):
+        key = self._key(item)
+        self._seq += 1
+        heapq.heappush(self._heap, (_Reversed(key) if self._reverse else key, self._seq, item))
+        if self._bothEnds:
+            heapq.heappush(self._largestHeap, (_Reversed(key), self._seq, item))
+        self._count += 1
+
+    def pop(self, largest=False):
+        heap = self._largestHeap if largest and self._bothEnds else self._heap
+        while heap:
+            item = heapq.heappop(heap)[2]
+            if not item.taken:
+                item.taken = True
+                self._count -= 1
+                return item
+        return None
+
+    def __len__(self):
+        return self._count
+
+# Distributes the uploads of all pending albums over parallel upload slots.
+# Uploads are either added up front and run as one batch (add/run), or
+# streamed in while the workers are already uploading (start/submit/finish).
+#
+# With a file cache, the remote image of every uploaded file is recorded
+# by file identity. Files already uploaded under another path (hardlinks)
+# are linked into their album instead of being uploaded again. Copies of
+# a file pending in the same run wait until the first one is uploaded.
+#
+# With a transcoder, files of the configured formats are converted first
+# and only enter the queue once their conversion is done.
+class UploadScheduler:
+
+    def __init__(self, workers=1, order="name", maxFailures=5, fileCache=None, transcoder=None):
+        if order not in Policies:
+            raise ValueError("Unknown upload order %r, expected one of %s" % (order, ", ".join(Policies)))
+        self.workers = max(1, workers)
+        self.order = order
+        self.maxFailures = maxFailures
+        self.progress = Progress()
+        self._items = []
+        self._albumCount = 0
+        self._condition = threading.Condition()
+        self._queue = None
+        self._threads = []
+        self._closed = True
+        self._failCount = 0
+        self._error = None
+        self.failedCount = 0
+        self.fileCache = fileCache
+        self._uploading = set()
+        self._duplicates = []
+        self.transcoder = transcoder
+        self._transcoding = 0
+        self._paused = False
+        self._largestNext = True
+
+    @classmethod
+    def fromConfig(cls, config, fileCache=None, transcoder=None):
+        uploadConfig = config.get("Upload", {})
+        return cls(workers=uploadConfig.get("Workers", 1),
+            order=uploadConfig.get("Order", "name"),
+            fileCache=fileCache,
+            transcoder=transcoder)
+
+    def _linkedImage(self, item):
+        # The collected image keeps its name, so it is only linked if the
+        # name matches the local file.
+        entry = self.fileCache.get(item.path, "image", item.stat)
+        if entry and normalizeName(entry[1]) == normalizeName(item.path.name):
+            return entry[0]
+        return None
+
+    def _createItems(self, album, files, replaces=None, lease=None):
+        files = list(files)
+        albumAge = min((f.stat().st_mtime for f in files), default=0)
+        if lease:
+            lease.pending += len(files)
+        items = []
+        for f in files:
+            item = UploadItem(album, f, self._albumCount, albumAge)
+            item.lease = lease
+            self.progress.add(item.path, item.size)
+            if replaces:
+                item.replaceUri = replaces.get(f)
+            if self.fileCache is not None and not item.replaceUri:
+                item.linkUri = self._linkedImage(item)
+                if not item.linkUri:
+                    identity = fileIdentity(f, item.stat)
+                    if identity in self._uploading:
+                        self._duplicates.append(item)
+                        continue
+                    self._uploading.add(identity)
+            items.append(item)
+        self._albumCount += 1
+        return items
+
+    def add(self, album, files, replaces=None, lease=None):
+        # replaces maps files to the Uri of a remote image they replace.
+        # With a lease (lib.ledger.AlbumLease), the album is leased before
+        # its first upload and its files are skipped if that fails.
+        self._items.extend(self._createItems(album, files, replaces, lease))
+
+    def pending(self):
+        with self._condition:
+            return len(self._items) + (len(self._queue) if self._queue else 0)
+
+    def pause(self):
+        # Uploads already running are finished, no new ones are started.
+        with self._condition:
+            self._paused = True
+
+    def resume(self):
+        with self._condition:
+            self._paused = False
+            self._condition.notify_all()
+
+    def isPaused(self):
+        return self._paused
+
+    def run(self):
+        if not self._items:
+            return
+
+        logging.info(f"Uploading {self.progress.totalFiles} files ({sizeFormat(self.progress.totalBytes)}) with {self.workers} worker(s), order {self.order}")
+
+        self.start()
+        with self._condition:
+            self._enqueue(self._items)
+            self._items = []
+        self.finish()
+
+    def start(self):
+        key, reverse = Policies[self.order]
+        self._queue = UploadQueue(key, reverse, bothEnds=self.order == "mixed")
+        self._closed = False
+        self._failCount = 0
+        self._error = None
+
+        self.progress.start()
+        self._threads = [threading.Thread(target=self._work, args=(slot,), daemon=True)
+            for slot in range(self.workers)]
+        for t in self._threads:
+            t.start()
+
+    def submit(self, album, files, lease=None):
+        items = self._createItems(album, files, lease=lease)
+        with self._condition:
+            self._enqueue(items)
+
+    def finish(self):
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        for t in self._threads:
+            t.join()
+        self._threads = []
+        self._uploading = set()
+
+        if self._error:
+            raise self._error
+
+        if self._duplicates:
+            items = self._duplicates
+            self._duplicates = []
+            logging.info(f"Linking {len(items)} files already uploaded under another path")
+            self.start()
+            with self._condition:
+                for item in items:
+                    item.linkUri = self._linkedImage(item)
+                self._enqueue(items)
+            self.finish()
+
+    def _enqueue(self, items):
+        # Called with the condition held
+        for item in items:
+            if self.transcoder and not item.linkUri and not item.replaceUri and self.transcoder.handles(item.path):
+                self._transcoding += 1
+                future = self.transcoder.submit(item.path, item.stat)
+                future.add_done_callback(functools.partial(self._transcoded, item))
+            else:
+                self._queue.push(item)
+        self._condition.notify_all()
+
+    def _transcoded(self, item, future):
+        with self._condition:
+            self._transcoding -= 1
+            try:
+                item.uploadPath = self.transcoder.result(item.path, item.stat, future)
+                self._queue.push(item)
+            except Exception as e: #pylint: disable=W0718
+                logging.error("Failed to transcode %s: %r", item.path, e)
+                self.progress.skipped(item.path, item.size)
+                self._failed(e)
+                self._leaseDone(item)
+            self._condition.notify_all()
+
+    def _leased(self, item):
+        # Leases the album of the item when its first upload starts.
+        lease = item.lease
+        with lease.lock:
+            if lease.held is None:
+                try:
+                    lease.held = lease.acquire()
+                except Exception as e: #pylint: disable=W0718
+                    logging.error("Failed to lease %s: %r", lease.albumPath, e)
+                    lease.held = False
+            return lease.held
+
+    def _leaseDone(self, item):
+        # Releases the lease after the last item of the album.
+        lease = item.lease
+        if not lease:
+            return
+        with self._condition:
+            lease.pending -= 1
+            release = lease.pending == 0 and lease.held
+        if release:
+            lease.release()
+
+    def _failed(self, e):
+        # Called with the condition held
+        self.failedCount += 1
+        self._failCount += 1
+        if self._failCount >= self.maxFailures and not self._error:
+            logging.error("Too many failed uploads, giving up.")
+            self._error = e
+            self._condition.notify_all()
+
+    def _transfer(self, item):
+        if item.lease and item.album.hasImage(item.path):
+            logging.info(f"Skipping {item.path.name}, uploaded by another worker")
+            return
+
+        if item.replaceUri:
+            item.album.replaceImage(item.replaceUri, item.path)
+            return
+
+        if item.linkUri:
+            try:
+                item.album.collectImage(item.linkUri, item.path)
+                return
+            except SmugMugException as e:
+                logging.warning(f"Failed to link {item.path.name}, uploading it instead: {e!r}")
+                if self.transcoder and self.transcoder.handles(item.path):
+                    item.uploadPath = self.transcoder.result(item.path, item.stat,
+                        self.transcoder.submit(item.path, item.stat))
+
+        image = item.album.upload(item.uploadPath)
+        if self.fileCache is not None and image:
+            self.fileCache.set(item.path, "image", (image.getUri(), image.getFileName()), item.stat)
+
+    def _next(self, slot):
+        with self._condition:
+            while True:
+                if self._error:
+                    return None
+                if self._paused:
+                    self._condition.wait()
+                    continue
+                # In mixed mode the first slot works through the large files
+                # while the others take care of the small ones. A single
+                # slot alternates between both.
+                largest = False
+                if self.order == "mixed":
+                    largest = slot == 0 if self.workers > 1 else self._largestNext
+                item = self._queue.pop(largest=largest)
+                if item and self.order == "mixed" and self.workers == 1:
+                    self._largestNext = not self._largestNext
+                if item or (self._closed and not self._transcoding):
+                    return item
+                self._condition.wait()
+
+    def _work(self, slot):
+        while True:
+            item = self._next(slot)
+            if not item:
+                return
+
+            if item.lease and not self._leased(item):
+                self.progress.skipped(item.path, item.size)
+                self._leaseDone(item)
+                continue
+
+            self.progress.started()
+            try:
+                self._transfer(item)
+            except Exception as e: #pylint: disable=W0718
+                logging.exception("Failed to upload %r", e)
+                self.progress.skipped(item.path, item.size)
+                with self._condition:
+                    self._failed(e)
+                self._leaseDone(item)
+                continue
+
+            with self._condition:
+                self._failCount = 0
+            self.progress.done(item.path, item.size)
+            self._leaseDone(item)
+            logging.info("Progress: %s", self.progress)
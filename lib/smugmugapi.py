@@ -1,14 +1,18 @@
 #pylint: disable=C,R,W0212
 
-from requests_oauthlib import OAuth1Session
 import json
-import pickle
 import logging
 import time
+import threading
+import concurrent.futures
 import urllib.parse as urlparse
-from requests_toolbelt.multipart import encoder
-
-CurrentSmugMugApi = None
+import functools
+import hashlib
+import bisect
+import array
+import contextlib
+from lib.concurrency import AdaptiveLimiter, parseRetryAfter
+from lib.backend import Backend
 
 urlTransTab = str.maketrans('', '', ' _.+&/\\\'()@')
 
@@ -24,10 +28,11 @@ def sizeFormat(nbytes):
     return '%s %s' % (f, suffixes[i])
 
 class SmugMugException(Exception):
-    def __init__(self, errCode, errMsg):
+    def __init__(self, errCode, errMsg, retryAfter=None):
         super().__init__(errCode, errMsg)
         self.errCode = errCode
         self.errMsg = errMsg
+        self.retryAfter = retryAfter
 
     def __repr__(self):
         return "SmugMugExcpetion " + repr(self.errCode) + ": " + repr(self.errMsg)
@@ -37,19 +42,51 @@ def extractUri(uri):
         return uri["Uri"]
     return uri
 
+def nameHash(name):
+    # 64 bit hash of a filename, stable across runs (unlike hash()).
+    return int.from_bytes(hashlib.blake2b(name.encode("utf-8"), digest_size=8).digest(), "little", signed=True)
+
+# Extensions of files transcoded before the upload, mapped to the extension
+# of the uploaded file.
+_extensionAliases = {}
+
+def setExtensionAliases(aliases):
+    _extensionAliases.clear()
+    _extensionAliases.update((ext.lower(), alias) for ext, alias in aliases.items())
+    normalizeName.cache_clear()
+
+def getExtensionAliases():
+    return dict(_extensionAliases)
+
+@functools.lru_cache(maxsize=65536)
 def normalizeName(name):
     # Needed to match files. Smugmug API is sometimes
     # returning a different extension to what was uploaded.
     for ff in (("_mp4.MP4", ".mp4"), (".MP4", ".mp4")):
         if name.endswith(ff[0]):
             return name.replace(ff[0], ff[1])
+    if _extensionAliases:
+        stem, dot, ext = name.rpartition(".")
+        alias = _extensionAliases.get(ext.lower())
+        if dot and alias:
+            return stem + "." + alias
     return name
 
+# Estimated memory of a loaded image with its response, used by the album
+# cache.
+ImageMemorySize = 400
+
 class Image():
 
     def __init__(self, resp):
         super().__init__()
         self._resp = resp
+        self._normalizedName = normalizeName(resp["FileName"])
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        # The extension aliases may have changed since the image was stored.
+        self._normalizedName = normalizeName(self._resp["FileName"])
 
     def __str__(self):
         return "%s [Image]" % (self.getFileName())
@@ -57,76 +94,217 @@ class Image():
     def getFileName(self):
         return self._resp["FileName"]
 
+    def getNormalizedName(self):
+        return self._normalizedName
+
+    def getUri(self):
+        return self._resp["Uri"]
+
     def toString(self, depth=0):
         return "%s%s\n" % ((" " * (depth*4)), self)
 
 class Album():
 
-    def __init__(self, resp, lazy=True):
+    def __init__(self, api, resp, lazy=True):
         super().__init__()
-        self._filenameCache = dict()
+        self._api = api
+        self._nameHashes = None
+        self._snapshot = None
+        self._clean = None
+        self._stale = False
+        self._lock = threading.RLock()
         self.__load(resp, lazy)
 
     def __getstate__(self):
+        self.__loadImages()
         state = self.__dict__.copy()
-        if "_filenameCache" in state:
-            del state["_filenameCache"]
+        for transient in ("_api", "_lock", "_snapshot", "_clean", "_stale"):
+            if transient in state:
+                del state[transient]
         return state
 
     def __setstate__(self, state):
+        self._nameHashes = None
+        self._snapshot = None
+        self._clean = None
+        self._stale = False
         self.__dict__.update(state)
-        self._filenameCache = dict()
+        self._api = None
+        self._lock = threading.RLock()
+
+    # _snapshot is the store (a snapshot, or the spill store of the album
+    # cache) and index of the images while they are not loaded. Albums read
+    # their images on first use. _clean keeps the store after loading until
+    # the images are modified, so they can be evicted again without writing
+    # them. _stale albums list their images again on first use.
+    def __loadImages(self):
+        if self._stale:
+            self.__reloadChildren()
+        if self._snapshot:
+            with self._lock:
+                if self._snapshot:
+                    snapshot, index = self._snapshot
+                    self._images = snapshot.readImages(index)
+                    self._clean = self._snapshot
+                    self._snapshot = None
+
+    def __touch(self):
+        # Records the use for the album cache, outside of the album's lock.
+        albumCache = self._api.albumCache if self._api else None
+        if albumCache:
+            albumCache.touch(self)
+
+    def memorySize(self):
+        size = len(self._images) * ImageMemorySize
+        if self._nameHashes is not None:
+            size += len(self._nameHashes) * 8
+        return size
+
+    def evict(self, spillStore):
+        # Drops the images and name hashes, which are read again from the
+        # snapshot or the spill store when needed.
+        with self._lock:
+            if not self._snapshot:
+                self._snapshot = self._clean or (spillStore, spillStore.write(self._images))
+                self._images = []
+                self._clean = None
+            self._nameHashes = None
+
+    def __changed(self):
+        # Marks the content to be saved
+        if self._api:
+            self._api.contentDirty = True
+
+    def setApi(self, api):
+        self._api = api
 
     def __load(self, resp=None, lazy=True):
         if resp:
             self._resp = resp
         else:
-            self._resp = CurrentSmugMugApi._get(self._resp["Uri"],
-                dataFilter=Album.dataFilter,
-                uriFilter=Album.uriFilter)["Album"]
-
-        self._images = []
-        self._filenameCache.clear()
+            self._resp = self._api.getAlbum(self._resp)
+        self.__changed()
 
         if not lazy:
             self.__reloadChildren()
         else:
+            with self._lock:
+                self.__setImages([])
             logging.debug("Lazy load Album %s", self.getName())
 
     def reload(self):
         logging.debug("Reload of Album %s", self.getName())
         self.__load(lazy=False)
 
-    def __reloadChildren(self):
-        pagedResp = CurrentSmugMugApi._get(extractUri(self._resp["Uris"]["AlbumImages"]),
-            dataFilter=["FileName"],
-            paged=True)
+    def __setImages(self, images):
+        # Called with the lock held
+        self._images = images
+        self._nameHashes = None
+        self._snapshot = None
+        self._clean = None
+        self._stale = False
 
-        self._filenameCache.clear()
-        for resp in pagedResp:
-            if "AlbumImage" in resp:
-                for img in resp["AlbumImage"]:
-                    self._images.append(Image(img))
-
-        logging.debug("%s has %d images", self._resp["Name"], len(self._images))
+    def __reloadChildren(self):
+        # The images are listed into a new list, as the album may be evicted
+        # during the listing, which must not spill a partial list.
+        images = [Image(img) for img in self._api.listImages(self._resp)]
+        with self._lock:
+            self.__setImages(images)
+        self.__changed()
+
+        logging.debug("%s has %d images", self._resp["Name"], len(images))
+        self.__touch()
+
+    # Membership tests use a sorted array of 64 bit hashes of the normalized
+    # image names (one entry per image, so duplicates are counted). It is
+    # stored with the tree cache, built once and then kept up to date by
+    # upload and deleteImage.
+    def __addToFilenameCache(self, image):
+        if self._nameHashes is not None:
+            with self._lock:
+                bisect.insort(self._nameHashes, nameHash(image.getNormalizedName()))
+
+    def __removeFromFilenameCache(self, image):
+        if self._nameHashes is not None:
+            h = nameHash(image.getNormalizedName())
+            with self._lock:
+                i = bisect.bisect_left(self._nameHashes, h)
+                if i < len(self._nameHashes) and self._nameHashes[i] == h:
+                    del self._nameHashes[i]
 
     def hasImage(self, path):
-        if not self._filenameCache:
-            for img in self._images:
-                self._filenameCache[normalizeName(img.getFileName())] = img
+        nameHashes = self._nameHashes
+        if nameHashes is None:
+            with self._lock:
+                snapshot = self._snapshot
+                if snapshot:
+                    nameHashes = snapshot[0].readNameHashes(snapshot[1])
+                if nameHashes is None:
+                    nameHashes = array.array("q", sorted(nameHash(img.getNormalizedName()) for img in self.getImages()))
+                self._nameHashes = nameHashes
+            self.__touch()
 
         from pathlib import Path
         assert isinstance(path, Path)
 
-        return normalizeName(path.name) in self._filenameCache
+        h = nameHash(normalizeName(path.name))
+        i = bisect.bisect_left(nameHashes, h)
+        return i < len(nameHashes) and nameHashes[i] == h
 
     def getImages(self):
-        return self._images
+        self.__loadImages()
+        images = self._images
+        self.__touch()
+        return images
+
+    def getArchivedDetails(self):
+        # FileName, ArchivedMD5 and ArchivedSize of all images. The cached
+        # images are not touched.
+        return list(self._api.listImages(self._resp, details=True))
 
     def deleteImage(self, image):
-        self._filenameCache.clear()
-        self._images.remove(image)
-        CurrentSmugMugApi._delete(image._resp["Uri"])
+        with self._lock:
+            self.__loadImages()
+            self.__removeFromFilenameCache(image)
+            # Evicted images are read again as new objects
+            self._images = [img for img in self._images if img.getUri() != image.getUri()]
+            self._clean = None
+        self.__changed()
+        self._api.deleteImage(image.getUri())
+        self._api.countImages(-1)
+        self.__countImages(-1)
+
+    def deleteImages(self, images, workers=1):
+        # Deletes the images in parallel and removes them from the image
+        # list in a single pass. Returns the images that were deleted.
+        def delete(image):
+            self._api.deleteImage(image.getUri())
+            return image
+
+        with concurrent.futures.ThreadPoolExecutor(max_workers=max(1, workers)) as executor:
+            futures = [executor.submit(delete, image) for image in images]
+
+        deleted = set()
+        for future in futures:
+            if future.exception():
+                logging.error("Failed to delete image: %r", future.exception())
+            else:
+                deleted.add(id(future.result()))
+
+        with self._lock:
+            self.__loadImages()
+            # Evicted images are read again as new objects
+            deletedUris = set(image.getUri() for image in images if id(image) in deleted)
+            for image in images:
+                if id(image) in deleted:
+                    self.__removeFromFilenameCache(image)
+            self._images = [image for image in self._images if image.getUri() not in deletedUris]
+            self._clean = None
+        self.__changed()
+        self._api.countImages(-len(deletedUris))
+        self.__countImages(-len(deletedUris))
+
+        return [image for image in images if id(image) in deleted]
 
     def getName(self):
         return self._resp["Name"]
@@ -137,23 +315,79 @@ class Album():
     def isAlbum(self):
         return True
 
+    def rename(self, name):
+        logging.info("Rename album %s to %s", self.getName(), name)
+        self._resp = self._api.renameAlbum(self._resp, name)
+        self.__changed()
+
     def upload(self, path):
 
         start_time = time.time()
         logging.info("Uploading %s (%s) into %s", path.name, sizeFormat(path.stat().st_size), self._resp["Name"])
-        resp = CurrentSmugMugApi.upload(self._resp["Uri"], path)
+        resp = self._api.upload(self._resp["Uri"], path)
         elapsed_time = time.time() - start_time
         logging.info("Uploading %s finished after %ds.", path.name, elapsed_time)
 
         if resp:
-            self._filenameCache.clear()
-            self._images.append(Image(resp))
+            self._api.countImages(1)
+            self.__countImages(1)
+            image = Image(resp)
+            self.__addImage(image)
+            return image
+
+        return None
+
+    def getImagesLastUpdated(self):
+        return self._resp.get("ImagesLastUpdated")
+
+    def getImageCount(self):
+        # As listed with the album and kept up to date by this client, None
+        # if unknown
+        return self._resp.get("ImageCount")
+
+    def __countImages(self, delta):
+        if "ImageCount" in self._resp:
+            self._resp["ImageCount"] += delta
+
+    def replaceImage(self, imageUri, path):
+        # Uploads the file again in place of an existing image.
+        logging.info("Replacing %s (%s) in %s", path.name, sizeFormat(path.stat().st_size), self._resp["Name"])
+        self._api.upload(self._resp["Uri"], path, replaceUri=imageUri)
+
+    def collectImage(self, imageUri, path):
+        # Links an image already uploaded into another album, instead of
+        # uploading the same file again.
+        logging.info("Linking %s into %s", path.name, self._resp["Name"])
+        resp = self._api.collectImage(self._resp, imageUri, path.name)
+        # Unknown whether collected images count towards the account
+        self._api.countImages(None)
+        self.__countImages(1)
+        self.__changed()
+
+        if resp:
+            image = Image(resp)
+            self.__addImage(image)
+            return image
+
+        # The Uri of the image in this album is unknown, the images are
+        # listed again when used.
+        with self._lock:
+            self._nameHashes = None
+            self._stale = True
+        return None
 
-        return path
+    def __addImage(self, image):
+        with self._lock:
+            self.__loadImages()
+            self._images.append(image)
+            self.__addToFilenameCache(image)
+            self._clean = None
+        self.__changed()
+        self.__touch()
 
     def toString(self, depth):
         result = "%s%s\n" % ((" " * (depth*4)), self)
-        for img in self._images:
+        for img in self.getImages():
             result += img.toString(depth+1)
         return result
 
@@ -161,30 +395,45 @@ class Album():
         return "%s [Album]" % (self.getName(),)
 
 Album.uriFilter = ["AlbumImages"]
-Album.dataFilter = ["Name", "Uri"]
+Album.dataFilter = ["Name", "Uri", "ImagesLastUpdated", "ImageCount"]
 
 class Folder():
 
-    def __init__(self, resp=None, lazy=True):
+    def __init__(self, api, resp=None, lazy=True):
         super().__init__()
+        self._api = api
         self._children = []
         self.__load(resp, lazy)
 
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        if "_api" in state:
+            del state["_api"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._api = None
+
+    def __changed(self):
+        # Marks the content to be saved
+        if self._api:
+            self._api.contentDirty = True
+
+    def setApi(self, api):
+        self._api = api
+        for c in self._children:
+            c.setApi(api)
+
     def __load(self, resp=None, lazy=True, incremental=False):
 
         if resp:
             self._resp = resp
         elif hasattr(self, "_resp") and self._resp:
-            self._resp = CurrentSmugMugApi._get(self._resp["Uri"],
-                dataFilter=Folder.dataFilter,
-                uriFilter=Folder.uriFilter)["Folder"]
+            self._resp = self._api.getFolder(self._resp)
         else:
-            self._resp = CurrentSmugMugApi._get(CurrentSmugMugApi.rootNode,
-                dataFilter=Folder.dataFilter,
-                uriFilter=Folder.uriFilter)["Folder"]
-
-        if "Node" in self._resp:
-            self._resp = self._resp["Node"]
+            self._resp = self._api.getRootFolder()
+        self.__changed()
 
         def getNameId(o):
             return (o["Uri"], o["Name"])
@@ -199,33 +448,21 @@ class Folder():
 
             self._children = []
 
-            pagedResp = CurrentSmugMugApi._get(extractUri(self._resp["Uris"]["Folders"]),
-                paged=True,
-                dataFilter=Folder.dataFilter,
-                uriFilter=Folder.uriFilter)
-
-            for resp in pagedResp:
-                if "Folder" in resp:
-                    for folder in resp["Folder"]:
-                        nameId = getNameId(folder)
-                        if nameId not in oldChildrenMap or oldChildrenMap[nameId].isAlbum():
-                            self._children.append(Folder(folder, lazy=False))
-                        else:
-                            self._children.append(oldChildrenMap[nameId])
-
-            pagedResp = CurrentSmugMugApi._get(extractUri(self._resp["Uris"]["FolderAlbums"]),
-                paged=True,
-                dataFilter=Album.dataFilter,
-                uriFilter=Album.uriFilter)
+            for folder in self._api.listFolders(self._resp):
+                nameId = getNameId(folder)
+                if nameId not in oldChildrenMap or oldChildrenMap[nameId].isAlbum():
+                    self._children.append(Folder(self._api, folder, lazy=False))
+                else:
+                    self._children.append(oldChildrenMap[nameId])
 
-            for resp in pagedResp:
-                if "Album" in resp:
-                    for album in resp["Album"]:
-                        nameId = getNameId(album)
-                        if nameId not in oldChildrenMap or not oldChildrenMap[nameId].isAlbum():
-                            self._children.append(Album(album, lazy=False))
-                        else:
-                            self._children.append(oldChildrenMap[nameId])
+            for album in self._api.listAlbums(self._resp):
+                nameId = getNameId(album)
+                if nameId not in oldChildrenMap or not oldChildrenMap[nameId].isAlbum():
+                    self._children.append(Album(self._api, album, lazy=False))
+                else:
+                    # Keeps the images, ImagesLastUpdated tells if they changed
+                    oldChildrenMap[nameId]._resp = album
+                    self._children.append(oldChildrenMap[nameId])
 
         else:
             logging.debug("Lazy load Folder %s", self.getName())
@@ -256,33 +493,66 @@ class Folder():
     def isAlbum(self):
         return False
 
+    # Image count of the account when the content was last known to match the
+    # remote, stored with the content of the root folder.
+    _verifiedImageCount = None
+    _verifiedDateModified = None
+
+    def getApi(self):
+        return self._api
+
+    def getVerifiedImageCount(self):
+        return self._verifiedImageCount
+
+    def getVerifiedDateModified(self):
+        return self._verifiedDateModified
+
+    def setVerifiedImageCount(self, imageCount, dateModified=None):
+        if (imageCount, dateModified) != (self._verifiedImageCount, self._verifiedDateModified):
+            self.__changed()
+        self._verifiedImageCount = imageCount
+        self._verifiedDateModified = dateModified
+
     def createAlbum(self, name, **params):
         logging.info("Create album %s", name)
-        params["UrlName"] = name.translate(urlTransTab)
-        params["Name"] = name
-        params.update(CurrentSmugMugApi.config["Album"])
-        params["TemplateUri"] = "/api/v2/template/18"
-
-        resp = CurrentSmugMugApi._post(extractUri(self._resp["Uris"]["FolderAlbums"]),
-            params,
-            dataFilter=Album.dataFilter,
-            uriFilter=Album.uriFilter)
-        self._children.append(Album(resp["Album"]))
+        self._children.append(Album(self._api, self._api.createAlbum(self._resp, name, **params)))
         return self._children[-1]
 
+    def moveAlbum(self, album, oldParent):
+        logging.info("Move album %s from %s to %s", album.getName(), oldParent.getName(), self.getName())
+        self._api.moveAlbum(self._resp, album._resp)
+        oldParent._children.remove(album)
+        self._children.append(album)
+        self.__changed()
+
+    def rename(self, name):
+        # The Uris of folders contain their path, so the Uris of all
+        # subfolders change as well and need to be reloaded.
+        logging.info("Rename folder %s to %s", self.getName(), name)
+        self._resp = self._api.renameFolder(self._resp, name)
+        self.reload(incremental=True)
+
     def createFolder(self, name):
         logging.info("Create folder %s", name)
-        params = {}
-        params["Name"] = name
-        params["UrlName"] = name.translate(urlTransTab)
-        params.update(CurrentSmugMugApi.config["Folder"])
-        resp = CurrentSmugMugApi._post(extractUri(self._resp["Uris"]["Folders"]),
-            params,
-            dataFilter=Folder.dataFilter,
-            uriFilter=Folder.uriFilter)
-        self._children.append(Folder(resp["Folder"]))
+        self._children.append(Folder(self._api, self._api.createFolder(self._resp, name)))
         return self._children[-1]
 
+    def graft(self, node):
+        # Puts the node of another tree in place of the child with the same
+        # name, to merge the content of several workers.
+        old = self.getChildrenByName(node.getName())
+        if old:
+            self._children.remove(old)
+        self._children.append(node)
+        self.__changed()
+
+    def removeAlbums(self, albumUris):
+        self._children = [c for c in self._children if not (c.isAlbum() and c.getUri() in albumUris)]
+        self.__changed()
+        for c in self._children:
+            if not c.isAlbum():
+                c.removeAlbums(albumUris)
+
     def toString(self, depth=0):
         result = "%s%s\n" % ((" " * (depth*4)), self)
         for nc in self._children:
@@ -295,7 +565,7 @@ class Folder():
 Folder.uriFilter = ["Folders", "FolderAlbums", "SortFolderAlbums"]
 Folder.dataFilter = ["Name", "Uri"]
 
-class SmugMug:
+class SmugMug(Backend):
 
     _tokenUrl = "https://api.smugmug.com/services/oauth/1.0a/getRequestToken"
     _authorizationBaseUrl = "https://api.smugmug.com/services/oauth/1.0a/authorize"
@@ -303,19 +573,171 @@ class SmugMug:
 
     _apiUrl = "https://api.smugmug.com"
 
-    def __init__(self, tokenFile, config):
-        global CurrentSmugMugApi #pylint: disable=W0603
+    # Retries of API requests rejected with 429
+    _throttleRetries = 3
+
+    def __init__(self, tokenFile, config, pools=None, uploadSlots=None, responseCache=None, albumCache=None):
         logging.getLogger("requests_oauthlib").setLevel(logging.WARNING)
         logging.getLogger("urllib3").setLevel(logging.WARNING)
         logging.getLogger("oauthlib").setLevel(logging.WARNING)
 
+        super().__init__(config, albumCache)
         self.tokenFile = tokenFile
-        self.config = config
-        while self.createOAuthSession() == False:
-            self.requestToken()
+        # Clients of several jobs can share the connection pools and one
+        # semaphore limiting the number of concurrent uploads.
+        self.pools = pools
+        self.uploadSlots = uploadSlots
+        self.responseCache = responseCache
+
+        # Concurrent API requests are adapted to latency and errors
+        adaptiveConfig = config.get("Adaptive", {})
+        if adaptiveConfig.get("Enabled"):
+            self.apiLimiter = AdaptiveLimiter.fromConfig("api",
+                adaptiveConfig.get("ApiMax", config.get("Connection", {}).get("Api", {}).get("PoolSize", 10)),
+                adaptiveConfig)
+
+        # The session is created and validated on the first remote call, so
+        # runs that find nothing to do never import the HTTP stack.
+        self._session = None
+        self._rootNode = None
+        self._connectLock = threading.Lock()
+
+    def _connect(self):
+        with self._connectLock:
+            if self._session is None:
+                if not self.pools:
+                    from lib.transport import ConnectionPools
+                    self.pools = ConnectionPools(self.config.get("Connection"))
+                while self.createOAuthSession() == False:
+                    self.requestToken()
+
+    @property
+    def session(self):
+        if self._session is None:
+            self._connect()
+        return self._session
+
+    @property
+    def rootNode(self):
+        if self._session is None:
+            self._connect()
+        return self._rootNode
+
+    def isConnected(self):
+        return self._session is not None
+
+    def getImageCount(self):
+        # The first request authorizes and fetches the count with the user.
+        if self._session is None:
+            self._connect()
+            return self.imageCount
+        return self._get("!authuser", dataFilter=["ImageCount"], uriFilter=[])["User"]["ImageCount"]
+
+    def getDateModified(self):
+        resp = self._get(self.rootNode, dataFilter=["DateModified"], uriFilter=[])["Folder"]
+        return resp.get("Node", resp).get("DateModified")
+
+    def getRootFolder(self):
+        resp = self._get(self.rootNode,
+            dataFilter=Folder.dataFilter,
+            uriFilter=Folder.uriFilter)["Folder"]
+        return resp.get("Node", resp)
+
+    def getFolder(self, folder):
+        resp = self._get(folder["Uri"],
+            dataFilter=Folder.dataFilter,
+            uriFilter=Folder.uriFilter)["Folder"]
+        return resp.get("Node", resp)
+
+    def listFolders(self, folder):
+        for resp in self._get(extractUri(folder["Uris"]["Folders"]),
+                paged=True,
+                dataFilter=Folder.dataFilter,
+                uriFilter=Folder.uriFilter):
+            for folder in resp.get("Folder", []):
+                yield folder.get("Node", folder)
+
+    def listAlbums(self, folder):
+        for resp in self._get(extractUri(folder["Uris"]["FolderAlbums"]),
+                paged=True,
+                dataFilter=Album.dataFilter,
+                uriFilter=Album.uriFilter):
+            yield from resp.get("Album", [])
+
+    def createFolder(self, parent, name):
+        params = {}
+        params["Name"] = name
+        params["UrlName"] = name.translate(urlTransTab)
+        params.update(self.config["Folder"])
+        resp = self._post(extractUri(parent["Uris"]["Folders"]),
+            params,
+            dataFilter=Folder.dataFilter,
+            uriFilter=Folder.uriFilter)["Folder"]
+        return resp.get("Node", resp)
 
-        if not CurrentSmugMugApi:
-            CurrentSmugMugApi = self
+    def renameFolder(self, folder, name):
+        return self._patch(folder["Uri"],
+            {"Name": name, "UrlName": name.translate(urlTransTab)},
+            dataFilter=Folder.dataFilter,
+            uriFilter=Folder.uriFilter)["Folder"]
+
+    def moveAlbum(self, folder, album):
+        self._post(folder["Uri"] + "!moveAlbums",
+            {"MoveUris": album["Uri"]},
+            dataFilter=[], uriFilter=[])
+
+    def getAlbum(self, album):
+        return self._get(album["Uri"],
+            dataFilter=Album.dataFilter,
+            uriFilter=Album.uriFilter)["Album"]
+
+    def listImages(self, album, details=False):
+        # Details are fetched in large pages
+        if details:
+            pagedResp = self._get(extractUri(album["Uris"]["AlbumImages"]),
+                params={"count": 1000},
+                dataFilter=["FileName", "ArchivedMD5", "ArchivedSize"],
+                paged=True)
+        else:
+            pagedResp = self._get(extractUri(album["Uris"]["AlbumImages"]),
+                dataFilter=["FileName"],
+                paged=True,
+                version=album.get("ImagesLastUpdated"))
+        for resp in pagedResp:
+            yield from resp.get("AlbumImage", [])
+
+    def createAlbum(self, parent, name, **params):
+        params["UrlName"] = name.translate(urlTransTab)
+        params["Name"] = name
+        params.update(self.config["Album"])
+        params["TemplateUri"] = "/api/v2/template/18"
+        return self._post(extractUri(parent["Uris"]["FolderAlbums"]),
+            params,
+            dataFilter=Album.dataFilter,
+            uriFilter=Album.uriFilter)["Album"]
+
+    def renameAlbum(self, album, name):
+        return self._patch(album["Uri"],
+            {"Name": name, "UrlName": name.translate(urlTransTab)},
+            dataFilter=Album.dataFilter,
+            uriFilter=Album.uriFilter)["Album"]
+
+    def collectImage(self, album, imageUri, fileName):
+        resp = self._post(album["Uri"] + "!collectimages",
+            {"CollectUris": imageUri},
+            dataFilter=["FileName"], uriFilter=[])
+        for image in resp.get("AlbumImage", []):
+            if image.get("FileName") == fileName:
+                return image
+        return None
+
+    def deleteImage(self, imageUri):
+        self._delete(imageUri)
+
+    def close(self):
+        if self.pools:
+            self.pools.logStats()
+            self.pools.close()
 
     def _checkApiResponse(self, resp):
 
@@ -332,9 +754,61 @@ class SmugMug:
             if "Response" in response:
                 response = response["Response"]
             return response
-        raise SmugMugException(resp.status_code, resp.text)
+        raise SmugMugException(resp.status_code, resp.text, parseRetryAfter(resp.headers.get("Retry-After")))
+
+    def _request(self, callType, url, params, data, headers, version=None, session=None):
+        session = session or self.session
+        cached = None
+        if callType == "get" and self.responseCache:
+            key = self.responseCache.key(url, params)
+            cached = self.responseCache.get(key)
+            if cached:
+                if version is not None and cached.version == version:
+                    self.responseCache.hit(key, revalidated=False)
+                    return cached.response
+                headers = dict(headers, **cached.conditionalHeaders())
+
+        if callType == "get":
+            resp = session.get(url, params=params, headers=headers)
+        elif callType == "post":
+            resp = session.post(url, data=data, params=params, headers=headers)
+        elif callType == "patch":
+            resp = session.patch(url, data=data, params=params, headers=headers)
+        elif callType == "delete":
+            resp = session.delete(url, params=params, headers=headers)
+
+        if cached and resp.status_code == 304:
+            logging.debug("API response: 304, using cached response")
+            self.responseCache.hit(key, revalidated=True)
+            return cached.response
+
+        result = self._checkApiResponse(resp)
+        if callType == "get" and self.responseCache:
+            self.responseCache.store(key, resp.headers.get("ETag"), resp.headers.get("Last-Modified"), version, result)
+        return result
 
-    def _call(self, callType, method, params = None, data=None, uriFilter=None, dataFilter=None, paged=False):
+    def _throttledRequest(self, callType, url, params, data, headers, version=None, session=None):
+        # Requests rejected with 429 weren't processed and are sent again
+        # after Retry-After. With an adaptive limit the limiter holds back
+        # all requests until then.
+        if session is None and self._session is None:
+            # Authentication passes the session being authorized
+            self._connect()
+        for attempt in range(self._throttleRetries + 1):
+            try:
+                with self.apiLimiter.track() if self.apiLimiter else contextlib.nullcontext():
+                    return self._request(callType, url, params, data, headers, version, session)
+            except SmugMugException as e:
+                if e.errCode != 429 or attempt == self._throttleRetries:
+                    raise
+                logging.warning("API request throttled, retrying after %.1fs", e.retryAfter or 1)
+                if not self.apiLimiter or not e.retryAfter:
+                    time.sleep(e.retryAfter or 1)
+
+    def _call(self, callType, method, params = None, data=None, uriFilter=None, dataFilter=None, paged=False, version=None, session=None):
+        # version identifies the state of the requested listing (e.g. the
+        # ImagesLastUpdated of an album). A cached response of the same
+        # version is used without a request.
         if not params:
             params = {}
         if uriFilter == None:
@@ -353,34 +827,31 @@ class SmugMug:
         if not method.startswith("/api/v2"):
             method = "/api/v2" + method
 
-        pagedResponses = []
+        if paged:
+            return self._pages(callType, method, params, data, headers, version)
+
+        logging.debug("API %s: method=%s, data=%r, params=%r", callType, self._apiUrl + method, data, params)
+        resp = self._throttledRequest(callType, self._apiUrl + method, params, data, headers, version, session)
+        if "Pages" in resp and "NextPage" in resp["Pages"]:
+            raise SmugMugException(-1, "Need to call in page mode")
+        return resp
 
+    def _pages(self, callType, method, params, data, headers, version):
+        # Yields the pages of a listing as they are fetched, so the pages of
+        # large albums are not all held in memory at once.
         while True:
 
             logging.debug("API %s: method=%s, data=%r, params=%r", callType, self._apiUrl + method, data, params)
-            if callType == "get":
-                resp = self.session.get(self._apiUrl + method, params=params, headers=headers)
-            elif callType == "post":
-                resp = self.session.post(self._apiUrl + method, data=data, params=params, headers=headers)
-            elif callType == "delete":
-                resp = self.session.delete(self._apiUrl + method, params=params, headers=headers)
-
-            resp = self._checkApiResponse(resp)
-
-            if not paged:
-                if "Pages" in resp and "NextPage" in resp["Pages"]:
-                    raise SmugMugException(-1, "Need to call in page mode")
-                return resp
-            else:
-                pagedResponses.append(resp)
+            resp = self._throttledRequest(callType, self._apiUrl + method, params, data, headers, version)
+            yield resp
 
-                if "Pages" in resp and "NextPage" in resp["Pages"]:
-                    parsedParams = urlparse.parse_qs(urlparse.urlparse(resp["Pages"]["NextPage"]).query)
+            if "Pages" in resp and "NextPage" in resp["Pages"]:
+                parsedParams = urlparse.parse_qs(urlparse.urlparse(resp["Pages"]["NextPage"]).query)
 
-                    params["start"] = parsedParams["start"]
-                    params["count"] = parsedParams["count"]
-                else:
-                    return pagedResponses
+                params["start"] = parsedParams["start"]
+                params["count"] = parsedParams["count"]
+            else:
+                return
 
     def _get(self, method, **params):
         return self._call("get", method, **params)
@@ -388,30 +859,41 @@ class SmugMug:
     def _post(self, method, data, **params):
         return self._call("post", method, data=data, **params)
 
+    def _patch(self, method, data, **params):
+        return self._call("patch", method, data=data, **params)
+
     def _delete(self, method, **params):
         return self._call("delete", method, **params)
 
     def loadToken(self):
+        import pickle
         if self.tokenFile.exists():
             with self.tokenFile.open("rb") as fp:
                 return pickle.load(fp)
         return None
 
     def storeToken(self, token):
+        import pickle
         with self.tokenFile.open("wb") as fp:
             pickle.dump(token, fp)
 
     def createOAuthSession(self):
+        from requests_oauthlib import OAuth1Session
+
         token = self.loadToken()
         if token and "oauth_token" in token and "oauth_token_secret" in token:
-            self.session = OAuth1Session(self.config["SmugMugApi"]["key"],
+            session = OAuth1Session(self.config["SmugMugApi"]["key"],
                 client_secret=self.config["SmugMugApi"]["secret"],
                 resource_owner_key=token['oauth_token'],
                 resource_owner_secret=token['oauth_token_secret'])
+            self.pools.mount(session)
 
-            resp = self._get("!authuser", dataFilter=["NickName", "ImageCount"], uriFilter=["Folder"] )
+            # The session is only published once it is authorized
+            resp = self._get("!authuser", dataFilter=["NickName", "ImageCount"], uriFilter=["Folder"], session=session)
             self.userName = resp["User"]["NickName"]
-            self.rootNode = extractUri(resp["User"]["Uris"]["Folder"])
+            self.imageCount = resp["User"]["ImageCount"]
+            self._rootNode = extractUri(resp["User"]["Uris"]["Folder"])
+            self._session = session
 
             logging.info("Successfully authorized as %s. Currently %d images online", self.userName, resp["User"]["ImageCount"])
             return True
@@ -419,6 +901,8 @@ class SmugMug:
         return False
 
     def requestToken(self):
+        from requests_oauthlib import OAuth1Session
+
         # 1. Get request token
         oauth = OAuth1Session(self.config["SmugMugApi"]["key"], client_secret=self.config["SmugMugApi"]["secret"], callback_uri='oob')
         requestToken = oauth.fetch_request_token(self._tokenUrl)
@@ -439,7 +923,18 @@ class SmugMug:
         authToken = oauth.fetch_access_token(self._accessTokenUrl)
         self.storeToken(authToken)
 
-    def upload(self, album, image):
+    def upload(self, album, image, replaceUri=None):
+        if isinstance(self.uploadSlots, AdaptiveLimiter):
+            with self.uploadSlots.track(image.stat().st_size):
+                return self._upload(album, image, replaceUri)
+        if self.uploadSlots:
+            with self.uploadSlots:
+                return self._upload(album, image, replaceUri)
+        return self._upload(album, image, replaceUri)
+
+    def _upload(self, album, image, replaceUri=None):
+        from requests_toolbelt.multipart import encoder
+
         url = "https://upload.smugmug.com/"
         with open(image, 'rb') as f:
             file = encoder.MultipartEncoder({
@@ -450,11 +945,15 @@ class SmugMug:
                 'X-Smug-Version': 'v2',
                 'X-Smug-Title': image.name,
                 "Content-Type": file.content_type}
+            if replaceUri:
+                # Album images have Uris like /album/<key>/image/<imageKey>
+                headers["X-Smug-ImageUri"] = "/api/v2/image/" + replaceUri.rsplit("/", 1)[-1]
             logging.debug("API upload: files=%s, headers=%r]", file, headers)
             r = self.session.post(url, data=file, headers=headers)
             response = self._checkApiResponse(r)
 
-            uploadedFile = CurrentSmugMugApi._get(response["Image"]["ImageUri"], dataFilter=["FileName"])["Image"]
+            uploadedFile = self._get(response["Image"]["ImageUri"], dataFilter=["FileName"])["Image"]
+            uploadedFile.setdefault("Uri", response["Image"]["ImageUri"])
             uploadedFileName = uploadedFile["FileName"]
             if image.name != uploadedFileName:
                 logging.warning("Filename missmatch after upload. Local: %s Remote: %s", image.name, uploadedFileName)
@@ -0,0 +1,255 @@
+#pylint: disable=C,R,W0212
+
+import sys
+import json
+import mmap
+import array
+import struct
+import logging
+import datetime
+
+from lib.smugmugapi import Folder, Album, Image, nameHash, normalizeName, getExtensionAliases
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# Binary snapshot of the remote tree. Unlike a pickle it doesn't depend on
+# the classes in lib.smugmugapi, and it is read through mmap: folders and
+# albums are created on load, the images and name hashes of an album are
+# only read when the album is used.
+#
+# Layout (little endian):
+#   header    magic, version, flags
+#   body      zstd compressed if flags & FlagZstd
+#     sections  counts and offsets (relative to the body) of:
+#     nodes     fixed-width folder/album records, breadth first, so the
+#               children of a node are consecutive records
+#     images    fixed-width image records, consecutive per album
+#     hashes    sorted 64 bit name hashes, consecutive per album
+#     strings   UTF-8 string table, referenced by offset and length
+#     meta      JSON describing the snapshot
+
+Magic = b"SMUGSNAP"
+Version = 1
+FlagZstd = 1
+
+KindFolder = 0
+KindAlbum = 1
+
+_header = struct.Struct("<8sHH")
+# nodeCount, imageCount, nodes, images, hashes, strings, meta, metaLength
+_sections = struct.Struct("<IIQQQQQQ")
+# kind, childStart, childCount, resp, respLength, imageStart, imageCount, hashStart, hashCount
+_node = struct.Struct("<B3xIIIIIIII")
+# fileName, fileNameLength, uri, uriLength, extra, extraLength
+_image = struct.Struct("<IIIIII")
+_hash = struct.Struct("<q")
+
+class SnapshotError(Exception):
+    pass
+
+def isSnapshot(path):
+    with open(path, "rb") as fp:
+        return fp.read(len(Magic)) == Magic
+
+class _StringTable:
+
+    def __init__(self):
+        self._offsets = {}
+        self.data = bytearray()
+
+    def add(self, s):
+        if not s:
+            return 0, 0
+        ref = self._offsets.get(s)
+        if ref is None:
+            encoded = s.encode("utf-8")
+            ref = (len(self.data), len(encoded))
+            self.data += encoded
+            self._offsets[s] = ref
+        return ref
+
+def _imageFields(album):
+    # (FileName, Uri, other fields as JSON) of all images of an album.
+    # Albums still backed by a snapshot are copied without creating images.
+    snapshot = album._snapshot
+    if snapshot:
+        return snapshot[0].readImageFields(snapshot[1])
+    fields = []
+    for image in album._images:
+        resp = image._resp
+        extra = dict((k, v) for k, v in resp.items() if k not in ("FileName", "Uri"))
+        fields.append((resp["FileName"], resp.get("Uri", ""), json.dumps(extra) if extra else ""))
+    return fields
+
+def _nameHashes(album, fields):
+    if album._nameHashes is not None:
+        return album._nameHashes
+    snapshot = album._snapshot
+    if snapshot:
+        hashes = snapshot[0].readNameHashes(snapshot[1])
+        if hashes is not None:
+            return hashes
+    return sorted(nameHash(normalizeName(fileName)) for fileName, _, _ in fields)
+
+def save(path, root, compress=False):
+    strings = _StringTable()
+    nodes = bytearray()
+    images = bytearray()
+    hashes = bytearray()
+    albumCount = 0
+    imageCount = 0
+
+    order = [root]
+    i = 0
+    while i < len(order):
+        node = order[i]
+        i += 1
+        respRef = strings.add(json.dumps(node._resp, separators=(",", ":")))
+        if node.isAlbum():
+            fields = _imageFields(node)
+            nameHashes = _nameHashes(node, fields)
+            for fileName, uri, extra in fields:
+                images += _image.pack(*strings.add(fileName), *strings.add(uri), *strings.add(extra))
+            hashStart = len(hashes) // _hash.size
+            for h in nameHashes:
+                hashes += _hash.pack(h)
+            nodes += _node.pack(KindAlbum, 0, 0, *respRef,
+                imageCount, len(fields), hashStart, len(nameHashes))
+            albumCount += 1
+            imageCount += len(fields)
+        else:
+            nodes += _node.pack(KindFolder, len(order), len(node._children), *respRef, 0, 0, 0, 0)
+            order.extend(node._children)
+
+    meta = json.dumps({
+        "created": datetime.datetime.now().isoformat(timespec="seconds"),
+        "folders": len(order) - albumCount,
+        "albums": albumCount,
+        "images": imageCount,
+        "verifiedImageCount": root.getVerifiedImageCount(),
+        "verifiedDateModified": root.getVerifiedDateModified(),
+        "extensionAliases": getExtensionAliases()}).encode("utf-8")
+
+    nodesOffset = _sections.size
+    imagesOffset = nodesOffset + len(nodes)
+    hashesOffset = imagesOffset + len(images)
+    stringsOffset = hashesOffset + len(hashes)
+    metaOffset = stringsOffset + len(strings.data)
+
+    body = b"".join((
+        _sections.pack(len(order), imageCount, nodesOffset, imagesOffset, hashesOffset,
+            stringsOffset, metaOffset, len(meta)),
+        nodes, images, hashes, strings.data, meta))
+
+    flags = 0
+    if compress:
+        if zstandard:
+            body = zstandard.ZstdCompressor().compress(body)
+            flags |= FlagZstd
+        else:
+            logging.warning("Snapshot compression requires zstandard, writing it uncompressed")
+
+    tmpFile = path.with_name(path.name + ".tmp")
+    with tmpFile.open("wb") as fp:
+        fp.write(_header.pack(Magic, Version, flags))
+        fp.write(body)
+    tmpFile.replace(path)
+
+class Snapshot:
+
+    def __init__(self, data, bodyOffset):
+        self._data = data
+        self._body = bodyOffset
+        (self.nodeCount, self.imageCount, self._nodes, self._images, self._hashes,
+            self._strings, meta, metaLength) = _sections.unpack_from(data, bodyOffset)
+        self.metadata = json.loads(self._read(meta, metaLength))
+        # The name hashes depend on the extension aliases they were built with.
+        self._hashesValid = self.metadata.get("extensionAliases", {}) == getExtensionAliases()
+
+    def _read(self, offset, length):
+        start = self._body + offset
+        return self._data[start:start + length]
+
+    def _string(self, offset, length):
+        if not length:
+            return ""
+        return self._read(self._strings + offset, length).decode("utf-8")
+
+    def _nodeRecord(self, index):
+        return _node.unpack_from(self._data, self._body + self._nodes + index * _node.size)
+
+    def readImageFields(self, index):
+        _, _, _, _, _, imageStart, imageCount, _, _ = self._nodeRecord(index)
+        fields = []
+        for i in range(imageStart, imageStart + imageCount):
+            record = _image.unpack_from(self._data, self._body + self._images + i * _image.size)
+            fields.append((self._string(*record[0:2]), self._string(*record[2:4]), self._string(*record[4:6])))
+        return fields
+
+    def readImages(self, index):
+        images = []
+        for fileName, uri, extra in self.readImageFields(index):
+            resp = json.loads(extra) if extra else {}
+            resp["FileName"] = fileName
+            if uri:
+                resp["Uri"] = uri
+            images.append(Image(resp))
+        return images
+
+    def readNameHashes(self, index):
+        if not self._hashesValid:
+            return None
+        _, _, _, _, _, _, _, hashStart, hashCount = self._nodeRecord(index)
+        hashes = array.array("q")
+        hashes.frombytes(self._read(self._hashes + hashStart * _hash.size, hashCount * _hash.size))
+        if sys.byteorder == "big":
+            hashes.byteswap()
+        return hashes
+
+    def buildTree(self):
+        # Children always follow their parent, so building the nodes from the
+        # end allows passing the children to the folders.
+        nodes = [None] * self.nodeCount
+        for index in reversed(range(self.nodeCount)):
+            kind, childStart, childCount, resp, respLength, _, _, _, _ = self._nodeRecord(index)
+            state = {"_resp": json.loads(self._string(resp, respLength))}
+            if kind == KindAlbum:
+                node = Album.__new__(Album)
+                state["_images"] = []
+                state["_snapshot"] = (self, index)
+            else:
+                node = Folder.__new__(Folder)
+                state["_children"] = nodes[childStart:childStart + childCount]
+            node.__setstate__(state)
+            nodes[index] = node
+        return nodes[0]
+
+def load(path):
+    # Returns the root folder of the snapshot or None if it was written by an
+    # incompatible version.
+    with open(path, "rb") as fp:
+        magic, version, flags = _header.unpack(fp.read(_header.size))
+        if magic != Magic:
+            raise SnapshotError(f"{path} is not a snapshot")
+        if version != Version:
+            logging.warning("Ignoring snapshot %s of version %d", path, version)
+            return None
+
+        if flags & FlagZstd:
+            if not zstandard:
+                logging.warning("Ignoring compressed snapshot %s, zstandard is not installed", path)
+                return None
+            snapshot = Snapshot(zstandard.ZstdDecompressor().decompress(fp.read()), 0)
+        else:
+            snapshot = Snapshot(mmap.mmap(fp.fileno(), 0, access=mmap.ACCESS_READ), _header.size)
+
+    logging.debug("Loaded snapshot of %s: %d folders, %d albums, %d images",
+        snapshot.metadata["created"], snapshot.metadata["folders"],
+        snapshot.metadata["albums"], snapshot.metadata["images"])
+    root = snapshot.buildTree()
+    root.setVerifiedImageCount(snapshot.metadata.get("verifiedImageCount"),
+        snapshot.metadata.get("verifiedDateModified"))
+    return root
@@ -0,0 +1,75 @@
+#pylint: disable=C,R,W1203
+
+import os
+import logging
+import subprocess
+import concurrent.futures
+from lib.hashing import md5File
+from lib.pool import processPool
+from lib.smugmugapi import setExtensionAliases
+
+def outputPath(outputDir, path, md5, extension):
+    # Outputs are stored by the content hash of the source file, under the
+    # name they are uploaded with.
+    return outputDir / md5 / (path.stem + "." + extension)
+
+def transcodeFile(path, md5, command, outputDir, extension):
+    if md5 is None:
+        md5 = md5File(path)
+    output = outputPath(outputDir, path, md5, extension)
+    if output.exists():
+        return md5, output
+
+    output.parent.mkdir(parents=True, exist_ok=True)
+    tmpOutput = output.with_name("tmp_" + output.name)
+    args = [arg.format(input=path, output=tmpOutput) for arg in command]
+    try:
+        subprocess.run(args, check=True, stdin=subprocess.DEVNULL, stdout=subprocess.DEVNULL, stderr=subprocess.PIPE)
+    except subprocess.CalledProcessError as e:
+        tmpOutput.unlink(missing_ok=True)
+        raise RuntimeError(f"Transcoding {path} failed: {e.stderr.decode(errors='replace').strip()}") from e
+    tmpOutput.replace(output)
+    return md5, output
+
+# Converts files of the configured extensions before they are uploaded, in
+# a process pool next to the upload workers. The uploaded file gets the
+# configured extension, which is registered as alias, so the local file
+# matches the remote image.
+class Transcoder:
+
+    def __init__(self, imageDir, config, fileCache):
+        self.formats = dict((ext.lower().lstrip("."), fmt) for ext, fmt in config.get("Formats", {}).items())
+        self.workers = config.get("Workers") or os.cpu_count() or 1
+        self.outputDir = imageDir / "_transcoded"
+        self.fileCache = fileCache
+        self._executor = None
+        setExtensionAliases(dict((ext, fmt["Extension"]) for ext, fmt in self.formats.items()))
+
+    def handles(self, path):
+        return path.suffix.lower().lstrip(".") in self.formats
+
+    def submit(self, path, stat):
+        # Returns a future of the file to upload instead of path.
+        fmt = self.formats[path.suffix.lower().lstrip(".")]
+        md5 = self.fileCache.get(path, "md5", stat)
+        if md5:
+            output = outputPath(self.outputDir, path, md5, fmt["Extension"])
+            if output.exists():
+                future = concurrent.futures.Future()
+                future.set_result((md5, output))
+                return future
+
+        if not self._executor:
+            self._executor = processPool(self.workers)
+        logging.info(f"Transcoding {path.name}")
+        return self._executor.submit(transcodeFile, path, md5, fmt["Command"], self.outputDir, fmt["Extension"])
+
+    def result(self, path, stat, future):
+        md5, output = future.result()
+        self.fileCache.set(path, "md5", md5, stat)
+        return output
+
+    def close(self):
+        if self._executor:
+            self._executor.shutdown()
+            self._executor = None
@@ -0,0 +1,186 @@
+#pylint: disable=C,R,W0212
+
+import os
+import ssl
+import logging
+import weakref
+import threading
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import httpx
+    # HTTP/2 support of httpx, installed by httpx[http2]
+    import h2 #pylint: disable=W0611
+except ImportError:
+    httpx = None
+
+ApiHost = "https://api.smugmug.com"
+UploadHost = "https://upload.smugmug.com"
+
+def createRetry(retries, statusRetries):
+    # Status based retries are only done for idempotent requests. Failed
+    # uploads are handled by the caller.
+    return Retry(total=retries,
+        connect=retries,
+        read=retries if statusRetries else 0,
+        status=retries if statusRetries else 0,
+        backoff_factor=0.5,
+        status_forcelist=(500, 502, 503, 504),
+        allowed_methods=("GET", "HEAD", "DELETE"),
+        respect_retry_after_header=True,
+        raise_on_status=False)
+
+def createSslContext(verify, cert):
+    # TLS settings of requests: verify is a bool or the path of a CA bundle,
+    # cert the path of a client certificate or a (cert, key) tuple.
+    if isinstance(verify, str):
+        if os.path.isdir(verify):
+            context = ssl.create_default_context(capath=verify)
+        else:
+            context = ssl.create_default_context(cafile=verify)
+    else:
+        context = ssl.create_default_context()
+        if not verify:
+            context.check_hostname = False
+            context.verify_mode = ssl.CERT_NONE
+    if cert:
+        certFile, keyFile = cert if isinstance(cert, tuple) else (cert, None)
+        context.load_cert_chain(certFile, keyFile)
+    return context
+
+# Sends requests through httpx clients with HTTP/2 enabled. The TLS and
+# proxy settings of httpx are per client, so there is a client for each
+# combination used. Responses are always read completely.
+class Http2Adapter(requests.adapters.BaseAdapter):
+
+    _chunkSize = 1024 * 1024
+
+    def __init__(self, poolSize):
+        super().__init__()
+        self._poolSize = poolSize
+        self._clients = {}
+        self._lock = threading.Lock()
+        self._connections = weakref.WeakSet()
+        self.numConnections = 0
+        self.numRequests = 0
+
+    def _client(self, url, verify, cert, proxies):
+        proxy = requests.utils.select_proxy(url, proxies or {})
+        key = (verify, cert, proxy)
+        with self._lock:
+            client = self._clients.get(key)
+            if not client:
+                options = {}
+                if verify is not True or cert:
+                    options["verify"] = createSslContext(verify, cert)
+                if proxy:
+                    options["proxy"] = proxy
+                client = httpx.Client(http2=True,
+                    limits=httpx.Limits(max_connections=self._poolSize, max_keepalive_connections=self._poolSize),
+                    **options)
+                self._clients[key] = client
+            return client
+
+    def send(self, request, stream=False, timeout=None, verify=True, cert=None, proxies=None):
+        if stream:
+            raise ValueError("Streamed responses are not supported over HTTP/2")
+
+        body = request.body
+        if hasattr(body, "read"):
+            body = iter(lambda: request.body.read(self._chunkSize), b"")
+
+        client = self._client(request.url, verify, cert, proxies)
+        with self._lock:
+            self.numRequests += 1
+
+        resp = client.request(request.method, request.url,
+            headers=dict(request.headers),
+            content=body,
+            timeout=timeout)
+
+        # Requests share connections, which are counted once
+        connection = resp.extensions.get("network_stream")
+        if connection is not None:
+            with self._lock:
+                if connection not in self._connections:
+                    self._connections.add(connection)
+                    self.numConnections += 1
+
+        response = requests.Response()
+        response.status_code = resp.status_code
+        response.headers = requests.structures.CaseInsensitiveDict(resp.headers)
+        response.reason = resp.reason_phrase
+        response.url = request.url
+        response.request = request
+        response.encoding = resp.encoding
+        response._content = resp.content
+        return response
+
+    def close(self):
+        with self._lock:
+            clients = list(self._clients.values())
+            self._clients = {}
+        for client in clients:
+            client.close()
+
+# Connection pools for the API and the upload host. The pools can be shared
+# by several SmugMug clients, so connections (and TLS sessions) are reused
+# across jobs and upload threads.
+class ConnectionPools:
+
+    def __init__(self, config=None):
+        config = config or {}
+
+        self.http2 = False
+        if config.get("Http2"):
+            if httpx:
+                self.http2 = True
+            else:
+                logging.warning("HTTP/2 requires httpx[http2], falling back to HTTP/1.1")
+
+        self.adapters = {
+            ApiHost: self._createAdapter(config.get("Api", {}), statusRetries=True),
+            UploadHost: self._createAdapter(config.get("Upload", {}), statusRetries=False)
+        }
+
+    def _createAdapter(self, config, statusRetries):
+        poolSize = config.get("PoolSize", 10)
+        if self.http2:
+            return Http2Adapter(poolSize)
+        return HTTPAdapter(pool_connections=1,
+            pool_maxsize=poolSize,
+            max_retries=createRetry(config.get("Retries", 3), statusRetries))
+
+    def mount(self, session):
+        session.headers["Connection"] = "keep-alive"
+        for host, adapter in self.adapters.items():
+            session.mount(host, adapter)
+
+    def stats(self):
+        result = {}
+        for host, adapter in self.adapters.items():
+            connections = 0
+            numRequests = 0
+            if isinstance(adapter, Http2Adapter):
+                connections = adapter.numConnections
+                numRequests = adapter.numRequests
+            else:
+                pools = adapter.poolmanager.pools
+                for key in pools.keys():
+                    pool = pools.get(key)
+                    if pool:
+                        connections += pool.num_connections
+                        numRequests += pool.num_requests
+            result[host] = (connections, numRequests)
+        return result
+
+    def logStats(self):
+        for host, (connections, numRequests) in self.stats().items():
+            logging.debug("Connections to %s: %d requests over %d connections (%d reused)",
+                host, numRequests, connections, max(0, numRequests - connections))
+
+    def close(self):
+        for adapter in self.adapters.values():
+            adapter.close()
@@ -1,29 +1,112 @@
 #!/usr/bin/python3
 #pylint: disable=C,R,W1203
 
-from lib.smugmugapi import SmugMug, Folder, SmugMugException
+import time
+StartTime = time.perf_counter()
+
+from lib.smugmugapi import SmugMug, Folder, SmugMugException, sizeFormat, normalizeName, setExtensionAliases
+from lib.scheduler import UploadScheduler, formatDuration
+from lib.filecache import FileInfoCache
+from lib.routing import DateRouter
+from lib.renames import RenameDetector
+from lib.hashing import md5Files
+from lib.concurrency import AdaptiveLimiter
+from lib.backend import Backend
+import os
 import logging
 from pathlib import Path
 import datetime
-import time
-import pickle
-import yaml
+import json
 import argparse
+import threading
+import contextlib
+import itertools
+import concurrent.futures
 
-def getContentFilePath(saveDir):
-    return saveDir / ".smugmugContent"
+# Each backend has its own content cache
+def getContentFilePath(saveDir, name=Backend.contentName):
+    return saveDir / name
 
-def saveContentToFile(saveDir, rootFolder):
-    contentFile = getContentFilePath(saveDir)
-    with contentFile.open('wb') as fp:
-        pickle.dump(rootFolder, fp)
+def saveContentToFile(saveDir, rootFolder, compress=False, name=Backend.contentName):
+    from lib import snapshot
+    snapshot.save(getContentFilePath(saveDir, name), rootFolder, compress)
 
-def loadContentFromFile(saveDir):
-    contentFile = getContentFilePath(saveDir)
-    if contentFile.exists():
-        with contentFile.open('rb') as fp:
-            return pickle.load(fp)
-    return None
+def mergeContent(saved, root, keys):
+    # Grafts the albums leased by this worker, with the folders missing in
+    # saved, into the content saved by the other workers of a ledger.
+    # Albums moved by renames are dropped from their old place.
+    grafts = []
+    for key in keys:
+        savedNode, node = saved, root
+        for name in key.split("/"):
+            child = node.getChildrenByName(name)
+            if not child:
+                break
+            savedChild = savedNode.getChildrenByName(name)
+            if child.isAlbum() or not savedChild or savedChild.isAlbum():
+                grafts.append((savedNode, child))
+                break
+            savedNode, node = savedChild, child
+
+    def albumUris(node):
+        if node.isAlbum():
+            return {node.getUri()}
+        return set().union(*(albumUris(c) for c in node.getChildren()))
+
+    uris = set().union(*(albumUris(child) for _, child in grafts))
+    saved.removeAlbums(uris)
+    for savedNode, child in grafts:
+        savedNode.graft(child)
+    saved.setVerifiedImageCount(root.getVerifiedImageCount(), root.getVerifiedDateModified())
+    return saved
+
+def loadContentFromFile(saveDir, name=Backend.contentName):
+    from lib import snapshot
+    contentFile = getContentFilePath(saveDir, name)
+    if not contentFile.exists():
+        return None
+    if snapshot.isSnapshot(contentFile):
+        return snapshot.load(contentFile)
+
+    # Content cache of an older version
+    import pickle
+    with contentFile.open('rb') as fp:
+        return pickle.load(fp)
+
+def getStatsFilePath(saveDir):
+    return saveDir / ".smugmugStats"
+
+def loadStats(saveDir):
+    statsFile = getStatsFilePath(saveDir)
+    if statsFile.exists():
+        with statsFile.open('r', encoding="utf-8") as fp:
+            return json.load(fp)
+    return {}
+
+def saveStats(saveDir, stats):
+    statsFile = getStatsFilePath(saveDir)
+    with statsFile.open('w', encoding="utf-8") as fp:
+        json.dump(stats, fp, indent=2)
+
+def recordThroughput(saveDir, progress):
+    # Smooth the measured throughput over several runs, so a single slow
+    # or fast run doesn't dominate the estimates of the scan plan.
+    if progress.doneBytes <= 0:
+        return
+    stats = loadStats(saveDir)
+    rate = progress.rate()
+    if stats.get("bytesPerSecond"):
+        rate = 0.7 * stats["bytesPerSecond"] + 0.3 * rate
+    stats["bytesPerSecond"] = rate
+    saveStats(saveDir, stats)
+
+def recordConcurrency(saveDir, limiters):
+    stats = loadStats(saveDir)
+    concurrency = stats.setdefault("concurrency", {})
+    for limiter in limiters:
+        limiter.logSummary()
+        concurrency[limiter.name] = limiter.metrics()
+    saveStats(saveDir, stats)
 
 def supportedFileFormat(path):
     if path.is_file() and path.suffix.lower().lstrip(".") in (
@@ -33,38 +116,64 @@ def supportedFileFormat(path):
         return True
     return False
 
+def dropAliasCollisions(path: Path, files):
+    # Files only differing by an aliased extension (IMG_1.heic and IMG_1.jpg
+    # with HEIC transcoded to JPG) are the same remote image. The file with
+    # the uploaded name is kept, the others are skipped.
+    groups = {}
+    for f in files:
+        groups.setdefault(normalizeName(f.name), []).append(f)
+    skipped = set()
+    for name, group in groups.items():
+        if len(group) > 1:
+            keep = next((f for f in group if f.name == name), group[0])
+            for f in group:
+                if f is not keep:
+                    logging.warning(f"Skipping {f.name} in {path}, it would be uploaded as {keep.name}")
+                    skipped.add(f)
+    if not skipped:
+        return files
+    return [f for f in files if f not in skipped]
+
 def error_callback(error):
     logging.error("Job returned error: %r", error)
 
-def uploadFiles(node, files):
-    failCount = 0
-    for f in sorted(files):
-        try:
-            node.upload(f)
-            failCount = 0
-        except Exception as e: #pylint: disable=W0718
-            logging.exception("Failed to upload %r", e)
-            failCount += 1
-            if failCount >= 5:
-                logging.error("Too many failed uploads, giving up.")
-                raise
+def scanRoutedFiles(path: Path, parent, router):
+
+    albums = {}
+    for albumName, files in router.route(path, supportedFileFormat).items():
+        node = parent.getChildrenByName(albumName) if parent else None
+        if node and not node.isAlbum():
+            logging.warning(f"Ignoring {albumName} in {path}, a folder with the same name exists")
+            continue
+        files = dropAliasCollisions(path / albumName, files)
+        newFiles = [f for f in files if not node or not node.hasImage(f)]
+        if newFiles:
+            albums[albumName] = newFiles
 
-def scanNewFiles(path: Path, parent):
+    return albums or None
+
+def scanNewFiles(path: Path, parent, router=None):
 
     assert(path.is_dir())
 
-    filesToUpload = []
+    files = []
     folders = {}
 
     for p in path.iterdir():
         if p.is_dir():
             if not p.name.startswith("_") and (not parent or not parent.isAlbum()):
                 node = parent.getChildrenByName(p.name) if parent else None
-                contentInSubfolder = scanNewFiles(p, node)
+                if router and router.isRouted(p):
+                    contentInSubfolder = scanRoutedFiles(p, node, router)
+                else:
+                    contentInSubfolder = scanNewFiles(p, node, router)
                 if contentInSubfolder:
                     folders[p.name] = contentInSubfolder
-        elif supportedFileFormat(p) and (not parent or not parent.hasImage(p)):
-            filesToUpload.append(p)
+        elif supportedFileFormat(p):
+            files.append(p)
+
+    filesToUpload = [f for f in dropAliasCollisions(path, files) if not parent or not parent.hasImage(f)]
 
     if filesToUpload and folders:
         raise f"Found files and folders in {path}"
@@ -76,6 +185,120 @@ def scanNewFiles(path: Path, parent):
     else:
         return None
 
+def iterNewFiles(path: Path, parent, router=None, names=()):
+    # Like scanNewFiles, but yields the new files of every album as soon as
+    # the album's directory has been scanned: (album path names, files).
+
+    files = []
+    hasFolders = False
+
+    for p in path.iterdir():
+        if p.is_dir():
+            if not p.name.startswith("_") and (not parent or not parent.isAlbum()):
+                node = parent.getChildrenByName(p.name) if parent else None
+                if router and router.isRouted(p):
+                    subChanges = ((names + (p.name, albumName), routedFiles)
+                        for albumName, routedFiles in (scanRoutedFiles(p, node, router) or {}).items())
+                else:
+                    subChanges = iterNewFiles(p, node, router, names + (p.name,))
+                # Like in scanNewFiles, only folders with changes count
+                for change in subChanges:
+                    hasFolders = True
+                    yield change
+        elif supportedFileFormat(p):
+            files.append(p)
+
+    filesToUpload = [f for f in dropAliasCollisions(path, files) if not parent or not parent.hasImage(f)]
+
+    if filesToUpload and hasFolders:
+        raise SmugMugException(-1, f"Found files and folders in {path}")
+
+    if filesToUpload:
+        yield names, filesToUpload
+
+def checkSubpath(path: Path, subPath):
+    parts = Path(subPath).parts
+    if Path(subPath).is_absolute() or ".." in parts:
+        raise ValueError(f"Expected a path relative to the gallery: {subPath}")
+    if not path.joinpath(*parts).is_dir():
+        raise ValueError(f"Directory not found: {subPath}")
+    return parts
+
+def normalizeSubpaths(subPaths):
+    # Drops duplicates and subpaths within other subpaths.
+    result = []
+    for parts in sorted(set(Path(p).parts for p in subPaths)):
+        if not any(parts[:len(other)] == other for other in result):
+            result.append(parts)
+    return [Path(*parts).as_posix() if parts else "." for parts in result]
+
+def findSubpath(path: Path, root, subPath, router=None):
+    # Returns the names, local directory and cached remote node (None if
+    # not known yet) to scan for subPath, and if the directory is routed.
+    # Routed directories are scanned as a whole. Returns None for
+    # directories within albums, which are ignored.
+
+    parts = checkSubpath(path, subPath)
+    node = root
+    for i, name in enumerate(parts):
+        if node and node.isAlbum():
+            return None
+        path = path / name
+        node = node.getChildrenByName(name) if node else None
+        if router and router.isRouted(path):
+            return parts[:i + 1], path, node, True
+    return parts, path, node, False
+
+def mergeChanges(changes, other):
+    if not changes or not other:
+        return changes or other
+    merged = dict(changes)
+    for name, subItems in other.items():
+        merged[name] = mergeChanges(merged.get(name), subItems)
+    return merged
+
+def scanSubpaths(path: Path, root, subPaths, router=None):
+    # Like scanNewFiles, but only scans the given directories of the gallery.
+    # The changes are returned relative to the root, so missing folders and
+    # albums above them are created as usual.
+
+    changes = None
+    for subPath in normalizeSubpaths(subPaths):
+        found = findSubpath(path, root, subPath, router)
+        if not found:
+            continue
+        names, subDir, node, routed = found
+        subChanges = scanRoutedFiles(subDir, node, router) if routed else scanNewFiles(subDir, node, router)
+        for name in reversed(names):
+            if not subChanges:
+                break
+            subChanges = {name: subChanges}
+        changes = mergeChanges(changes, subChanges)
+    return changes
+
+def iterSubpathFiles(path: Path, root, subPaths, router=None):
+    # Like iterNewFiles for the given directories of the gallery.
+    for subPath in normalizeSubpaths(subPaths):
+        found = findSubpath(path, root, subPath, router)
+        if not found:
+            continue
+        names, subDir, node, routed = found
+        if routed:
+            for albumName, files in (scanRoutedFiles(subDir, node, router) or {}).items():
+                yield names + (albumName,), files
+        else:
+            yield from iterNewFiles(subDir, node, router, names)
+
+def scanChanges(path: Path, root, router=None, subPaths=None):
+    if subPaths:
+        return scanSubpaths(path, root, subPaths, router)
+    return scanNewFiles(path, root, router)
+
+def iterChanges(path: Path, root, router=None, subPaths=None):
+    if subPaths:
+        return iterSubpathFiles(path, root, subPaths, router)
+    return iterNewFiles(path, root, router)
+
 def refreshPattern(parent, pattern):
 
     if parent.getName() == pattern:
@@ -93,54 +316,247 @@ def refreshPattern(parent, pattern):
         for childToDel in childrenToDelete:
             parent.getChildren().remove(childToDel)
                     
-def refreshFromRemote(changes, parent):
+def refreshFromRemote(changes, parent, reload=True):
+    # Reloads the folders and albums with pending files and returns the
+    # changes still missing on remote, without walking the local tree again.
+    # Without reload, only the already known remote images are checked.
 
     if isinstance(changes, dict):
 
-        parent.reload(incremental=True)
+        if reload:
+            parent.reload(incremental=True)
 
+        remaining = {}
         for name, subItems in changes.items():
             node = parent.getChildrenByName(name)
             if node:
-                refreshFromRemote(subItems, node)
+                subItems = refreshFromRemote(subItems, node, reload)
+            if subItems:
+                remaining[name] = subItems
+        return remaining or None
 
     elif isinstance(changes, list):
 
-        parent.reload()
+        if reload:
+            parent.reload()
+        return [f for f in changes if not parent.hasImage(f)] or None
+
+    return None
+
+def refreshTree(parent):
+    # Reloads all known folders, and the images of the albums whose
+    # ImagesLastUpdated changed. New folders and albums are loaded completely.
+    known = set(id(child) for child in parent.getChildren())
+    stamps = dict((id(child), child.getImagesLastUpdated()) for child in parent.getChildren() if child.isAlbum())
+    parent.reload(incremental=True)
+
+    for child in parent.getChildren():
+        if id(child) not in known:
+            continue
+        if not child.isAlbum():
+            refreshTree(child)
+        elif not child.getImagesLastUpdated() or child.getImagesLastUpdated() != stamps[id(child)]:
+            child.reload()
+
+def verifyRemote(root):
+    # With ChangeDetection the image count of the account and the
+    # modification time of the root folder are stored with the content while
+    # the content is known to match the remote. The count changes with new
+    # and deleted images, the timestamp with other changes of the folders.
+    # If both are unchanged at the start of a run, the content is used
+    # without refreshing; otherwise the whole tree is checked once. Returns
+    # None if the content was not verified by this call, otherwise whether it
+    # was refreshed (and needs to be scanned again).
+    api = root.getApi()
+    if not api or not api.changeDetection or api.verifiedImageCount is not None:
+        return None
+
+    imageCount = api.getImageCount()
+    refreshed = (imageCount != root.getVerifiedImageCount()
+        or api.getDateModified() != root.getVerifiedDateModified())
+    if refreshed:
+        logging.info("Remote changed since the last run, checking all folders and albums")
+        refreshTree(root)
+    else:
+        logging.info("No changes on remote since the last run")
+    api.verifiedImageCount = imageCount
+    return refreshed
+
+def recordImageCount(root, api):
+    # Stores the image count and the modification time with the content if
+    # the count only changed by the uploads and deletes of this client since
+    # it was verified.
+    if not api.changeDetection or not api.isConnected():
+        return
+
+    base = api.verifiedImageCount
+    if base is None:
+        base = root.getVerifiedImageCount()
+    imageCount = None
+    dateModified = None
+    if base is not None and api.imageDelta is not None:
+        try:
+            imageCount = api.getImageCount()
+            dateModified = api.getDateModified()
+        except (SmugMugException, OSError) as e:
+            logging.warning(f"Failed to get the image count: {e}")
+            imageCount = None
+        if imageCount is not None and imageCount != base + api.imageDelta:
+            logging.debug(f"Image count {imageCount} differs from {base} {api.imageDelta:+d}")
+            imageCount = None
 
-def uploadChanges(path: Path, changes, parent):
+    root.setVerifiedImageCount(imageCount, dateModified)
+    api.verifiedImageCount = None
+    api.imageDelta = 0
+
+def adoptNode(parent, name, changes, renames, ledger=None):
+    if not ledger:
+        return renames.adopt(name, changes, parent)
+    # Another worker may have adopted a node for the same directory.
+    with ledger.lock("renames"):
+        parent.reload(incremental=True)
+        node = parent.getChildrenByName(name)
+        if node:
+            return node
+        return renames.adopt(name, changes, parent)
+
+def createNode(parent, name, isAlbum, ledger=None, key=None):
+    if ledger:
+        # Another worker may have created it since the last refresh.
+        with ledger.lock("create:" + key):
+            parent.reload(incremental=True)
+            node = parent.getChildrenByName(name)
+            if node:
+                return node
+            return createNode(parent, name, isAlbum)
+
+    if isAlbum:
+        return parent.createAlbum(name)
+    return parent.createFolder(name)
+
+def scheduleChanges(path: Path, changes, parent, scheduler, renames=None, ledger=None):
 
     if isinstance(changes, dict):
         for name, subItems in changes.items():
             subPath = path / name
+            if ledger and isinstance(subItems, list) and ledger.leasedByOther(subPath):
+                continue
             node = parent.getChildrenByName(name)
+            if not node and renames:
+                node = adoptNode(parent, name, subItems, renames, ledger)
             if not node:
-                if isinstance(subItems, dict):
-                    node = parent.createFolder(name)
-                else:
-                    node = parent.createAlbum(name)
-            uploadChanges(subPath, subItems, node)
+                node = createNode(parent, name, isinstance(subItems, list), ledger, ledger and ledger.key(subPath))
+            scheduleChanges(subPath, subItems, node, scheduler, renames, ledger)
 
     elif isinstance(changes, list):
-        logging.info(f"Uploading {len(changes)} files into {parent.getName()}")
-        uploadFiles(parent, changes)
+        # Renamed albums already contain most of the files.
+        changes = [f for f in changes if not parent.hasImage(f)]
+        if changes:
+            logging.info(f"Queueing {len(changes)} files for {parent.getName()}")
+            # With a ledger the album is leased when its first upload starts
+            scheduler.add(parent, changes, lease=ledger and ledger.albumLease(path, parent))
+
+def uploadChanges(path: Path, changes, parent, scheduler=None, renames=None, ledger=None):
+
+    if not scheduler:
+        scheduler = UploadScheduler()
+
+    scheduleChanges(path, changes, parent, scheduler, renames, ledger)
+    scheduler.run()
 
-def upload(path: Path, root):
+def upload(path: Path, root, scheduler=None, router=None, renames=None, ledger=None, subPaths=None):
 
     logging.info("Scanning for new files to upload")
 
-    for _ in range(3):
+    changes = scanChanges(path, root, router, subPaths)
+    verified = verifyRemote(root) if changes else None
+    if verified:
+        # Files deleted on remote are new again
+        changes = scanChanges(path, root, router, subPaths)
 
-        changes = scanNewFiles(path, root)
+    # Retries only refresh the albums with files still missing.
+    for attempt in range(3):
 
         if changes:
-            refreshFromRemote(changes, root)
-            changes = scanNewFiles(path, root)
-            uploadChanges(path, changes, root)
+            changes = refreshFromRemote(changes, root, reload=attempt > 0 or verified is None)
+        if changes:
+            uploadChanges(path, changes, root, scheduler, renames, ledger)
+            changes = refreshFromRemote(changes, root, reload=False)
         else:
             logging.info("All in sync")
             break
 
+def resolveAlbum(path: Path, root, names, files, refreshed, renames=None, ledger=None, verified=False):
+    # Finds or creates the album for the given path. Folders are refreshed
+    # from remote once per run, the album itself just before uploading,
+    # unless the whole content was verified. Returns None if the album is
+    # leased by another worker.
+
+    if ledger and ledger.leasedByOther(path.joinpath(*names)):
+        return None
+
+    parent = root
+    for i, name in enumerate(names):
+        isAlbum = i == len(names) - 1
+        node = parent.getChildrenByName(name)
+        if not node and not verified and parent not in refreshed:
+            parent.reload(incremental=True)
+            refreshed.add(parent)
+            node = parent.getChildrenByName(name)
+
+        if node and isAlbum and not verified and node not in refreshed:
+            try:
+                node.reload()
+                refreshed.add(node)
+            except SmugMugException as e:
+                if e.errCode != 404:
+                    raise
+                parent.getChildren().remove(node)
+                node = None
+
+        if not node and isAlbum and renames:
+            node = adoptNode(parent, name, files, renames, ledger)
+        if not node:
+            node = createNode(parent, name, isAlbum, ledger, "/".join(names[:i + 1]))
+            refreshed.add(node)
+        parent = node
+
+    return parent
+
+def pipelinedUpload(path: Path, root, scheduler, router=None, renames=None, ledger=None, subPaths=None):
+
+    logging.info("Scanning and uploading new files")
+
+    refreshed = set()
+    scheduler.start()
+    try:
+        newFiles = iterChanges(path, root, router, subPaths)
+        first = next(newFiles, None)
+        verified = verifyRemote(root) if first else None
+        if verified:
+            # Files deleted on remote are new again
+            newFiles = iterChanges(path, root, router, subPaths)
+        elif first:
+            newFiles = itertools.chain([first], newFiles)
+        for names, files in newFiles:
+            if not names:
+                raise SmugMugException(-1, f"Found files in {path}, expected folders and albums only")
+            album = resolveAlbum(path, root, names, files, refreshed, renames, ledger, verified is not None)
+            if not album:
+                continue
+            files = [f for f in files if not album.hasImage(f)]
+            if files:
+                logging.info(f"Queueing {len(files)} files for {album.getName()}")
+                scheduler.submit(album, files, ledger and ledger.albumLease(path.joinpath(*names), album))
+    finally:
+        scheduler.finish()
+
+    if scheduler.failedCount:
+        # Retry failed uploads
+        upload(path, root, scheduler, router, renames, ledger, subPaths)
+    else:
+        logging.info("All in sync")
+
 def printChanges(path: Path, changes):
     if isinstance(changes, dict):
         for name, subItems in changes.items():
@@ -150,59 +566,362 @@ def printChanges(path: Path, changes):
     elif isinstance(changes, list):
         logging.info(f"Missing {len(changes)} files in {path}")
 
-def scan(path: Path, root):
+# Requests needed per uploaded file: the upload and the check of the
+# resulting filename.
+RequestsPerUpload = 2
+
+def planChanges(path: Path, changes, parent, plan):
+
+    if isinstance(changes, dict):
+        for name, subItems in changes.items():
+            subPath = path / name
+            node = parent.getChildrenByName(name) if parent else None
+            if not node:
+                if isinstance(subItems, dict):
+                    plan["createFolders"].append(subPath.as_posix())
+                else:
+                    plan["createAlbums"].append(subPath.as_posix())
+            planChanges(subPath, subItems, node, plan)
+
+    elif isinstance(changes, list):
+        plan["albums"].append({
+            "path": path.as_posix(),
+            "files": len(changes),
+            "bytes": sum(f.stat().st_size for f in changes),
+            "exists": parent is not None
+        })
+
+def createPlan(changes, root, stats):
+
+    plan = {"albums": [], "createFolders": [], "createAlbums": []}
+    if changes:
+        planChanges(Path(), changes, root, plan)
+
+    plan["files"] = sum(a["files"] for a in plan["albums"])
+    plan["bytes"] = sum(a["bytes"] for a in plan["albums"])
+    plan["requests"] = (len(plan["createFolders"]) + len(plan["createAlbums"]) +
+        RequestsPerUpload * plan["files"])
+
+    plan["bytesPerSecond"] = stats.get("bytesPerSecond")
+    if plan["bytesPerSecond"]:
+        plan["estimatedSeconds"] = plan["bytes"] / plan["bytesPerSecond"]
+    else:
+        plan["estimatedSeconds"] = None
+
+    return plan
+
+def printPlan(plan):
+    if plan["estimatedSeconds"] is not None:
+        estimate = formatDuration(plan["estimatedSeconds"])
+    else:
+        estimate = "unknown"
+    logging.info("Plan: upload %d files (%s), create %d folders and %d albums, ~%d requests, estimated time %s",
+        plan["files"], sizeFormat(plan["bytes"]),
+        len(plan["createFolders"]), len(plan["createAlbums"]),
+        plan["requests"], estimate)
+
+def scan(path: Path, root, router=None, subPaths=None):
 
     logging.info("Scanning for new files")
 
-    changes = scanNewFiles(path, root)
+    changes = scanChanges(path, root, router, subPaths)
+    verified = verifyRemote(root) if changes else None
+    if verified:
+        changes = scanChanges(path, root, router, subPaths)
     if changes:
-        refreshFromRemote(changes, root)
-        changes = scanNewFiles(path, root)
+        changes = refreshFromRemote(changes, root, reload=verified is None)
 
     if changes:
         printChanges(Path(), changes)
     else:
         logging.info("All in sync")
 
-def scanRemoteRecursive(path, parent):
-    if not parent.isAlbum():
-        for c in parent.getChildren():
-            subPath = path / c.getName()
-            if subPath.exists():
-                scanRemoteRecursive(subPath, c)
-            else:
-                logging.error("Ignoring folder not found on disk: %r", subPath)
+    plan = createPlan(changes, root, loadStats(path))
+    if changes:
+        printPlan(plan)
+    return plan
+
+def writePlan(planFile, plan):
+    if planFile == "-":
+        print(json.dumps(plan, indent=2))
     else:
-        seenSet = set()
-        delList = []
-        for p in parent.getImages():
-            imgPath = path / p.getFileName()
-            if not imgPath.exists():
-                logging.info("Delete missing  : %s", imgPath)
-                delList.append(p)
-            elif imgPath in seenSet:
-                logging.info("Delete duplicate: %s", imgPath)
-                delList.append(p)
+        with open(planFile, "w", encoding="utf-8") as fp:
+            json.dump(plan, fp, indent=2)
+
+def listLocalFiles(path: Path):
+    # One directory listing per album instead of a stat per remote image.
+    return [p for p in path.iterdir() if supportedFileFormat(p)]
+
+def planRemoteDeletes(albumPath: Path, album, localNames, deletions):
+
+    album.reload()
+
+    seenSet = set()
+    delList = []
+    for img in album.getImages():
+        name = img.getNormalizedName()
+        if name not in localNames:
+            logging.info("Delete missing  : %s", albumPath / img.getFileName())
+            delList.append(img)
+        elif name in seenSet:
+            logging.info("Delete duplicate: %s", albumPath / img.getFileName())
+            delList.append(img)
+        else:
+            seenSet.add(name)
+
+    if delList:
+        deletions.append((album, delList))
+
+def walkRemoteAlbums(path, parent, router=None):
+    # Yields (local path, album, local files) for all remote albums with a
+    # local counterpart.
+
+    parent.reload(incremental=True)
+
+    routedAlbums = None
+    if router and router.isRouted(path):
+        routedAlbums = router.route(path, supportedFileFormat)
+
+    for c in parent.getChildren():
+        subPath = path / c.getName()
+        if routedAlbums is not None:
+            if c.isAlbum() and c.getName() in routedAlbums:
+                yield subPath, c, routedAlbums[c.getName()]
             else:
-                seenSet.add(imgPath)
+                logging.error("Ignoring album not found on disk: %r", subPath)
+        elif not subPath.is_dir():
+            logging.error("Ignoring folder not found on disk: %r", subPath)
+        elif c.isAlbum():
+            yield subPath, c, listLocalFiles(subPath)
+        else:
+            yield from walkRemoteAlbums(subPath, c, router)
+
+def syncRemote(path: Path, root, workers=4, confirmed=False, router=None):
+
+    logging.info("Scanning for remote images missing locally")
+
+    deletions = []
+    for albumPath, album, files in walkRemoteAlbums(path, root, router):
+        planRemoteDeletes(albumPath, album, set(normalizeName(f.name) for f in files), deletions)
+
+    total = sum(len(delList) for _, delList in deletions)
+    if not total:
+        logging.info("Nothing to delete")
+        return
+
+    if not confirmed:
+        logging.info("Delete %d images in %d albums? [y/n]", total, len(deletions))
+        if input() != "y":
+            logging.info("Skipping")
+            return
+
+    deleted = 0
+    for album, delList in deletions:
+        deleted += len(album.deleteImages(delList, workers))
+
+    logging.info("Deleted %d of %d images", deleted, total)
+
+def verify(path: Path, root, scheduler, fileCache, workers=1, router=None, transcoder=None):
 
-        if delList:
-            logging.info("Delete %d images in %s? [y/n]", len(delList), parent.getName())
-            if input() != "y":
-                logging.info("Skipping")
+    logging.info("Verifying uploaded files")
+
+    # Sizes are compared first, only files of the same size are hashed.
+    mismatches = []
+    toHash = []
+    for albumPath, album, files in walkRemoteAlbums(path, root, router):
+        remote = {}
+        for detail in album.getArchivedDetails():
+            remote.setdefault(normalizeName(detail["FileName"]), detail)
+
+        for f in files:
+            # Transcoded files can't be compared with the uploaded file
+            if transcoder and transcoder.handles(f):
+                continue
+            detail = remote.get(normalizeName(f.name))
+            if not detail or not detail.get("ArchivedMD5"):
+                continue
+            if detail.get("ArchivedSize") not in (None, f.stat().st_size):
+                mismatches.append((albumPath, album, f, detail))
             else:
-                for i in delList:
-                    parent.deleteImage(i)
-                parent.reload()
+                toHash.append((albumPath, album, f, detail))
 
-def main(args):
+    hashes = md5Files([f for _, _, f, _ in toHash], fileCache, workers)
+    for albumPath, album, f, detail in toHash:
+        if hashes[f] != detail["ArchivedMD5"]:
+            mismatches.append((albumPath, album, f, detail))
+
+    logging.info(f"Verified {len(toHash) + len(mismatches)} files, {len(mismatches)} differ from Smugmug")
+    if not mismatches:
+        return
+
+    replaces = {}
+    for albumPath, album, f, detail in mismatches:
+        logging.warning("Mismatch: %s", albumPath / f.name)
+        replaces.setdefault(album, {})[f] = detail["Uri"]
+
+    for album, albumReplaces in replaces.items():
+        scheduler.add(album, list(albumReplaces), albumReplaces)
+    scheduler.run()
+
+# Keeps the remote tree, the HTTP sessions and the caches of one gallery in
+# memory between syncs. Syncs requested through the control API are run
+# one after another by a worker thread.
+class SyncService:
+
+    def __init__(self, path: Path, root, config, fileCache, router=None, transcoder=None, ledger=None, saveCaches=None):
+        self.path = path
+        self.root = root
+        self.config = config
+        self.fileCache = fileCache
+        self.router = router
+        self.transcoder = transcoder
+        self.ledger = ledger
+        self.saveCaches = saveCaches
+        self._lock = threading.Lock()
+        self._requests = []
+        self._wakeup = threading.Condition(self._lock)
+        self._current = None
+        self._scheduler = None
+        self._paused = False
+        self._stopped = False
+        self._lastSync = None
+        self.onStop = None
+        self._worker = threading.Thread(target=self._work, daemon=True)
+        self._worker.start()
+
+    def sync(self, subPath):
+        subPath = Path(subPath).as_posix()
+        checkSubpath(self.path, subPath)
+        with self._lock:
+            if self._stopped:
+                raise ValueError("Stopping")
+            if subPath not in self._requests:
+                self._requests.append(subPath)
+                self._wakeup.notify()
+            return {"queued": list(self._requests)}
+
+    def pause(self):
+        with self._lock:
+            self._paused = True
+            if self._scheduler:
+                self._scheduler.pause()
+        logging.info("Uploads paused")
+        return self.status()
+
+    def resume(self):
+        with self._lock:
+            self._paused = False
+            if self._scheduler:
+                self._scheduler.resume()
+        logging.info("Uploads resumed")
+        return self.status()
+
+    def stop(self):
+        # Queued syncs are dropped, a running one is finished.
+        with self._lock:
+            self._stopped = True
+            self._requests = []
+            self._wakeup.notify()
+        self.resume()
+        if self.onStop:
+            # Called from a request of the control server, which it stops
+            threading.Thread(target=self.onStop, daemon=True).start()
+        return {"stopping": True}
+
+    def join(self):
+        self._worker.join()
 
-    imageDir = Path(args.imagePath)
+    def status(self):
+        with self._lock:
+            scheduler = self._scheduler
+            status = {
+                "state": "paused" if self._paused else "syncing" if self._current else "idle",
+                "current": self._current,
+                "queued": list(self._requests),
+                "lastSync": self._lastSync,
+            }
+        progress = scheduler.progress if scheduler else None
+        status.update({
+            "queueDepth": scheduler.pending() if scheduler else 0,
+            "totalFiles": progress.totalFiles if progress else 0,
+            "uploadedFiles": progress.doneFiles if progress else 0,
+            "totalBytes": progress.totalBytes if progress else 0,
+            "uploadedBytes": progress.doneBytes if progress else 0,
+            "bytesPerSecond": progress.rate() if progress else 0.0,
+            "eta": progress.eta() if progress else None,
+        })
+        return status
+
+    def _work(self):
+        while True:
+            with self._lock:
+                while not self._requests and not self._stopped:
+                    self._wakeup.wait()
+                if self._stopped:
+                    return
+                subPath = self._requests.pop(0)
+                self._current = subPath
+                self._scheduler = UploadScheduler.fromConfig(self.config, self.fileCache, self.transcoder)
+                if self._paused:
+                    self._scheduler.pause()
+
+            startTime = time.time()
+            error = None
+            try:
+                self._sync(subPath, self._scheduler)
+            except Exception as e: #pylint: disable=W0718
+                logging.exception("Sync of %s failed", subPath)
+                error = repr(e)
+
+            with self._lock:
+                self._current = None
+                self._lastSync = {"path": subPath,
+                    "finished": datetime.datetime.now().isoformat(timespec="seconds"),
+                    "duration": round(time.time() - startTime, 3),
+                    "error": error}
+
+    def _sync(self, subPath, scheduler):
+        logging.info(f"Syncing {self.path / subPath}")
+        if self.router:
+            self.router.reset()
+
+        renames = None
+        renameConfig = self.config.get("Rename", {})
+        if renameConfig.get("Enabled", False):
+            renames = RenameDetector(self.path, self.root, self.router, renameConfig.get("MinSimilarity", 0.8), self.fileCache)
+
+        try:
+            upload(self.path, self.root, scheduler, self.router, renames, self.ledger, [subPath])
+        finally:
+            if self.ledger:
+                self.ledger.releaseAll()
+            recordThroughput(self.path, scheduler.progress)
+            if self.saveCaches:
+                self.saveCaches()
+
+def serve(path: Path, root, config, fileCache, listen, router=None, transcoder=None, ledger=None, saveCaches=None):
+    from lib.control import createServer
+
+    service = SyncService(path, root, config, fileCache, router, transcoder, ledger, saveCaches)
+    server = createServer(service, listen)
+    service.onStop = server.shutdown
+
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        logging.info("Stopping")
+        service.onStop = None
+        service.stop()
+    finally:
+        server.server_close()
+        service.join()
+
+def setupLogging(logDir, debug):
 
     logHandlers = []
-    if args.debug:
+    if debug:
         fileHandler = logging.FileHandler(
-            filename=imageDir / ("smugler_%s.log" % datetime.datetime.fromtimestamp(time.time()).strftime('%Y_%m_%d_%H.%M.%S')),
+            filename=logDir / ("smugler_%s.log" % datetime.datetime.fromtimestamp(time.time()).strftime('%Y_%m_%d_%H.%M.%S')),
             mode='w')
         fileHandler.setLevel(logging.DEBUG)
         logHandlers.append(fileHandler)
@@ -211,53 +930,269 @@ def main(args):
     consoleHandler.setLevel(logging.INFO)
     logHandlers.append(consoleHandler)
 
-    logging.basicConfig(level= logging.DEBUG if args.debug else logging.INFO,
+    logging.basicConfig(level= logging.DEBUG if debug else logging.INFO,
                         format="%(asctime)s [%(levelname)s] %(message)s",
                         handlers=logHandlers)
 
-    logging.debug('Started')
+def loadConfig(imageDir):
+    import yaml
 
-    configLocations = [
-        Path("smuglerconf.yaml"),
-        imageDir / "smuglerconf.yaml",
-        Path.home() / "smuglerconf.yaml"]
+    configLocations = [Path("smuglerconf.yaml")]
+    if imageDir:
+        configLocations.append(imageDir / "smuglerconf.yaml")
+    configLocations.append(Path.home() / "smuglerconf.yaml")
 
     for cl in configLocations:
         if cl.exists():
             with cl.open("r", encoding="utf-8") as fp:
-                config = yaml.safe_load(fp)
-            break
-    else:
-        logging.error("Config file not found")
+                return yaml.safe_load(fp)
+
+    logging.error("Config file not found")
+    exit(-1)
+
+def getJobs(args, config):
+
+    if args.imagePath:
+        imageDir = Path(args.imagePath)
+        return [(imageDir, imageDir / ".smugmugToken", config)]
+
+    if not config.get("Jobs"):
+        logging.error("No imagePath given and no Jobs configured")
         exit(-1)
 
-    SmugMug(imageDir / ".smugmugToken", config)
+    jobs = []
+    for job in config["Jobs"]:
+        imageDir = Path(job["imagePath"])
+        tokenFile = Path(job["tokenFile"]) if "tokenFile" in job else imageDir / ".smugmugToken"
+        jobConfig = dict(config)
+        del jobConfig["Jobs"]
+        for section in ("SmugMugApi", "Album", "Folder", "LocalBackend"):
+            if section in job:
+                jobConfig[section] = dict(config.get(section, {}), **job[section])
+        jobs.append((imageDir, tokenFile, jobConfig))
+    return jobs
+
+def runJob(args, imageDir, tokenFile, config, pools=None, uploadSlots=None):
+
+    responseCache = None
+    cacheConfig = config.get("HttpCache", {})
+    if cacheConfig.get("Enabled") and args.backend == "smugmug":
+        from lib.httpcache import ResponseCache
+        responseCache = ResponseCache(imageDir / ".smugmugHttpCache", cacheConfig.get("MaxMB", 64) * 1024 * 1024)
+
+    albumCache = None
+    memoryConfig = config.get("Memory", {})
+    if memoryConfig.get("MaxMB"):
+        from lib.albumcache import AlbumCache
+        albumCache = AlbumCache(memoryConfig["MaxMB"] * 1024 * 1024)
+
+    if args.backend == "local":
+        from lib.localbackend import LocalBackend
+        api = LocalBackend(Path(config["LocalBackend"]["Path"]), config, albumCache=albumCache)
+    else:
+        api = SmugMug(tokenFile, config, pools=pools, uploadSlots=uploadSlots,
+            responseCache=responseCache, albumCache=albumCache)
+
+    ledger = None
+    if args.ledger:
+        from lib.ledger import Ledger
+        ledger = Ledger(Path(args.ledger), imageDir, args.worker,
+            config.get("Ledger", {}).get("LeaseSeconds", 600))
+
+    fileCache = FileInfoCache(imageDir / ".smugmugFileInfo")
+
+    # Registers the extension aliases, which are needed to load the content.
+    transcoder = None
+    if config.get("Transcode"):
+        from lib.transcode import Transcoder
+        transcoder = Transcoder(imageDir, config["Transcode"], fileCache)
+    else:
+        setExtensionAliases({})
+
+    rootFolder = loadContentFromFile(imageDir, api.contentName)
+    if rootFolder:
+        rootFolder.setApi(api)
+        # Content caches of an older version are saved as snapshot
+        from lib import snapshot
+        api.contentDirty = not snapshot.isSnapshot(getContentFilePath(imageDir, api.contentName))
+    else:
+        rootFolder = Folder(api, lazy=True)
+
+    router = None
+    if config.get("DateRouting"):
+        router = DateRouter(imageDir, config["DateRouting"], fileCache)
+
+    logging.debug("Startup finished after %.3fs", time.perf_counter() - StartTime)
 
-    rootFolder = loadContentFromFile(imageDir)
-    if not rootFolder:
-        rootFolder = Folder(lazy=True)
-    
     if args.refresh == "*":
-        rootFolder = Folder(lazy=False)
+        rootFolder = Folder(api, lazy=False)
+        api.verifiedImageCount = api.imageCount
     elif args.refresh:
         refreshPattern(rootFolder, args.refresh)        
 
+    def saveCaches():
+        # The caches are shared by all workers of a ledger.
+        with ledger.lock("caches") if ledger else contextlib.nullcontext():
+            recordImageCount(rootFolder, api)
+            # Saving reads all albums, which is skipped if nothing changed
+            if api.contentDirty:
+                content = rootFolder
+                if ledger:
+                    # Other workers saved the albums they uploaded to since
+                    saved = loadContentFromFile(imageDir, api.contentName)
+                    if saved:
+                        saved.setApi(api)
+                        content = mergeContent(saved, rootFolder, ledger.leasedKeys())
+                saveContentToFile(imageDir, content, config.get("Snapshot", {}).get("Compress", False), api.contentName)
+                api.contentDirty = False
+            fileCache.save(merge=ledger is not None)
+
+    result = None
     try:
         if args.action == "sync":
-            upload(imageDir, rootFolder)
+            scheduler = UploadScheduler.fromConfig(config, fileCache, transcoder)
+            renames = None
+            renameConfig = config.get("Rename", {})
+            if renameConfig.get("Enabled", False):
+                renames = RenameDetector(imageDir, rootFolder, router, renameConfig.get("MinSimilarity", 0.8), fileCache)
+            try:
+                if args.pipeline:
+                    pipelinedUpload(imageDir, rootFolder, scheduler, router, renames, ledger, args.subpath)
+                else:
+                    upload(imageDir, rootFolder, scheduler, router, renames, ledger, args.subpath)
+            finally:
+                recordThroughput(imageDir, scheduler.progress)
         elif args.action == "scan":
-            scan(imageDir, rootFolder)
-        #elif args.action == "syncRemote":
-        #    scanRemoteRecursive(imageDir, rootFolder)
+            result = scan(imageDir, rootFolder, router, args.subpath)
+        elif args.action == "verify":
+            verify(imageDir, rootFolder,
+                UploadScheduler.fromConfig(config),
+                fileCache,
+                workers=config.get("Verify", {}).get("Workers") or os.cpu_count() or 1,
+                router=router,
+                transcoder=transcoder)
+        elif args.action == "syncRemote":
+            syncRemote(imageDir, rootFolder,
+                workers=config.get("Delete", {}).get("Workers", 4),
+                confirmed=args.yes,
+                router=router)
+        elif args.action == "serve":
+            serve(imageDir, rootFolder, config, fileCache,
+                listen=args.listen or config.get("Serve", {}).get("Listen", "127.0.0.1:8765"),
+                router=router,
+                transcoder=transcoder,
+                ledger=ledger,
+                saveCaches=saveCaches)
     finally:
-        saveContentToFile(imageDir, rootFolder)
+        saveCaches()
+        limiters = [l for l in (api.apiLimiter, uploadSlots) if isinstance(l, AdaptiveLimiter)]
+        if limiters:
+            recordConcurrency(imageDir, limiters)
+        if ledger:
+            ledger.close()
+        if transcoder:
+            transcoder.close()
+        if responseCache:
+            responseCache.close()
+        if albumCache:
+            albumCache.report()
+            albumCache.close()
+        if not pools:
+            api.close()
+
+    return result
+
+def main(args):
+
+    imageDir = Path(args.imagePath) if args.imagePath else None
+
+    setupLogging(imageDir or Path(), args.debug)
+
+    logging.debug('Started')
+
+    config = loadConfig(imageDir)
+    jobs = getJobs(args, config)
+
+    if args.ledger and len(jobs) > 1:
+        logging.error("A ledger can only be used with a single imagePath")
+        exit(-1)
+
+    if args.subpath:
+        if len(jobs) > 1:
+            logging.error("--subpath can only be used with a single imagePath")
+            exit(-1)
+        try:
+            for subPath in args.subpath:
+                checkSubpath(jobs[0][0], subPath)
+        except ValueError as e:
+            logging.error(str(e))
+            exit(-1)
+
+    if args.backend == "local":
+        for jobDir, _, jobConfig in jobs:
+            if not jobConfig.get("LocalBackend", {}).get("Path"):
+                logging.error(f"The local backend needs LocalBackend: Path for {jobDir}")
+                exit(-1)
+
+    if args.action == "serve" and len(jobs) > 1:
+        logging.error("serve can only run a single job")
+        exit(-1)
+
+    uploadWorkers = config.get("Upload", {}).get("Workers", 1)
+    if config.get("Adaptive", {}).get("Enabled"):
+        # The scheduler runs Upload: Workers threads, the limiter decides
+        # how many of them upload at the same time.
+        uploadSlots = AdaptiveLimiter.fromConfig("upload", uploadWorkers, config["Adaptive"])
+    else:
+        uploadSlots = threading.BoundedSemaphore(uploadWorkers)
+
+    if len(jobs) == 1:
+        result = runJob(args, *jobs[0], uploadSlots=uploadSlots)
+        if args.plan and result:
+            writePlan(args.plan, result)
+        return
+
+    # All jobs share the connection pools and one budget of concurrent uploads.
+    from lib.transport import ConnectionPools
+    pools = ConnectionPools(config.get("Connection"))
+
+    try:
+        with concurrent.futures.ThreadPoolExecutor(max_workers=len(jobs)) as executor:
+            futures = dict((executor.submit(runJob, args, *job, pools=pools, uploadSlots=uploadSlots), job[0])
+                for job in jobs)
+    finally:
+        pools.logStats()
+        pools.close()
+
+    failedJobs = []
+    plans = {}
+    for future, jobDir in futures.items():
+        if future.exception():
+            logging.error("Job for %s failed: %r", jobDir, future.exception())
+            failedJobs.append(future.exception())
+        elif future.result():
+            plans[str(jobDir)] = future.result()
+
+    if args.plan and plans:
+        writePlan(args.plan, plans)
+
+    if failedJobs:
+        raise failedJobs[0]
 
 if __name__ == "__main__":
 
     parser = argparse.ArgumentParser(description='Sync folder to Smugmug')
-    parser.add_argument('action', type=str, choices=["sync", "scan"], help='sync: Upload images to Smugmug. scan: Scan for changes, but don\'t upload.')
-    parser.add_argument('imagePath', type=str, help='Path to local gallery')
+    parser.add_argument('action', type=str, choices=["sync", "scan", "syncRemote", "verify", "serve"], help='sync: Upload images to Smugmug. scan: Scan for changes, but don\'t upload. syncRemote: Delete images from Smugmug which don\'t exist locally. verify: Compare uploaded images with the local files and upload them again if they differ. serve: Keep running and sync on requests of the control API.')
+    parser.add_argument('imagePath', type=str, nargs='?', help='Path to local gallery. If omitted, the Jobs from the config file are run.')
+    parser.add_argument('--backend', type=str, choices=["smugmug", "local"], default="smugmug", help='Sync to Smugmug, or to the local directory LocalBackend: Path of the config file.')
     parser.add_argument('--refresh', type=str, help='Refresh Folders/Albums with the given name from Smugmug. * for everything.')
+    parser.add_argument('--plan', type=str, help='scan: Write the upload plan as JSON to the given file (- for stdout).')
+    parser.add_argument('--subpath', type=str, action='append', help='sync, scan: Only sync/scan this directory, relative to imagePath. Can be given several times.')
+    parser.add_argument('--pipeline', action='store_true', help='sync: Start uploading while still scanning.')
+    parser.add_argument('--ledger', type=str, help='sync: Coordinate with other workers syncing the same imagePath through this SQLite file (on the shared filesystem).')
+    parser.add_argument('--worker', type=str, help='sync: Worker name in the ledger. Defaults to host name and process id.')
+    parser.add_argument('--listen', type=str, help='serve: host:port or Unix socket path of the control API. Defaults to Serve: Listen or 127.0.0.1:8765.')
+    parser.add_argument('--yes', action='store_true', help='syncRemote: Delete without asking for confirmation.')
     parser.add_argument('--debug', action='store_true', help='Print additional debug trace')
     parsedArgs = parser.parse_args()
 
@@ -269,4 +1204,3 @@ if __name__ == "__main__":
         cProfile.run('run()', sort='cumulative')
     else:
         run()
-
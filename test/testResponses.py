@@ -72,11 +72,15 @@ def postFolderResponse(folderName, path):
         "Message": "Created"
         }
 
-def albumItem(albumName, path):
+def imagesLastUpdated(images):
+    # Changes with the images of an album, like the real timestamp
+    return md5(",".join(sorted(images)).encode('utf-8')).hexdigest()
+
+def albumItem(albumName, path, images=None, imageCount=None):
 
     albumId = getItemId(albumName)
 
-    return {
+    item = {
             "NiceName": albumName,
             "UrlName": albumName,
             "Title": albumName,
@@ -137,26 +141,32 @@ def albumItem(albumName, path):
             },
             "ResponseLevel": "Full"
         }
+    if images is not None:
+        item["ImagesLastUpdated"] = imagesLastUpdated(images)
+    if imageCount is not None:
+        item["ImageCount"] = imageCount
+    return item
 
-def getAlbumsResponse(albums, path):
+def getAlbumsResponse(albums, path, images=None, imageCounts=None):
     return {
         "Response": {
             "Uri": f"/api/v2/folder/user/testuser/{path}!albums",
             "Locator": "Album",
             "LocatorType": "Objects",
-            "Album": [ albumItem(albumName, path) for albumName in albums ]
+            "Album": [ albumItem(albumName, path, images and images[albumName], imageCounts and imageCounts[albumName])
+                for albumName in albums ]
         },
         "Code": 200,
         "Message": "Ok"
         }
 
-def getAlbumResponse(albumName):
+def getAlbumResponse(albumName, images=None):
     return {
         "Response": {
             "Uri": f"/api/v2/folder/user/testuser/{getItemId(albumName)}",
             "Locator": "Album",
             "LocatorType": "Objects",
-            "Album": albumItem(albumName, "")
+            "Album": albumItem(albumName, "", images)
         },
         "Code": 200,
         "Message": "Ok"
@@ -175,7 +185,7 @@ def postAlbumResponse(albumName, path):
         }
 
 def imageItem(imageName):
-    #imageId = getItemId(imageName)
+    imageId = getItemId(imageName)
     return {
         "Title": imageName,
         #"Caption": "",
@@ -188,6 +198,7 @@ def imageItem(imageName):
         #"Hidden": false,
         #"ThumbnailUrl": f"https://photos.smugmug.com/photos/i-{imageId}/0/Th/i-{imageId}-Th.jpg",
         "FileName": imageName,
+        "Uri": f"/api/v2/image/{imageId}-0",
         #"Processing": false,
         #"UploadKey": "123",
         #"Date": "2020-01-01T00:00:00+00:00",
@@ -204,8 +215,9 @@ def imageItem(imageName):
         #"Watermarked": false,
         #"ImageKey": imageId,
         #"ArchivedUri": f"https://photos.smugmug.com/photos/i-{imageId}/0/D/i-{imageId}-D.jpg",
-        #"ArchivedSize": 12345,
-        #"ArchivedMD5": "aaa",
+        # Local test files contain their own name
+        "ArchivedSize": len(imageName.encode('utf-8')),
+        "ArchivedMD5": md5(imageName.encode('utf-8')).hexdigest(),
         #"CanShare": true,
         #"Comments": true,
         #"ShowKeywords": true,
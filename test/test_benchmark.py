@@ -0,0 +1,202 @@
+#!/usr/bin/python3
+#pylint: disable=C,R,W0621
+
+# Benchmarks of the local hot paths: scanning the gallery, membership tests
+# of remote albums and the content cache. They run on a synthetic gallery
+# with a matching remote tree, in which 1% of the files are missing. The
+# sync engine is measured with the local backend, without the network, and
+# the startup in a new process.
+#
+#   pip install pytest-benchmark
+#   python -m pytest test/test_benchmark.py --benchmark-autosave
+#   python -m pytest test/test_benchmark.py --benchmark-compare
+#
+# Saved runs are stored per commit in .benchmarks, --benchmark-compare
+# compares with the last one. SMUGLER_BENCH_FILES sets the number of files
+# (default 10000, up to 1000000).
+
+import os
+import sys
+import shutil
+import subprocess
+import tempfile
+import tracemalloc
+from pathlib import Path
+
+import pytest
+
+pytest.importorskip("pytest_benchmark")
+
+import smugler
+from lib.smugmugapi import Folder, Album, Image
+from lib.localbackend import LocalBackend
+from lib.scheduler import UploadScheduler
+
+FilesPerAlbum = 100
+AlbumsPerFolder = 10
+
+def fileCount():
+    return int(os.environ.get("SMUGLER_BENCH_FILES", 10000))
+
+def folderResp(name, path):
+    return {"Name": name, "UrlName": name, "Uri": f"/api/v2/folder/user/bench{path}/{name}",
+        "Uris": {"Folders": f"/api/v2/folder/user/bench{path}/{name}!folders",
+            "FolderAlbums": f"/api/v2/folder/user/bench{path}/{name}!albums"}}
+
+def albumResp(name, index):
+    return {"Name": name, "UrlName": name, "Uri": f"/api/v2/album/a{index}",
+        "Uris": {"AlbumImages": f"/api/v2/album/a{index}!images"}}
+
+class Gallery:
+
+    def __init__(self, files, missing=True):
+        self.path = Path(tempfile.mkdtemp())
+        self.files = []
+        self.missing = 0
+        self.root = Folder(None, folderResp("", ""), lazy=True)
+
+        albumCount = max(1, files // FilesPerAlbum)
+        folder = None
+        for a in range(albumCount):
+            if a % AlbumsPerFolder == 0:
+                folderName = "Folder%d" % (a // AlbumsPerFolder)
+                folderDir = self.path / folderName
+                folderDir.mkdir()
+                folder = Folder(None, folderResp(folderName, ""), lazy=True)
+                self.root.getChildren().append(folder)
+
+            albumName = "Album%d" % a
+            albumDir = folderDir / albumName
+            albumDir.mkdir()
+            album = Album(None, albumResp(albumName, a), lazy=True)
+            folder.getChildren().append(album)
+
+            images = album.getImages()
+            for i in range(FilesPerAlbum):
+                f = albumDir / ("IMG_%05d.jpg" % i)
+                f.touch()
+                self.files.append(f)
+                if missing and (a * FilesPerAlbum + i) % 100 == 99:
+                    self.missing += 1
+                else:
+                    images.append(Image({"FileName": f.name, "Uri": f"/api/v2/album/a{a}/image/i{i}-0"}))
+
+    def close(self):
+        shutil.rmtree(self.path)
+
+@pytest.fixture(scope="module")
+def gallery():
+    g = Gallery(fileCount())
+    yield g
+    g.close()
+
+@pytest.fixture(scope="module")
+def syncedGallery():
+    # Gallery without changes, with its content cache and a config
+    g = Gallery(fileCount(), missing=False)
+    smugler.saveContentToFile(g.path, g.root)
+    (g.path / "smuglerconf.yaml").write_text("{}\n", encoding="utf-8")
+    yield g
+    g.close()
+
+def peakMemory(fn):
+    tracemalloc.start()
+    try:
+        fn()
+        return tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+def countFiles(changes):
+    if isinstance(changes, dict):
+        return sum(countFiles(c) for c in changes.values())
+    return len(changes or [])
+
+def test_scanNewFiles(benchmark, gallery):
+    benchmark.extra_info["files"] = len(gallery.files)
+    benchmark.extra_info["peakMemory"] = peakMemory(lambda: smugler.scanNewFiles(gallery.path, gallery.root))
+
+    changes = benchmark.pedantic(smugler.scanNewFiles, args=(gallery.path, gallery.root), rounds=3)
+    assert countFiles(changes) == gallery.missing
+
+def test_supportedFileFormat(benchmark, gallery):
+    files = gallery.files[:10000]
+
+    def check():
+        return sum(1 for f in files if smugler.supportedFileFormat(f))
+
+    assert benchmark(check) == len(files)
+    benchmark.extra_info["checksPerSecond"] = len(files) / benchmark.stats.stats.mean
+
+def test_hasImage(benchmark, gallery):
+    albums = {}
+    for folder in gallery.root.getChildren():
+        for album in folder.getChildren():
+            albums[album.getName()] = album
+    lookups = [(albums[f.parent.name], f) for f in gallery.files[:100000]]
+
+    def lookup():
+        return sum(1 for album, f in lookups if album.hasImage(f))
+
+    assert benchmark(lookup) == len(lookups) - len(lookups) // 100
+    benchmark.extra_info["lookupsPerSecond"] = len(lookups) / benchmark.stats.stats.mean
+
+def test_saveContentToFile(benchmark, gallery, tmp_path):
+    benchmark.extra_info["peakMemory"] = peakMemory(lambda: smugler.saveContentToFile(tmp_path, gallery.root))
+    benchmark.pedantic(smugler.saveContentToFile, args=(tmp_path, gallery.root), rounds=3)
+    benchmark.extra_info["bytes"] = smugler.getContentFilePath(tmp_path).stat().st_size
+
+def test_loadContentFromFile(benchmark, gallery, tmp_path):
+    smugler.saveContentToFile(tmp_path, gallery.root)
+    benchmark.extra_info["peakMemory"] = peakMemory(lambda: smugler.loadContentFromFile(tmp_path))
+
+    root = benchmark.pedantic(smugler.loadContentFromFile, args=(tmp_path,), rounds=3)
+    assert len(root.getChildren()) == len(gallery.root.getChildren())
+
+def test_scanFromLoadedContent(benchmark, gallery, tmp_path):
+    # Startup of a run: load the content cache and scan the gallery
+    smugler.saveContentToFile(tmp_path, gallery.root)
+
+    def loadAndScan():
+        return smugler.scanNewFiles(gallery.path, smugler.loadContentFromFile(tmp_path))
+
+    benchmark.extra_info["peakMemory"] = peakMemory(loadAndScan)
+    changes = benchmark.pedantic(loadAndScan, rounds=3)
+    assert countFiles(changes) == gallery.missing
+
+def test_importSmugler(benchmark):
+    script = Path(smugler.__file__)
+    benchmark.pedantic(subprocess.run, args=([sys.executable, "-c", "import smugler"],),
+        kwargs={"cwd": script.parent, "check": True}, rounds=5)
+
+def test_scanWithoutChanges(benchmark, syncedGallery):
+    # A run which finds nothing to do, like a cron job
+    script = Path(smugler.__file__)
+
+    def run():
+        return subprocess.run([sys.executable, str(script), "scan", str(syncedGallery.path)],
+            cwd=syncedGallery.path, check=True, capture_output=True, text=True)
+
+    result = benchmark.pedantic(run, rounds=5)
+    assert "All in sync" in result.stderr
+    benchmark.extra_info["files"] = len(syncedGallery.files)
+
+def test_syncToLocalBackend(benchmark, tmp_path):
+    source = tmp_path / "gallery"
+    fileSize = 64 * 1024
+    for a in range(10):
+        albumDir = source / ("Folder%d" % (a // AlbumsPerFolder)) / ("Album%d" % a)
+        albumDir.mkdir(parents=True)
+        for i in range(FilesPerAlbum):
+            (albumDir / ("IMG_%05d.jpg" % i)).write_bytes(os.urandom(fileSize))
+    targets = iter(range(1000))
+
+    def newTarget():
+        backend = LocalBackend(tmp_path / ("target%d" % next(targets)), {})
+        return (source, Folder(backend, lazy=False), UploadScheduler(workers=4)), {}
+
+    benchmark.pedantic(smugler.upload, setup=newTarget, rounds=3)
+    files = 10 * FilesPerAlbum
+    benchmark.extra_info["files"] = files
+    benchmark.extra_info["filesPerSecond"] = files / benchmark.stats.stats.mean
+    benchmark.extra_info["bytesPerSecond"] = files * fileSize / benchmark.stats.stats.mean
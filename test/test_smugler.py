@@ -2,7 +2,17 @@
 #pylint: disable=C,R,W0201
 
 import os
+import sys
+import time
+import threading
+import socket
+import urllib.request
+import urllib.error
+import sqlite3
+import subprocess
 import tempfile
+import importlib
+import types
 import yaml
 import pickle
 from urllib.parse import parse_qs
@@ -11,16 +21,31 @@ import requests
 import json
 from collections import deque
 import shutil
+import struct
+import hashlib
+import datetime
+import email.utils
 import pytest
 from pathlib import Path
 
 import unittest
+from unittest import mock
 import requests_mock
+from requests_toolbelt.multipart import encoder
 
 from test import testResponses
 
 import smugler
-from lib.smugmugapi import SmugMug, Folder, SmugMugException
+from lib.smugmugapi import SmugMug, Folder, SmugMugException, setExtensionAliases
+from lib import transport, snapshot
+from lib.scheduler import UploadScheduler
+from lib import metadata, routing, hashing
+from lib.filecache import FileInfoCache
+from lib.ledger import Ledger
+from lib.concurrency import AdaptiveLimiter, parseRetryAfter
+from lib.httpcache import ResponseCache
+from lib.albumcache import AlbumCache
+from lib.localbackend import LocalBackend
 
 def isFolder(node):
     return isinstance(node, dict)
@@ -29,11 +54,20 @@ def isAlbum(node):
     return isinstance(node, list)
 
 class Args:
-    def __init__(self, action, imagePath, refresh=None, debug=False):
+    def __init__(self, action, imagePath, refresh=None, debug=False, plan=None, yes=False, pipeline=False,
+            ledger=None, worker=None, listen=None, subpath=None, backend="smugmug"):
         self.action = action
         self.imagePath = imagePath
         self.refresh = refresh
         self.debug = debug
+        self.plan = plan
+        self.yes = yes
+        self.pipeline = pipeline
+        self.ledger = ledger
+        self.worker = worker
+        self.listen = listen
+        self.subpath = subpath
+        self.backend = backend
 
 class TestSmuglerBase(unittest.TestCase):
 
@@ -47,6 +81,12 @@ class TestSmuglerBase(unittest.TestCase):
         self.remote = {}
 
         self.uploadFail = {}
+        self.remoteCorrupt = {}
+        self.throttled = 0
+        self.etags = False
+        self.albumTimestamps = False
+        self.remoteDateModified = "2020-01-01T00:00:00+00:00"
+        self.notModified = 0
 
         self.registerUserBaseCalls()
         self.request_mock.add_matcher(self.remoteHandler)
@@ -77,9 +117,10 @@ class TestSmuglerBase(unittest.TestCase):
 
     def registerUserBaseCalls(self):
 
-        dataUser = { "Response": {
+        def dataUser(request, context):
+            return { "Response": {
                     "User": {
-                        "ImageCount": 0,
+                        "ImageCount": self.remoteImageCount(),
                         "NickName": "TestUser",
                         "Uris": {
                             "Folder": "/api/v2/folder/user/testuser"
@@ -91,21 +132,29 @@ class TestSmuglerBase(unittest.TestCase):
             '//api.smugmug.com/api/v2!authuser?',
             json=dataUser)
 
-        dataUserFolder = { "Response": {
-                            "Folder": {
-                                "Name": "",
-                                "Uri": "/api/v2/folder/user/testuser",
-                                "Uris": {
-                                    "Folders": "/api/v2/folder/user/testuser!folders",
-                                    "FolderAlbums": "/api/v2/folder/user/testuser!albums"
-                                }
-                            }
-                        }}
+        def dataUserFolder(request, context):
+            return { "Response": {
+                    "Folder": {
+                        "Name": "",
+                        "DateModified": self.remoteDateModified,
+                        "Uri": "/api/v2/folder/user/testuser",
+                        "Uris": {
+                            "Folders": "/api/v2/folder/user/testuser!folders",
+                            "FolderAlbums": "/api/v2/folder/user/testuser!albums"
+                        }
+                    }
+                }}
 
         self.request_mock.register_uri('GET',
             '//api.smugmug.com/api/v2/folder/user/testuser?',
             json=dataUserFolder)
 
+    def remoteImageCount(self, node=None):
+        node = self.remote if node is None else node
+        if isAlbum(node):
+            return len(node)
+        return sum(self.remoteImageCount(childNode) for childNode in node.values())
+
     def createErrorResponse(self, code = 400):
         resp = requests.Response()
         resp.status_code = code
@@ -155,7 +204,25 @@ class TestSmuglerBase(unittest.TestCase):
 
         return None, None
 
+    def findAlbumParentWithId(self, albumId):
+        front = deque()
+        front.append(self.remote)
+
+        while front:
+            node = front.popleft()
+            for name, nextNode in node.items():
+                if isAlbum(nextNode) and testResponses.getItemId(name) == albumId:
+                    return node, name
+                elif isFolder(nextNode):
+                    front.append(nextNode)
+
+        return None, None
+
     def findImageWithId(self, imageId):
+        imageName, _ = self.findImageAndAlbumWithId(imageId)
+        return imageName
+
+    def findImageAndAlbumWithId(self, imageId):
         try:
             imageId = imageId.decode()
         except (UnicodeDecodeError, AttributeError):
@@ -172,15 +239,47 @@ class TestSmuglerBase(unittest.TestCase):
             elif isAlbum(node):
                 for imageName in node:
                     if testResponses.getItemId(imageName) == imageId:
-                        return imageName
+                        return imageName, node
 
-        return None
+        return None, None
 
     def remoteHandler(self, request):
 
+        resp = self.remoteResponse(request)
+        if self.etags and request.method == "GET" and resp is not None and resp.status_code == 200:
+            etag = '"%s"' % hashlib.md5(resp.content).hexdigest()
+            if request.headers.get("If-None-Match") in (etag, etag.encode()):
+                self.notModified += 1
+                resp = self.createErrorResponse(304)
+            resp.headers["ETag"] = etag
+        return resp
+
+    def albumImages(self, node):
+        # Images of the albums of a folder for ImagesLastUpdated
+        if not self.albumTimestamps:
+            return None
+        return dict((name, childNode) for name, childNode in node.items() if isAlbum(childNode))
+
+    def remoteResponse(self, request):
+
         method = request.method
         urlPath = request.path.replace("//api.smugmug.com/api/v2/", "")
 
+        if self.throttled and method == "GET":
+            self.throttled -= 1
+            resp = self.createErrorResponse(429)
+            resp.headers["Retry-After"] = "0.1"
+            return resp
+
+        m = re.search("folder/user/testuser(.*)!movealbums", urlPath)
+        if m and method == "POST":
+            node = self.getFolderAtPath(m.group(1))
+            albumId = parse_qs(request.text)["MoveUris"][0].replace("/api/v2/album/", "")
+            albumParent, albumName = self.findAlbumParentWithId(albumId)
+            self.assertNotIn(albumName, node)
+            node[albumName] = albumParent.pop(albumName)
+            return self.createResponse({"Response": {}, "Code": 200, "Message": "Ok"})
+
         m = re.search("folder/user/testuser(.*)!folders", urlPath)
         if m:
             nodePath = m.group(1)
@@ -200,27 +299,51 @@ class TestSmuglerBase(unittest.TestCase):
             node = self.getFolderAtPath(nodePath)
             if method == "GET":
                 albums = [name for name, childNode in node.items() if isAlbum(childNode)]
-                return self.createResponse(testResponses.getAlbumsResponse(albums, nodePath))
+                imageCounts = dict((name, len(node[name])) for name in albums)
+                return self.createResponse(testResponses.getAlbumsResponse(albums, nodePath, self.albumImages(node), imageCounts))
             elif method == "POST":
                 name = parse_qs(request.text)["Name"][0]
                 self.assertNotIn(name, node)
                 node[name] = []
                 return self.createResponse(testResponses.postAlbumResponse(name, nodePath))
 
+        m = re.search("album/(.+)!collectimages", urlPath)
+        if m and method == "POST":
+            _, album = self.findAlbumWithId(m.group(1))
+            imageId = parse_qs(request.text)["CollectUris"][0].replace("/api/v2/image/", "").replace("-0", "")
+            imageName = self.findImageWithId(imageId)
+            if not imageName:
+                return self.createErrorResponse(404)
+            self.assertNotIn(imageName, album)
+            album.append(imageName)
+            return self.createResponse({"Response": {}, "Code": 200, "Message": "Ok"})
+
         m = re.search("album/(.+)!images", urlPath)
         if m:
             if method == "GET":
                 albumName, album = self.findAlbumWithId(m.group(1))
-                
-                return self.createResponse(testResponses.getImagesResponse(albumName, album))
+                resp = testResponses.getImagesResponse(albumName, album)
+                for image in resp["Response"]["AlbumImage"]:
+                    corruption = self.remoteCorrupt.get(image["FileName"])
+                    if corruption == "truncated":
+                        image["ArchivedSize"] -= 1
+                    if corruption:
+                        image["ArchivedMD5"] = "0" * 32
+                return self.createResponse(resp)
 
         m = re.search("album/(.+)", urlPath)
         if m:
+            if method == "PATCH":
+                newName = parse_qs(request.text)["Name"][0]
+                albumParent, albumName = self.findAlbumParentWithId(m.group(1))
+                self.assertNotIn(newName, albumParent)
+                albumParent[newName] = albumParent.pop(albumName)
+                return self.createResponse(testResponses.getAlbumResponse(newName))
             if method == "GET":
                 albumName, album = self.findAlbumWithId(m.group(1))
-                if not album:
+                if album is None:
                     return self.createErrorResponse(404)
-                return self.createResponse(testResponses.getAlbumResponse(albumName))
+                return self.createResponse(testResponses.getAlbumResponse(albumName, album if self.albumTimestamps else None))
 
         m = re.search("image/(.+)-0", urlPath)
         if m:
@@ -228,6 +351,12 @@ class TestSmuglerBase(unittest.TestCase):
                 imageName = self.findImageWithId(m.group(1))
                 self.assertIsNotNone(imageName)
                 return self.createResponse(testResponses.getImageResponse(imageName))
+            elif method == "DELETE":
+                imageName, album = self.findImageAndAlbumWithId(m.group(1))
+                if not album:
+                    return self.createErrorResponse(404)
+                album.remove(imageName)
+                return self.createResponse({"Response": {}, "Code": 200, "Message": "Ok"})
 
         m = re.search("folder/user/testuser/(.*)", urlPath)
         if m:
@@ -242,12 +371,26 @@ class TestSmuglerBase(unittest.TestCase):
                 return self.createErrorResponse(404)
             if method == "GET":
                 return self.createResponse(testResponses.getFolderResponse(realfolderName, pathName))
+            elif method == "PATCH":
+                newName = parse_qs(request.text)["Name"][0]
+                parentNode = self.getFolderAtPath(pathName)
+                self.assertNotIn(newName, parentNode)
+                parentNode[newName] = parentNode.pop(realfolderName)
+                return self.createResponse(testResponses.getFolderResponse(newName, "/" + pathName if pathName else ""))
 
         if request.hostname == 'upload.smugmug.com':
             imageName = request.text.fields['upload_file'][0]
             albumId = request.headers['X-Smug-AlbumUri'].replace(b"/api/v2/album/", b"")
             albumName, album = self.findAlbumWithId(albumId)
             self.assertIsNotNone(album)
+
+            if "X-Smug-ImageUri" in request.headers:
+                imageId = request.headers["X-Smug-ImageUri"].replace(b"/api/v2/image/", b"").replace(b"-0", b"")
+                self.assertEqual(self.findImageWithId(imageId), imageName)
+                self.assertIn(imageName, album)
+                self.remoteCorrupt.pop(imageName, None)
+                return self.createResponse(testResponses.uploadResponse(imageName))
+
             self.assertNotIn(imageName, album)
 
             if imageName in self.uploadFail:
@@ -517,6 +660,33 @@ class TestSmuglerSync(TestSmuglerBase):
         self.assertLocalEqRemote()
         self.assertUploadCount(5)
 
+    def testFailingUploadRefreshesOnlyPendingAlbums(self):
+        self.createLocalFiles(self.tempDir, {"Folder1": {"Album1": ["File1.jpg", "File2.jpg"], "Album2": ["File3.jpg"]}})
+
+        self.uploadFail["File2.jpg"] = True
+
+        with mock.patch.object(smugler, "scanNewFiles", wraps=smugler.scanNewFiles) as scanMock:
+            smugler.main(Args("sync", self.tempDir))
+
+        self.assertLocalEqRemote()
+        # File2.jpg arrived despite the error and is found by the refresh.
+        self.assertUploadCount(3)
+        # The local tree is walked once, only Album1 is reloaded for the retry.
+        self.assertEqual([c.args[0] for c in scanMock.call_args_list].count(Path(self.tempDir)), 1)
+        albumReloads = [r for r in self.request_mock.request_history
+            if r.method == "GET" and "!images" in r.path]
+        self.assertEqual(len(albumReloads), 1)
+
+    def testParallelUpload(self):
+        self.createConfig({"Upload": {"Workers": 3, "Order": "largestFirst"}})
+        self.createLocalFiles(self.tempDir, self.getTestStructure())
+
+        smugler.main(Args("sync", self.tempDir))
+
+        self.assertLocalEqRemote()
+        self.assertUploadCount(11)
+        self.assertPostCount(9)
+
     def testFailingUploadGiveUp(self):
         self.createLocalFiles(self.tempDir, {"Folder1": {"Album1": ["File1.jpg", "File2.jpg", "File3.jpg", "File4.jpg", "File5.jpg"]}})
 
@@ -620,6 +790,1458 @@ class TestSmuglerSync(TestSmuglerBase):
         self.assertUploadCount(2)
         self.assertPostCount(1)
 
+class RecordingAlbum:
+
+    def __init__(self, uploads, fail=()):
+        self.uploads = uploads
+        self.fail = fail
+
+    def upload(self, path):
+        if path.name in self.fail:
+            raise SmugMugException(503, "Service unavailable")
+        self.uploads.append(path.name)
+
+class TestUploadScheduler(unittest.TestCase):
+
+    def setUp(self):
+        self.tempDir = Path(tempfile.mkdtemp())
+        self.uploads = []
+
+    def tearDown(self):
+        shutil.rmtree(self.tempDir)
+
+    def createFiles(self, album, sizes):
+        albumDir = self.tempDir / album
+        albumDir.mkdir()
+        files = []
+        for name, size in sizes.items():
+            f = albumDir / name
+            f.write_bytes(b"x" * size)
+            files.append(f)
+        return files
+
+    def runScheduler(self, order, fail=(), maxFailures=5):
+        scheduler = UploadScheduler(order=order, maxFailures=maxFailures)
+        scheduler.add(RecordingAlbum(self.uploads, fail), self.createFiles("Album1", {"b.jpg": 30, "a.jpg": 10}))
+        scheduler.add(RecordingAlbum(self.uploads, fail), self.createFiles("Album2", {"c.jpg": 20, "d.jpg": 40}))
+        scheduler.run()
+        return scheduler
+
+    def testOrderByName(self):
+        self.runScheduler("name")
+        self.assertEqual(self.uploads, ["a.jpg", "b.jpg", "c.jpg", "d.jpg"])
+
+    def testOrderSmallFirst(self):
+        self.runScheduler("smallFirst")
+        self.assertEqual(self.uploads, ["a.jpg", "c.jpg", "b.jpg", "d.jpg"])
+
+    def testOrderLargestFirst(self):
+        self.runScheduler("largestFirst")
+        self.assertEqual(self.uploads, ["d.jpg", "b.jpg", "c.jpg", "a.jpg"])
+
+    def testOrderMixedSingleWorker(self):
+        self.runScheduler("mixed")
+        self.assertEqual(self.uploads, ["d.jpg", "a.jpg", "b.jpg", "c.jpg"])
+
+    def testOrderOldestAlbum(self):
+        scheduler = UploadScheduler(order="oldestAlbum")
+        newFiles = self.createFiles("New", {"n.jpg": 1})
+        oldFiles = self.createFiles("Old", {"o.jpg": 1})
+        os.utime(oldFiles[0], (0, 0))
+        scheduler.add(RecordingAlbum(self.uploads), newFiles)
+        scheduler.add(RecordingAlbum(self.uploads), oldFiles)
+        scheduler.run()
+        self.assertEqual(self.uploads, ["o.jpg", "n.jpg"])
+
+    def testProgress(self):
+        scheduler = self.runScheduler("name")
+        self.assertEqual(scheduler.progress.doneFiles, 4)
+        self.assertEqual(scheduler.progress.doneBytes, 100)
+        self.assertIn("4/4 files, 100 B/100 B", str(scheduler.progress))
+
+    def testProgressOfRetries(self):
+        scheduler = self.runScheduler("name", fail=("a.jpg",))
+        self.assertIn("3/3 files, 90 B/90 B", str(scheduler.progress))
+
+        # Retry pass with the failed and an uploaded file
+        files = sorted((self.tempDir / "Album1").iterdir())
+        scheduler.add(RecordingAlbum(self.uploads), files)
+        scheduler.run()
+        self.assertIn("4/4 files, 100 B/100 B", str(scheduler.progress))
+
+    def testFailuresGiveUp(self):
+        with pytest.raises(SmugMugException):
+            self.runScheduler("name", fail=("a.jpg", "b.jpg", "c.jpg"), maxFailures=3)
+
+    def testParallel(self):
+        scheduler = UploadScheduler(workers=3, order="mixed")
+        scheduler.add(RecordingAlbum(self.uploads), self.createFiles("Album1", dict(("%d.jpg" % i, i) for i in range(20))))
+        scheduler.run()
+        self.assertEqual(sorted(self.uploads), sorted("%d.jpg" % i for i in range(20)))
+
+    def testUnknownOrder(self):
+        with pytest.raises(ValueError):
+            UploadScheduler(order="random")
+
+class TestAdaptiveLimiter(unittest.TestCase):
+
+    def complete(self, limiter, count, latency, size=None):
+        for _ in range(count):
+            limiter.success(latency, size)
+
+    def testIncreaseWhileLatencyIsStable(self):
+        limiter = AdaptiveLimiter("test", maxLimit=4)
+        for limit in range(1, 4):
+            self.assertEqual(limiter.limit, limit)
+            self.complete(limiter, limit, 1.0)
+        self.assertEqual(limiter.limit, 4)
+        self.complete(limiter, 4, 1.0)
+        self.assertEqual(limiter.limit, 4)
+        self.assertEqual(limiter.increases, 3)
+
+    def testDecreaseOnRisingLatency(self):
+        limiter = AdaptiveLimiter("test", maxLimit=8, initial=4)
+        self.complete(limiter, 4, 1.0, 1000)
+        self.assertEqual(limiter.limit, 5)
+        # Latency per byte is compared
+        self.complete(limiter, 5, 2.0, 2000)
+        self.assertEqual(limiter.limit, 6)
+        self.complete(limiter, 6, 5.0, 1000)
+        self.assertEqual(limiter.limit, 5)
+
+    def testErrorsHalveOncePerLimit(self):
+        limiter = AdaptiveLimiter("test", maxLimit=8, initial=8)
+        epochs = [limiter.acquire() for _ in range(4)]
+        for epoch in epochs:
+            limiter.failure(epoch)
+            limiter.release()
+        self.assertEqual(limiter.limit, 4)
+
+        limiter.failure(limiter.acquire())
+        limiter.release()
+        self.assertEqual(limiter.limit, 2)
+        self.assertEqual([d[1:] for d in limiter.metrics()["decisions"]], [(4, "error"), (2, "error")])
+
+    def testRetryAfterHoldsRequests(self):
+        limiter = AdaptiveLimiter("test", maxLimit=2, initial=2)
+        limiter.failure(retryAfter=0.3)
+        start = time.time()
+        with limiter:
+            self.assertGreaterEqual(time.time() - start, 0.25)
+        self.assertEqual(limiter.retryAfterCount, 1)
+
+    def testTrack(self):
+        limiter = AdaptiveLimiter("test", maxLimit=2, initial=2)
+        with self.assertRaises(SmugMugException):
+            with limiter.track():
+                raise SmugMugException(503, "Unavailable")
+        self.assertEqual(limiter.limit, 1)
+        # Client errors don't change the limit
+        with self.assertRaises(SmugMugException):
+            with limiter.track():
+                raise SmugMugException(404, "Not found")
+        self.assertEqual(limiter.decreases, 1)
+
+    def testParseRetryAfter(self):
+        self.assertEqual(parseRetryAfter("5"), 5.0)
+        self.assertEqual(parseRetryAfter("100000"), 300)
+        self.assertIsNone(parseRetryAfter("soon"))
+        self.assertAlmostEqual(parseRetryAfter(email.utils.formatdate(time.time() + 60, usegmt=True)), 60, delta=2)
+
+class TestSmuglerAdaptive(TestSmuglerBase):
+
+    def testThrottledRequestsAreRetried(self):
+        self.createConfig({"Adaptive": {"Enabled": True}, "Upload": {"Workers": 3}})
+        self.createLocalFiles(self.tempDir, self.getTestStructure())
+        self.throttled = 2
+
+        smugler.main(Args("sync", self.tempDir))
+
+        self.assertLocalEqRemote()
+        self.assertUploadCount(11)
+        concurrency = smugler.loadStats(Path(self.tempDir))["concurrency"]
+        self.assertEqual(concurrency["api"]["retryAfter"], 2)
+        self.assertEqual(concurrency["upload"]["max"], 3)
+        self.assertGreater(concurrency["upload"]["increases"], 0)
+
+    def testThrottledWithoutAdaptiveLimit(self):
+        self.createLocalFiles(self.tempDir, {"Album1": ["File1.jpg"]})
+        self.throttled = 1
+
+        smugler.main(Args("sync", self.tempDir))
+
+        self.assertLocalEqRemote()
+        self.assertNotIn("concurrency", smugler.loadStats(Path(self.tempDir)))
+
+class TestSmuglerHttpCache(TestSmuglerBase):
+
+    def setUp(self):
+        super().setUp()
+        self.createConfig({"HttpCache": {"Enabled": True}})
+
+    def imageListings(self, start):
+        return sum(1 for r in self.request_mock.request_history[start:] if r.method == "GET" and "!images" in r.path)
+
+    def testConditionalRequests(self):
+        self.etags = True
+        self.createLocalFiles(self.tempDir, self.getTestStructure())
+        smugler.main(Args("sync", self.tempDir))
+        smugler.main(Args("sync", self.tempDir, refresh="*"))
+
+        self.notModified = 0
+        start = len(self.request_mock.request_history)
+        smugler.main(Args("sync", self.tempDir, refresh="*"))
+        self.assertEqual(self.imageListings(start), 5)
+        self.assertGreaterEqual(self.notModified, 5)
+        self.assertUploadCount(11)
+
+        self.remote["Album1"].remove("File1_1.jpg")
+        smugler.main(Args("sync", self.tempDir, refresh="*"))
+        self.assertLocalEqRemote()
+        self.assertUploadCount(12)
+
+    def testUnchangedAlbumsAreNotListed(self):
+        self.albumTimestamps = True
+        self.createLocalFiles(self.tempDir, self.getTestStructure())
+        smugler.main(Args("sync", self.tempDir))
+        smugler.main(Args("sync", self.tempDir, refresh="*"))
+
+        start = len(self.request_mock.request_history)
+        smugler.main(Args("sync", self.tempDir, refresh="*"))
+        self.assertEqual(self.imageListings(start), 0)
+
+        self.remote["Album1"].remove("File1_1.jpg")
+        start = len(self.request_mock.request_history)
+        smugler.main(Args("sync", self.tempDir, refresh="*"))
+        self.assertEqual(self.imageListings(start), 1)
+        self.assertLocalEqRemote()
+        self.assertUploadCount(12)
+
+    def testLeastRecentlyUsedAreEvicted(self):
+        cacheFile = Path(self.tempDir) / "cache"
+        cache = ResponseCache(cacheFile)
+
+        def store(key):
+            cache.store(key, '"etag"', None, None, {"Data": os.urandom(500).hex()})
+
+        store("a")
+        cache.maxBytes = cache._size * 2.5
+        store("b")
+        cache.hit("a", revalidated=True)
+        store("c")
+
+        self.assertIsNone(cache.get("b"))
+        self.assertEqual(cache.get("a").etag, '"etag"')
+        cache.close()
+
+        cache = ResponseCache(cacheFile)
+        self.assertEqual(len(cache.get("c").response["Data"]), 1000)
+        self.assertIsNone(cache.get("b"))
+        cache.close()
+
+class TestSmuglerChangeDetection(TestSmuglerBase):
+
+    def setUp(self):
+        super().setUp()
+        self.createConfig({"ChangeDetection": {"Enabled": True}})
+        self.albumTimestamps = True
+
+    def listings(self, start):
+        return [r.path for r in self.request_mock.request_history[start:]
+            if r.method == "GET" and re.search("!(folders|albums|images)$", r.path)]
+
+    def addLocalFile(self, structure, folder, album, name):
+        structure[folder][album].append(name)
+        self.createLocalFiles(self.tempDir, structure)
+
+    def testUnchangedRemoteIsNotRefreshed(self):
+        structure = self.getTestStructure()
+        self.createLocalFiles(self.tempDir, structure)
+        smugler.main(Args("sync", self.tempDir))
+        self.assertLocalEqRemote()
+
+        self.addLocalFile(structure, "Folder1", "Album1_1", "New1.jpg")
+        start = len(self.request_mock.request_history)
+        smugler.main(Args("sync", self.tempDir))
+        self.assertEqual(self.listings(start), [])
+        self.assertLocalEqRemote()
+        self.assertUploadCount(12)
+
+        self.addLocalFile(structure, "Folder3", "Album3_1", "New2.jpg")
+        start = len(self.request_mock.request_history)
+        smugler.main(Args("scan", self.tempDir))
+        smugler.main(Args("sync", self.tempDir, pipeline=True))
+        self.assertEqual(self.listings(start), [])
+        self.assertLocalEqRemote()
+        self.assertUploadCount(13)
+
+    def testRemoteChangesAreDetected(self):
+        structure = self.getTestStructure()
+        self.createLocalFiles(self.tempDir, structure)
+        smugler.main(Args("sync", self.tempDir))
+        # Albums changed by uploads are listed again on the next check
+        smugler.main(Args("sync", self.tempDir, refresh="*"))
+
+        # Deleted elsewhere, only this album is listed again
+        self.remote["Folder2"]["Album2_1"].remove("File2_1_1.jpg")
+        self.addLocalFile(structure, "Folder1", "Album1_1", "New1.jpg")
+        start = len(self.request_mock.request_history)
+        smugler.main(Args("sync", self.tempDir))
+        self.assertEqual([path for path in self.listings(start) if path.endswith("!images")],
+            ["/api/v2/album/%s!images" % testResponses.getItemId("Album2_1")])
+        self.assertLocalEqRemote()
+        self.assertUploadCount(13)
+
+        self.addLocalFile(structure, "Folder1", "Album1_1", "New2.jpg")
+        start = len(self.request_mock.request_history)
+        smugler.main(Args("sync", self.tempDir))
+        self.assertEqual(self.listings(start), [])
+        self.assertLocalEqRemote()
+
+    def testChangesWithSameImageCount(self):
+        structure = self.getTestStructure()
+        self.createLocalFiles(self.tempDir, structure)
+        smugler.main(Args("sync", self.tempDir))
+        smugler.main(Args("sync", self.tempDir, refresh="*"))
+
+        # Renamed elsewhere
+        self.remote["Folder2"]["Renamed"] = self.remote["Folder2"].pop("Album2_1")
+        self.remoteDateModified = "2020-01-02T00:00:00+00:00"
+        self.addLocalFile(structure, "Folder2", "Album2_1", "New1.jpg")
+        with self.assertLogs() as cm:
+            smugler.main(Args("sync", self.tempDir))
+
+        self.assertIn("INFO:root:Remote changed since the last run, checking all folders and albums", cm.output)
+        self.assertEqual(sorted(self.remote["Folder2"]["Album2_1"]), sorted(structure["Folder2"]["Album2_1"]))
+
+class TestSmuglerLocalBackend(TestSmuglerBase):
+
+    def setUp(self):
+        super().setUp()
+        self.targetDir = Path(tempfile.mkdtemp())
+        self.createConfig({"LocalBackend": {"Path": str(self.targetDir)}, "Rename": {"Enabled": True}})
+
+    def tearDown(self):
+        shutil.rmtree(self.targetDir)
+
+    def readTarget(self, path=None):
+        path = path or self.targetDir
+        if (path / ".smuglerAlbum").exists():
+            return sorted(p.name for p in path.iterdir() if not p.name.startswith("."))
+        return dict((p.name, self.readTarget(p)) for p in path.iterdir() if p.is_dir())
+
+    def sync(self, action="sync", **kwargs):
+        smugler.main(Args(action, self.tempDir, backend="local", **kwargs))
+        self.remote = self.readTarget()
+
+    def testSync(self):
+        self.createLocalFiles(self.tempDir, self.getTestStructure())
+        self.sync()
+        self.assertLocalEqRemote()
+        self.assertEqual((self.targetDir / "Album1" / "File1_1.jpg").read_text(encoding="utf-8"), "File1_1.jpg")
+        self.assertEqual(self.request_mock.call_count, 0)
+
+        # Deleted images are found again on refresh
+        (self.targetDir / "Album1" / "File1_1.jpg").unlink()
+        self.sync()
+        self.assertNotIn("File1_1.jpg", self.remote["Album1"])
+        self.sync(refresh="*")
+        self.assertLocalEqRemote()
+
+        # The SmugMug content is kept apart
+        self.assertFalse(smugler.getContentFilePath(Path(self.tempDir)).exists())
+
+    def testRenameAndSyncRemote(self):
+        self.createLocalFiles(self.tempDir, {"2023": {"Trip": ["File1.jpg", "File2.jpg", "File3.jpg"]}})
+        self.sync()
+        albumId = json.loads((self.targetDir / "2023" / "Trip" / ".smuglerAlbum").read_text())["Id"]
+
+        self.clearLocalFiles(self.tempDir)
+        self.createLocalFiles(self.tempDir, {"2024": {"Iceland Trip": ["File1.jpg", "File2.jpg", "File3.jpg"]}})
+        self.sync()
+        self.assertEqual(self.remote, {"2023": {}, "2024": {"Iceland Trip": ["File1.jpg", "File2.jpg", "File3.jpg"]}})
+        self.assertEqual(json.loads((self.targetDir / "2024" / "Iceland Trip" / ".smuglerAlbum").read_text())["Id"], albumId)
+
+        os.unlink(os.path.join(self.tempDir, "2024", "Iceland Trip", "File3.jpg"))
+        self.sync("syncRemote", yes=True)
+        self.assertEqual(self.remote["2024"], {"Iceland Trip": ["File1.jpg", "File2.jpg"]})
+
+    def testCollectedImageUri(self):
+        self.createLocalFiles(self.tempDir, {"Album1": ["File1.jpg"], "Album2": ["File2.jpg"]})
+        self.sync()
+
+        rootFolder = Folder(LocalBackend(self.targetDir, self.config), lazy=False)
+        album1 = rootFolder.getChildrenByName("Album1")
+        album2 = rootFolder.getChildrenByName("Album2")
+        source = album1.getImages()[0]
+        image = album2.collectImage(source.getUri(), Path("File1.jpg"))
+        self.assertNotEqual(image.getUri(), source.getUri())
+        self.assertEqual(self.readTarget(), {"Album1": ["File1.jpg"], "Album2": ["File1.jpg", "File2.jpg"]})
+
+        album2.deleteImage(image)
+        self.assertEqual(self.readTarget(), {"Album1": ["File1.jpg"], "Album2": ["File2.jpg"]})
+
+    def testVerify(self):
+        self.createLocalFiles(self.tempDir, {"Album1": ["File1.jpg", "File2.jpg"]})
+        self.sync()
+        (self.targetDir / "Album1" / "File2.jpg").write_text("corrupt", encoding="utf-8")
+
+        self.sync("verify")
+        self.assertEqual((self.targetDir / "Album1" / "File2.jpg").read_text(encoding="utf-8"), "File2.jpg")
+        self.assertLocalEqRemote()
+
+class TestSmuglerMemory(TestSmuglerBase):
+
+    def setUp(self):
+        super().setUp()
+        # Room for the images of about one album
+        self.createConfig({"Memory": {"MaxMB": 0.001}})
+        self.spillDir = Path(self.tempDir) / "_tmp"
+        self.spillDir.mkdir()
+        patcher = mock.patch("tempfile.tempdir", str(self.spillDir))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def assertNoSpillFile(self):
+        self.assertEqual(list(self.spillDir.iterdir()), [])
+
+    def testSyncWithEvictions(self):
+        self.createLocalFiles(self.tempDir, self.getTestStructure())
+        with self.assertLogs(level="INFO") as logs:
+            smugler.main(Args("sync", self.tempDir))
+        self.assertLocalEqRemote()
+        self.assertUploadCount(11)
+        self.assertTrue(any(re.search(r"Album cache: .* [1-9]\d* evictions", line) for line in logs.output))
+        self.assertNoSpillFile()
+
+        smugler.main(Args("sync", self.tempDir))
+        self.assertUploadCount(11)
+
+        structure = self.getTestStructure()
+        structure["Folder1"]["Album1_1"].append("New.jpg")
+        self.createLocalFiles(self.tempDir, structure)
+        smugler.main(Args("sync", self.tempDir))
+        self.assertLocalEqRemote()
+        self.assertUploadCount(12)
+
+    def testSyncRemoteWithEvictions(self):
+        self.createLocalFiles(self.tempDir, {"Album1": ["File1.jpg"], "Album2": ["File3.jpg"], "Album3": ["File5.jpg"]})
+        self.remote = {"Album1": ["File1.jpg", "File2.jpg"], "Album2": ["File3.jpg", "File4.jpg"],
+            "Album3": ["File5.jpg", "File6.jpg"]}
+
+        smugler.main(Args("syncRemote", self.tempDir, yes=True))
+        self.assertLocalEqRemote()
+        self.assertNoSpillFile()
+
+    def testModifiedAlbumsAreSpilled(self):
+        self.remote = {"Album1": ["File1.jpg", "File2.jpg"], "Album2": ["File3.jpg"]}
+        cache = AlbumCache(1)
+        api = SmugMug(self.tokenFile, self.config, albumCache=cache)
+        rootFolder = Folder(api, lazy=False)
+        album1 = rootFolder.getChildrenByName("Album1")
+        album2 = rootFolder.getChildrenByName("Album2")
+
+        self.assertTrue(album1.hasImage(Path("File1.jpg")))
+        self.assertTrue(album2.hasImage(Path("File3.jpg")))
+        self.assertEqual(album1._images, [])
+        self.assertGreater(cache._spillStore.spilled, 0)
+        self.assertEqual(Path(cache._spillStore.path).parent, self.spillDir)
+
+        # Read again from the spill file
+        self.assertEqual(sorted(image.getFileName() for image in album1.getImages()), ["File1.jpg", "File2.jpg"])
+        self.assertTrue(album1.hasImage(Path("File2.jpg")))
+
+        smugler.saveContentToFile(Path(self.tempDir), rootFolder)
+        loaded = smugler.loadContentFromFile(Path(self.tempDir))
+        self.assertEqual(len(loaded.getChildrenByName("Album1").getImages()), 2)
+        self.assertEqual(len(loaded.getChildrenByName("Album2").getImages()), 1)
+        cache.close()
+        self.assertNoSpillFile()
+
+    def testEvictionDuringListing(self):
+        self.remote = {"Album1": ["File%d.jpg" % i for i in range(10)], "Album2": ["File10.jpg"]}
+        cache = AlbumCache(1)
+        api = SmugMug(self.tokenFile, self.config, albumCache=cache)
+        rootFolder = Folder(api, lazy=False)
+        album1 = rootFolder.getChildrenByName("Album1")
+        album2 = rootFolder.getChildrenByName("Album2")
+        listImages = api.listImages
+        album1.getImages()
+
+        def interruptedListing(album, details=False):
+            for i, image in enumerate(listImages(album, details)):
+                if i == 5:
+                    # Another thread uses an album, which evicts this one
+                    album2.getImages()
+                yield image
+
+        with mock.patch.object(api, "listImages", interruptedListing):
+            album1.reload()
+
+        self.assertEqual(len(album1.getImages()), 10)
+        self.assertTrue(album1.hasImage(Path("File9.jpg")))
+        cache.close()
+
+class TestSmuglerHardlinks(TestSmuglerBase):
+
+    def linkLocalFile(self, source, target):
+        os.makedirs(os.path.dirname(os.path.join(self.tempDir, target)), exist_ok=True)
+        os.link(os.path.join(self.tempDir, source), os.path.join(self.tempDir, target))
+
+    def assertCollectCount(self, expectedCount):
+        actualCount = 0
+        for r in self.request_mock.request_history:
+            if r.method == "POST" and r.path.endswith("!collectimages"):
+                actualCount += 1
+        self.assertEqual(expectedCount, actualCount)
+
+    def testHardlinkedFilesAreLinked(self):
+        self.createLocalFiles(self.tempDir, {"Folder1": {"Album1": ["File1.jpg", "File2.jpg"]}})
+        self.linkLocalFile("Folder1/Album1/File1.jpg", "Collections/Best/File1.jpg")
+        self.local["Collections"] = {"Best": ["File1.jpg"]}
+
+        smugler.main(Args("sync", self.tempDir))
+
+        self.assertLocalEqRemote()
+        self.assertUploadCount(2)
+        self.assertCollectCount(1)
+        # The Uri of the collected image is listed
+        imagesPath = "/api/v2/album/%s!images" % testResponses.getItemId("Best")
+        self.assertTrue(any(r.method == "GET" and r.path == imagesPath for r in self.request_mock.request_history))
+
+    def testHardlinkAddedLater(self):
+        self.createLocalFiles(self.tempDir, {"Folder1": {"Album1": ["File1.jpg", "File2.jpg"]}})
+        smugler.main(Args("sync", self.tempDir))
+        self.assertUploadCount(2)
+
+        self.linkLocalFile("Folder1/Album1/File2.jpg", "Collections/Best/File2.jpg")
+        self.local["Collections"] = {"Best": ["File2.jpg"]}
+        smugler.main(Args("sync", self.tempDir))
+
+        self.assertLocalEqRemote()
+        self.assertUploadCount(2)
+        self.assertCollectCount(1)
+
+    def testLinkedImageDeletedRemotely(self):
+        self.createLocalFiles(self.tempDir, {"Folder1": {"Album1": ["File1.jpg"]}})
+        smugler.main(Args("sync", self.tempDir))
+
+        self.linkLocalFile("Folder1/Album1/File1.jpg", "Collections/Best/File1.jpg")
+        os.unlink(os.path.join(self.tempDir, "Folder1/Album1/File1.jpg"))
+        self.remote["Folder1"]["Album1"].remove("File1.jpg")
+
+        smugler.main(Args("sync", self.tempDir))
+
+        self.assertEqual(self.remote["Collections"], {"Best": ["File1.jpg"]})
+        self.assertUploadCount(2)
+        self.assertCollectCount(1)
+
+class TestSmuglerVerify(TestSmuglerBase):
+
+    def testVerifyInSync(self):
+        self.createLocalFiles(self.tempDir, self.getTestStructure())
+        self.remote = self.getTestStructure()
+
+        smugler.main(Args("verify", self.tempDir))
+
+        self.assertUploadCount(0)
+
+    def testVerifyReplacesMismatches(self):
+        self.createLocalFiles(self.tempDir, self.getTestStructure())
+        self.remote = self.getTestStructure()
+        self.remoteCorrupt = {"File1_1_1.jpg": "truncated", "File2_1_2.jpg": "modified"}
+
+        with mock.patch.object(hashing, "md5File", wraps=hashing.md5File) as md5Mock:
+            smugler.main(Args("verify", self.tempDir))
+
+        self.assertEqual(self.remoteCorrupt, {})
+        self.assertLocalEqRemote()
+        self.assertUploadCount(2)
+        self.assertPostCount(0)
+        # The truncated file is detected by its size, without hashing it
+        hashed = set(c.args[0].name for c in md5Mock.call_args_list)
+        self.assertIn("File2_1_2.jpg", hashed)
+        self.assertNotIn("File1_1_1.jpg", hashed)
+
+    def testVerifyUsesCachedHashes(self):
+        self.createLocalFiles(self.tempDir, {"Album1": ["File1.jpg", "File2.jpg"]})
+        self.remote = {"Album1": ["File1.jpg", "File2.jpg"]}
+
+        smugler.main(Args("verify", self.tempDir))
+
+        with mock.patch.object(hashing, "md5File", wraps=hashing.md5File) as md5Mock:
+            smugler.main(Args("verify", self.tempDir))
+        self.assertEqual(md5Mock.call_count, 0)
+
+    def testVerifyIgnoresMissingFiles(self):
+        self.createLocalFiles(self.tempDir, {"Album1": ["File1.jpg", "File2.jpg"]})
+        self.remote = {"Album1": ["File2.jpg", "File3.jpg"]}
+
+        smugler.main(Args("verify", self.tempDir))
+
+        self.assertUploadCount(0)
+
+    def testHashFilesInPool(self):
+        paths = []
+        for i in range(hashing.MinFilesForPool):
+            p = Path(self.tempDir) / f"File{i}.jpg"
+            p.write_bytes(os.urandom(1000))
+            paths.append(p)
+        fileCache = FileInfoCache(Path(self.tempDir) / ".smugmugFileInfo")
+
+        hashes = hashing.md5Files(paths, fileCache, workers=2)
+
+        self.assertEqual(hashes, dict((p, hashing.md5File(p)) for p in paths))
+        self.assertEqual(fileCache.get(paths[0], "md5"), hashes[paths[0]])
+
+class TestSmuglerTranscode(TestSmuglerBase):
+
+    def setUp(self):
+        super().setUp()
+        self.transcodeLog = os.path.join(self.tempDir, "_transcodeLog")
+        script = "import sys, shutil; open(sys.argv[3], 'a').write(sys.argv[1] + '\\n'); shutil.copyfile(sys.argv[1], sys.argv[2])"
+        self.createConfig({"Transcode": {"Workers": 2, "Formats": {
+            "heic": {"Extension": "jpg", "Command": [sys.executable, "-c", script, "{input}", "{output}", self.transcodeLog]},
+            "mts": {"Extension": "mp4", "Command": [sys.executable, "-c", "import sys; sys.exit(1)"]}}}})
+
+    def tearDown(self):
+        setExtensionAliases({})
+        super().tearDown()
+
+    def transcodeCount(self):
+        if not os.path.exists(self.transcodeLog):
+            return 0
+        with open(self.transcodeLog, encoding="utf-8") as fp:
+            return len(fp.readlines())
+
+    def testTranscodeBeforeUpload(self):
+        self.createLocalFiles(self.tempDir, {"Album1": ["File1.heic", "File2.jpg", "File3.HEIC"]})
+
+        smugler.main(Args("sync", self.tempDir))
+
+        self.assertEqual(sorted(self.remote["Album1"]), ["File1.jpg", "File2.jpg", "File3.jpg"])
+        self.assertUploadCount(3)
+        self.assertEqual(self.transcodeCount(), 2)
+
+        # The local files match the transcoded images
+        smugler.main(Args("sync", self.tempDir))
+        self.assertUploadCount(3)
+        self.assertEqual(self.transcodeCount(), 2)
+
+    def testTranscodedOutputIsReused(self):
+        self.createLocalFiles(self.tempDir, {"Album1": ["File1.heic"]})
+        smugler.main(Args("sync", self.tempDir, pipeline=True))
+
+        self.remote["Album1"].remove("File1.jpg")
+        smugler.main(Args("sync", self.tempDir, refresh="Album1", pipeline=True))
+
+        self.assertEqual(self.remote["Album1"], ["File1.jpg"])
+        self.assertUploadCount(2)
+        self.assertEqual(self.transcodeCount(), 1)
+
+    def testAliasCollision(self):
+        self.createLocalFiles(self.tempDir, {"Album1": ["File1.heic", "File1.jpg", "File2.heic"]})
+
+        with self.assertLogs(level="WARNING") as cm:
+            smugler.main(Args("sync", self.tempDir))
+
+        self.assertTrue(any("Skipping File1.heic" in line for line in cm.output))
+        self.assertEqual(sorted(self.remote["Album1"]), ["File1.jpg", "File2.jpg"])
+        self.assertEqual(self.transcodeCount(), 1)
+
+    def testFailingTranscode(self):
+        self.createLocalFiles(self.tempDir, {"Album1": ["File1.mts", "File2.jpg"]})
+
+        smugler.main(Args("sync", self.tempDir))
+
+        self.assertEqual(self.remote["Album1"], ["File2.jpg"])
+        self.assertUploadCount(1)
+
+class TestSmuglerLedger(TestSmuglerBase):
+
+    def setUp(self):
+        super().setUp()
+        self.ledgerFile = os.path.join(self.tempDir, "_ledger.db")
+
+    def otherWorker(self, leaseSeconds=600):
+        return Ledger(Path(self.ledgerFile), Path(self.tempDir), "other", leaseSeconds)
+
+    def testLeasedAlbumIsSkipped(self):
+        self.createLocalFiles(self.tempDir, self.getTestStructure())
+        other = self.otherWorker()
+        self.assertTrue(other.tryLease(Path(self.tempDir) / "Folder2" / "Album2_1"))
+
+        smugler.main(Args("sync", self.tempDir, ledger=self.ledgerFile, worker="worker1"))
+
+        self.assertNotIn("Album2_1", self.remote["Folder2"])
+        self.assertUploadCount(9)
+
+        other.close()
+        smugler.main(Args("sync", self.tempDir, ledger=self.ledgerFile, worker="worker1", pipeline=True))
+
+        self.assertLocalEqRemote()
+        self.assertUploadCount(11)
+
+    def testExpiredLeaseIsTaken(self):
+        self.createLocalFiles(self.tempDir, {"Album1": ["File1.jpg"]})
+        self.otherWorker().close()
+        # Lease of a crashed worker
+        with sqlite3.connect(self.ledgerFile) as db:
+            db.execute("INSERT INTO leases VALUES ('Album1', 'other', ?)", (time.time() - 1,))
+
+        smugler.main(Args("sync", self.tempDir, ledger=self.ledgerFile, worker="worker1"))
+
+        self.assertLocalEqRemote()
+
+    def testAlbumCreatedByOtherWorker(self):
+        self.createLocalFiles(self.tempDir, {"Folder1": {"Album1": ["File1.jpg", "File2.jpg"]}})
+        rootFolder = Folder(SmugMug(self.tokenFile, self.config), lazy=False)
+        smugler.saveContentToFile(Path(self.tempDir), rootFolder)
+
+        # Another worker created the folder and uploaded one file after the
+        # content was cached.
+        self.remote = {"Folder1": {"Album1": ["File1.jpg"]}}
+
+        smugler.main(Args("sync", self.tempDir, ledger=self.ledgerFile, worker="worker1"))
+
+        self.assertLocalEqRemote()
+        self.assertUploadCount(1)
+        self.assertPostCount(0)
+
+    def leasedAlbums(self):
+        with sqlite3.connect(self.ledgerFile) as db:
+            return sorted(row[0] for row in db.execute("SELECT album FROM leases"))
+
+    def testAlbumsAreLeasedWhileUploading(self):
+        self.createLocalFiles(self.tempDir, {"Album1": ["File1.jpg", "File2.jpg"], "Album2": ["File3.jpg"]})
+        upload = SmugMug.upload
+        for pipeline in (False, True):
+            leases = []
+
+            def leasedUpload(api, album, image, replaceUri=None):
+                leases.append((image.parent.name, self.leasedAlbums()))
+                return upload(api, album, image, replaceUri)
+
+            self.remote = {}
+            smugler.getContentFilePath(Path(self.tempDir)).unlink(missing_ok=True)
+            with mock.patch.object(SmugMug, "upload", leasedUpload):
+                smugler.main(Args("sync", self.tempDir, ledger=self.ledgerFile, worker="worker1", pipeline=pipeline))
+
+            self.assertLocalEqRemote()
+            self.assertEqual(sorted(leases), [("Album1", ["Album1"]), ("Album1", ["Album1"]), ("Album2", ["Album2"])])
+            self.assertEqual(self.leasedAlbums(), [])
+
+    def testContentOfOtherWorkersIsMerged(self):
+        self.createLocalFiles(self.tempDir, {"Folder1": {"Album1": ["File1.jpg", "File2.jpg"]}})
+        upload = SmugMug.upload
+
+        def otherWorkerUpload(api, album, image, replaceUri=None):
+            if "Album2" not in self.remote["Folder1"]:
+                # Another worker uploads and saves its content meanwhile
+                self.remote["Folder1"]["Album2"] = ["File3.jpg"]
+                smugler.saveContentToFile(Path(self.tempDir), Folder(SmugMug(self.tokenFile, self.config), lazy=False))
+            return upload(api, album, image, replaceUri)
+
+        self.remote = {"Folder1": {}}
+        with mock.patch.object(SmugMug, "upload", otherWorkerUpload):
+            smugler.main(Args("sync", self.tempDir, ledger=self.ledgerFile, worker="worker1"))
+
+        content = smugler.loadContentFromFile(Path(self.tempDir))
+        folder = content.getChildrenByName("Folder1")
+        self.assertTrue(folder.getChildrenByName("Album2").hasImage(Path("File3.jpg")))
+        album = folder.getChildrenByName("Album1")
+        self.assertTrue(album.hasImage(Path("File1.jpg")))
+        self.assertTrue(album.hasImage(Path("File2.jpg")))
+
+    def testLockIsExclusive(self):
+        worker1 = Ledger(Path(self.ledgerFile), Path(self.tempDir), "worker1")
+        worker2 = Ledger(Path(self.ledgerFile), Path(self.tempDir), "worker2")
+        events = []
+
+        def locked(ledger, name):
+            with ledger.lock("create:Album1"):
+                events.append(name + " start")
+                time.sleep(0.3)
+                events.append(name + " end")
+
+        threads = [threading.Thread(target=locked, args=(ledger, ledger.worker)) for ledger in (worker1, worker2)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(events[0].split()[0], events[1].split()[0])
+        self.assertEqual(events[2].split()[0], events[3].split()[0])
+        worker1.close()
+        worker2.close()
+
+    def testLockIsExclusiveWithinWorker(self):
+        worker1 = Ledger(Path(self.ledgerFile), Path(self.tempDir), "worker1")
+        events = []
+
+        def locked(name):
+            with worker1.lock("renames"):
+                events.append(name + " start")
+                time.sleep(0.3)
+                events.append(name + " end")
+
+        threads = [threading.Thread(target=locked, args=(name,)) for name in ("thread1", "thread2")]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+
+        self.assertEqual(events[0].split()[0], events[1].split()[0])
+        self.assertEqual(events[2].split()[0], events[3].split()[0])
+        worker1.close()
+
+    def testHeldLockIsRenewed(self):
+        worker1 = Ledger(Path(self.ledgerFile), Path(self.tempDir), "worker1", leaseSeconds=3)
+        other = self.otherWorker()
+
+        with worker1.lock("renames"):
+            with sqlite3.connect(self.ledgerFile) as db:
+                expires = db.execute("SELECT expires FROM locks WHERE name = 'renames'").fetchone()[0]
+            time.sleep(1.5)
+            with sqlite3.connect(self.ledgerFile) as db:
+                self.assertGreater(db.execute("SELECT expires FROM locks WHERE name = 'renames'").fetchone()[0], expires)
+            self.assertFalse(other._acquire("locks", "name", "renames"))
+
+        self.assertTrue(other._acquire("locks", "name", "renames"))
+        worker1.close()
+        other.close()
+
+    def testFileCacheMerge(self):
+        cacheFile = Path(self.tempDir) / ".smugmugFileInfo"
+        files = []
+        for i in range(2):
+            files.append(Path(self.tempDir) / f"File{i}.jpg")
+            files[-1].write_text(str(i))
+
+        cache1 = FileInfoCache(cacheFile)
+        cache2 = FileInfoCache(cacheFile)
+        cache1.set(files[0], "md5", "a")
+        cache2.set(files[1], "md5", "b")
+        cache1.save(merge=True)
+        cache2.save(merge=True)
+
+        merged = FileInfoCache(cacheFile)
+        self.assertEqual(merged.get(files[0], "md5"), "a")
+        self.assertEqual(merged.get(files[1], "md5"), "b")
+
+class TestSmuglerServe(TestSmuglerBase):
+
+    def setUp(self):
+        super().setUp()
+        self.startDaemon()
+
+    def startDaemon(self):
+        with socket.socket() as s:
+            s.bind(("127.0.0.1", 0))
+            self.listen = "127.0.0.1:%d" % s.getsockname()[1]
+        self.daemon = threading.Thread(target=smugler.main, args=(Args("serve", self.tempDir, listen=self.listen),))
+        self.daemon.start()
+        for _ in range(100):
+            try:
+                self.request("GET", "/status")
+                break
+            except OSError:
+                time.sleep(0.05)
+
+    def tearDown(self):
+        if self.daemon.is_alive():
+            self.request("POST", "/stop")
+        self.daemon.join()
+
+    def request(self, method, path, body=None):
+        data = json.dumps(body).encode("utf-8") if body is not None else None
+        req = urllib.request.Request("http://" + self.listen + path, data=data, method=method)
+        try:
+            with urllib.request.urlopen(req, timeout=10) as resp:
+                return resp.status, json.loads(resp.read())
+        except urllib.error.HTTPError as e:
+            return e.code, json.loads(e.read())
+
+    def waitIdle(self):
+        for _ in range(200):
+            status = self.request("GET", "/status")[1]
+            if status["state"] == "idle" and not status["queued"]:
+                return status
+            time.sleep(0.05)
+        self.fail("Sync didn't finish")
+
+    def testSyncSubpath(self):
+        self.createLocalFiles(self.tempDir, self.getTestStructure())
+
+        code, _ = self.request("POST", "/sync", {"path": "Folder2"})
+        self.assertEqual(code, 202)
+        status = self.waitIdle()
+
+        self.assertEqual(list(self.remote), ["Folder2"])
+        self.assertUploadCount(4)
+        self.assertEqual(status["uploadedFiles"], 4)
+        self.assertEqual(status["lastSync"]["path"], "Folder2")
+        self.assertIsNone(status["lastSync"]["error"])
+
+        # The tree is kept in memory
+        callCount = self.request_mock.call_count
+        self.request("POST", "/sync", {"path": "Folder2/Folder2_1/Album2_1_1"})
+        self.waitIdle()
+        self.assertEqual(self.request_mock.call_count, callCount)
+
+        self.request("POST", "/sync", {})
+        self.waitIdle()
+        self.assertLocalEqRemote()
+
+    def testRoutedFilesAddedBetweenSyncs(self):
+        self.request("POST", "/stop")
+        self.daemon.join()
+        self.createConfig({"DateRouting": {"Folders": ["Dump"], "Album": "%Y-%m"}})
+        dump = Path(self.tempDir) / "Dump"
+        dump.mkdir()
+        createJpeg(dump / "a.jpg", datetime.datetime(2020, 1, 15, 10, 0, 0))
+        self.startDaemon()
+
+        self.request("POST", "/sync", {"path": "Dump"})
+        self.waitIdle()
+        self.assertUploadCount(1)
+
+        createJpeg(dump / "b.jpg", datetime.datetime(2020, 1, 20, 10, 0, 0))
+        self.request("POST", "/sync", {"path": "Dump"})
+        self.waitIdle()
+        self.local = {"Dump": {"2020-01": ["a.jpg", "b.jpg"]}}
+        self.assertLocalEqRemote()
+        self.assertUploadCount(2)
+
+    def testPauseAndResume(self):
+        self.createLocalFiles(self.tempDir, {"Album1": ["File1.jpg", "File2.jpg"]})
+
+        self.assertEqual(self.request("POST", "/pause")[1]["state"], "paused")
+        self.request("POST", "/sync", {"path": "Album1"})
+        for _ in range(100):
+            status = self.request("GET", "/status")[1]
+            if status["queueDepth"] == 2:
+                break
+            time.sleep(0.05)
+        self.assertEqual(status["queueDepth"], 2)
+        self.assertEqual(status["current"], "Album1")
+        self.assertUploadCount(0)
+
+        self.request("POST", "/resume")
+        self.waitIdle()
+        self.assertLocalEqRemote()
+
+    def testInvalidRequests(self):
+        self.assertEqual(self.request("POST", "/sync", {"path": "Missing"})[0], 400)
+        self.assertEqual(self.request("POST", "/sync", {"path": "../x"})[0], 400)
+        self.assertEqual(self.request("GET", "/unknown")[0], 404)
+
+    def testStopSavesContent(self):
+        self.createLocalFiles(self.tempDir, {"Album1": ["File1.jpg"]})
+        self.request("POST", "/sync", {})
+        self.waitIdle()
+
+        self.assertEqual(self.request("POST", "/stop")[1], {"stopping": True})
+        self.daemon.join(10)
+        self.assertFalse(self.daemon.is_alive())
+        self.assertTrue(smugler.getContentFilePath(Path(self.tempDir)).exists())
+
+class TestSmuglerSubpath(TestSmuglerBase):
+
+    def testSyncSubpaths(self):
+        self.createLocalFiles(self.tempDir, self.getTestStructure())
+
+        smugler.main(Args("sync", self.tempDir, subpath=["Folder2/Folder2_1", "Album1", "Folder2/Folder2_1/Album2_1_1"]))
+
+        self.assertEqual(self.remote, {
+            "Folder2": {"Folder2_1": {"Album2_1_1": ["File2_1_1_1.jpg", "File2_1_1_2.jpg"]}},
+            "Album1": ["File1_1.jpg", "File1_2.jpg", "File1_3.jpg"]})
+        self.assertPostCount(4)
+
+        smugler.main(Args("sync", self.tempDir, subpath=["Folder2"]))
+        self.assertUploadCount(7)
+        self.assertNotIn("Folder1", self.remote)
+
+        smugler.main(Args("sync", self.tempDir))
+        self.assertLocalEqRemote()
+        self.assertUploadCount(11)
+
+    def testPipelinedSyncSubpath(self):
+        self.createLocalFiles(self.tempDir, self.getTestStructure())
+
+        smugler.main(Args("sync", self.tempDir, pipeline=True, subpath=["Folder2/Album2_1", "Folder3"]))
+
+        self.assertEqual(self.remote, {
+            "Folder2": {"Album2_1": ["File2_1_1.jpg", "File2_1_2.jpg"]},
+            "Folder3": {"Album3_1": ["File3_1_1.jpg", "File3_1_2.jpg"]}})
+
+    def testSubpathOnlyScansSubtree(self):
+        self.createLocalFiles(self.tempDir, self.getTestStructure())
+
+        with mock.patch("smugler.scanNewFiles", wraps=smugler.scanNewFiles) as scanNewFiles:
+            plan = smugler.runJob(Args("scan", self.tempDir, subpath=["Folder1"]), Path(self.tempDir), self.tokenFile, self.config)
+
+        scanned = set(Path(call.args[0]).name for call in scanNewFiles.call_args_list)
+        self.assertEqual(scanned, {"Folder1", "Album1_1"})
+        self.assertEqual(plan["files"], 2)
+        self.assertEqual(plan["createFolders"], ["Folder1"])
+
+    def testInvalidSubpath(self):
+        with self.assertRaises(SystemExit):
+            smugler.main(Args("sync", self.tempDir, subpath=["Missing"]))
+
+class TestSmuglerPipeline(TestSmuglerBase):
+
+    def testPipelinedUpload(self):
+        self.createLocalFiles(self.tempDir, self.getTestStructure())
+
+        smugler.main(Args("sync", self.tempDir, pipeline=True))
+
+        self.assertLocalEqRemote()
+        self.assertUploadCount(11)
+        self.assertPostCount(9)
+
+        # Uploads start before all albums have been created
+        history = self.request_mock.request_history
+        firstUpload = min(i for i, r in enumerate(history) if r.hostname == "upload.smugmug.com")
+        lastCreate = max(i for i, r in enumerate(history) if r.method == "POST" and r.hostname == "api.smugmug.com")
+        self.assertLess(firstUpload, lastCreate)
+
+    def testPipelinedUploadWithUnsupportedSubfolder(self):
+        self.createLocalFiles(self.tempDir, {"Trip": ["a.jpg", "b.jpg"]})
+        os.makedirs(os.path.join(self.tempDir, "Trip", "RAW"))
+        with open(os.path.join(self.tempDir, "Trip", "RAW", "a.cr2"), "w", encoding="utf-8") as fp:
+            fp.write("a.cr2")
+        os.makedirs(os.path.join(self.tempDir, "Trip", "Empty"))
+
+        smugler.main(Args("sync", self.tempDir, pipeline=True))
+
+        self.assertLocalEqRemote()
+        self.assertUploadCount(2)
+
+    def testPipelinedUploadPartial(self):
+        self.createLocalFiles(self.tempDir, self.getTestStructure())
+        self.remote = self.getTestStructure()
+        self.remote["Folder2"]["Album2_1"].pop()
+        del self.remote["Folder3"]
+
+        smugler.main(Args("sync", self.tempDir, pipeline=True))
+
+        self.assertLocalEqRemote()
+        self.assertUploadCount(3)
+        self.assertPostCount(2)
+
+        smugler.main(Args("sync", self.tempDir, pipeline=True))
+        self.assertUploadCount(3)
+
+    def testPipelinedUploadRetry(self):
+        self.createLocalFiles(self.tempDir, {"Folder1": {"Album1": ["File1.jpg", "File2.jpg", "File3.jpg", "File4.jpg"]}})
+
+        self.uploadFail["File2.jpg"] = False
+        self.uploadFail["File4.jpg"] = True
+
+        smugler.main(Args("sync", self.tempDir, pipeline=True))
+
+        self.assertLocalEqRemote()
+        self.assertUploadCount(5)
+
+class TestSmuglerJobs(TestSmuglerBase):
+
+    def createJobs(self, structures):
+        jobs = []
+        for i, structure in enumerate(structures):
+            jobDir = os.path.join(self.tempDir, "job%d" % i)
+            os.makedirs(jobDir)
+            self.createLocalFiles(jobDir, structure)
+            jobs.append({"imagePath": jobDir, "tokenFile": str(self.tokenFile)})
+        return jobs
+
+    def testMultipleJobs(self):
+        jobs = self.createJobs([
+            {"Album1": ["File1.jpg", "File2.jpg"]},
+            {"Folder2": {"Album2": ["File3.jpg"]}}])
+        self.createConfig({"Jobs": jobs, "Upload": {"Workers": 1}})
+
+        cwd = os.getcwd()
+        os.chdir(self.tempDir)
+        try:
+            smugler.main(Args("sync", None))
+        finally:
+            os.chdir(cwd)
+
+        self.local = {"Album1": ["File1.jpg", "File2.jpg"], "Folder2": {"Album2": ["File3.jpg"]}}
+        self.assertLocalEqRemote()
+        self.assertUploadCount(3)
+        self.assertPostCount(3)
+
+        for job in jobs:
+            self.assertTrue(smugler.getContentFilePath(Path(job["imagePath"])).exists())
+
+    def testJobConfigOverride(self):
+        config = {"Album": {"Privacy": "Private"}, "Jobs": [
+            {"imagePath": "a"},
+            {"imagePath": "b", "tokenFile": "token", "Album": {"Privacy": "Public"}}]}
+
+        jobs = smugler.getJobs(Args("sync", None), config)
+
+        self.assertEqual(jobs[0][1], Path("a/.smugmugToken"))
+        self.assertEqual(jobs[0][2]["Album"], {"Privacy": "Private"})
+        self.assertEqual(jobs[1][1], Path("token"))
+        self.assertEqual(jobs[1][2]["Album"], {"Privacy": "Public"})
+        self.assertNotIn("Jobs", jobs[1][2])
+
+class TestConnectionPools(unittest.TestCase):
+
+    def testPoolConfig(self):
+        pools = transport.ConnectionPools({"Api": {"PoolSize": 3, "Retries": 2}, "Upload": {"PoolSize": 8}})
+
+        apiAdapter = pools.adapters[transport.ApiHost]
+        uploadAdapter = pools.adapters[transport.UploadHost]
+        self.assertEqual(apiAdapter._pool_maxsize, 3)
+        self.assertEqual(apiAdapter.max_retries.total, 2)
+        self.assertEqual(apiAdapter.max_retries.status, 2)
+        self.assertEqual(uploadAdapter._pool_maxsize, 8)
+        self.assertEqual(uploadAdapter.max_retries.status, 0)
+        self.assertNotIn("POST", apiAdapter.max_retries.allowed_methods)
+
+    def testMount(self):
+        pools = transport.ConnectionPools()
+        session = requests.Session()
+        pools.mount(session)
+
+        self.assertIs(session.get_adapter("https://api.smugmug.com/api/v2"), pools.adapters[transport.ApiHost])
+        self.assertIs(session.get_adapter("https://upload.smugmug.com/"), pools.adapters[transport.UploadHost])
+        self.assertEqual(pools.stats()[transport.ApiHost], (0, 0))
+
+    def testHttp2Fallback(self):
+        httpx = transport.httpx
+        transport.httpx = None
+        try:
+            with self.assertLogs(level="WARNING"):
+                pools = transport.ConnectionPools({"Http2": True})
+        finally:
+            transport.httpx = httpx
+        self.assertFalse(pools.http2)
+
+    def testHttp2WithoutH2(self):
+        # httpx without the http2 extra
+        try:
+            with mock.patch.dict(sys.modules, {"h2": None}):
+                importlib.reload(transport)
+            self.assertIsNone(transport.httpx)
+            with self.assertLogs(level="WARNING"):
+                pools = transport.ConnectionPools({"Http2": True})
+            self.assertFalse(pools.http2)
+        finally:
+            importlib.reload(transport)
+
+    def testHttp2Adapter(self):
+        # httpx stub, with one connection per client
+        sent = []
+
+        class NetworkStream:
+            pass
+
+        class Client:
+            def __init__(self, http2, limits, **options):
+                self.connection = NetworkStream()
+
+            def request(self, method, url, headers, content, timeout):
+                chunks = [content] if isinstance(content, (bytes, type(None))) else list(content)
+                sent.append((method, url, headers, chunks))
+                return types.SimpleNamespace(status_code=201, headers={"Content-Type": "application/json"},
+                    reason_phrase="Created", encoding="utf-8", content=b'{"Stat": "ok"}',
+                    extensions={"network_stream": self.connection})
+
+            def close(self):
+                pass
+
+        httpx = types.SimpleNamespace(Client=Client, Limits=lambda **limits: limits)
+        with mock.patch.object(transport, "httpx", httpx), mock.patch.object(transport.Http2Adapter, "_chunkSize", 16):
+            pools = transport.ConnectionPools({"Http2": True})
+            session = requests.Session()
+            pools.mount(session)
+
+            body = encoder.MultipartEncoder({"upload_file": ("File1.jpg", b"x" * 100, "image/jpeg")}, boundary="b")
+            resp = session.post(transport.UploadHost + "/", data=body, headers={"Content-Type": body.content_type})
+            session.get(transport.ApiHost + "/api/v2!authuser")
+            session.get(transport.ApiHost + "/api/v2/user/test")
+
+        self.assertEqual(resp.status_code, 201)
+        self.assertEqual(resp.reason, "Created")
+        self.assertEqual(resp.headers["content-type"], "application/json")
+        self.assertEqual(resp.json(), {"Stat": "ok"})
+
+        # The multipart body is streamed in chunks
+        method, url, headers, chunks = sent[0]
+        self.assertEqual((method, url), ("POST", transport.UploadHost + "/"))
+        self.assertGreater(len(chunks), 1)
+        expected = encoder.MultipartEncoder({"upload_file": ("File1.jpg", b"x" * 100, "image/jpeg")}, boundary="b")
+        self.assertEqual(b"".join(chunks), expected.to_string())
+        self.assertEqual(headers["Content-Type"], body.content_type)
+
+        self.assertEqual(pools.stats(), {transport.ApiHost: (1, 2), transport.UploadHost: (1, 1)})
+
+class TestSmuglerRenames(TestSmuglerBase):
+
+    def setUp(self):
+        super().setUp()
+        self.createConfig({"Rename": {"Enabled": True}})
+
+    def assertRequestCount(self, method, hostname, expectedCount):
+        actualCount = sum(1 for r in self.request_mock.request_history[self.historyStart:]
+            if r.method == method and r.hostname == hostname)
+        self.assertEqual(expectedCount, actualCount)
+
+    def syncRenamed(self, before, after):
+        self.createLocalFiles(self.tempDir, before)
+        smugler.main(Args("sync", self.tempDir))
+        self.assertLocalEqRemote()
+        self.historyStart = len(self.request_mock.request_history)
+
+        self.clearLocalFiles(self.tempDir)
+        self.createLocalFiles(self.tempDir, after)
+        smugler.main(Args("sync", self.tempDir))
+
+    def testRenameAlbum(self):
+        self.syncRenamed(
+            {"2023": {"Trip": ["File1.jpg", "File2.jpg", "File3.jpg", "File4.jpg", "File5.jpg"]}},
+            {"2023": {"Iceland Trip": ["File1.jpg", "File2.jpg", "File3.jpg", "File4.jpg", "File5.jpg"]}})
+
+        self.assertRequestCount("POST", "upload.smugmug.com", 0)
+        self.assertRequestCount("POST", "api.smugmug.com", 0)
+        self.assertRequestCount("PATCH", "api.smugmug.com", 1)
+        self.assertLocalEqRemote()
+
+    def testRenameAlbumWithNewFile(self):
+        self.syncRenamed(
+            {"Trip": ["File1.jpg", "File2.jpg", "File3.jpg", "File4.jpg", "File5.jpg"]},
+            {"Iceland Trip": ["File1.jpg", "File2.jpg", "File3.jpg", "File4.jpg", "File5.jpg", "File6.jpg"]})
+
+        self.assertRequestCount("POST", "upload.smugmug.com", 1)
+        self.assertRequestCount("POST", "api.smugmug.com", 0)
+        self.assertLocalEqRemote()
+
+    def testMoveAlbum(self):
+        self.syncRenamed(
+            {"2023": {"Trip": ["File1.jpg", "File2.jpg"]}},
+            {"2024": {"Trip 2": ["File1.jpg", "File2.jpg"]}})
+
+        self.assertRequestCount("POST", "upload.smugmug.com", 0)
+        # Create folder 2024 and move the album into it
+        self.assertRequestCount("POST", "api.smugmug.com", 2)
+        self.assertRequestCount("PATCH", "api.smugmug.com", 1)
+        self.assertEqual(self.remote["2023"], {})
+        del self.remote["2023"]
+        self.assertLocalEqRemote()
+
+    def testRenameFolder(self):
+        self.syncRenamed(
+            {"Folder1": {"Album1": ["File1.jpg"], "Album2": ["File2.jpg"]}},
+            {"Folder2": {"Album1": ["File1.jpg"], "Album2": ["File2.jpg"]}})
+
+        self.assertRequestCount("POST", "upload.smugmug.com", 0)
+        self.assertRequestCount("POST", "api.smugmug.com", 0)
+        self.assertRequestCount("PATCH", "api.smugmug.com", 1)
+        self.assertLocalEqRemote()
+
+    def testNoMatch(self):
+        self.syncRenamed(
+            {"Album1": ["File1.jpg", "File2.jpg"]},
+            {"Album2": ["File2.jpg", "File3.jpg"]})
+
+        self.assertRequestCount("POST", "upload.smugmug.com", 2)
+        self.assertRequestCount("POST", "api.smugmug.com", 1)
+        self.assertRequestCount("PATCH", "api.smugmug.com", 0)
+        del self.remote["Album1"]
+        self.assertLocalEqRemote()
+
+    def testDisabledByDefault(self):
+        self.createConfig()
+        self.syncRenamed(
+            {"Trip": ["File1.jpg", "File2.jpg"]},
+            {"Iceland Trip": ["File1.jpg", "File2.jpg"]})
+
+        self.assertRequestCount("POST", "upload.smugmug.com", 2)
+        self.assertRequestCount("PATCH", "api.smugmug.com", 0)
+
+    def testDifferentContentIsNotAdopted(self):
+        files = ["File1.jpg", "File2.jpg", "File3.jpg"]
+        self.createLocalFiles(self.tempDir, {"Trip": files})
+        smugler.main(Args("sync", self.tempDir))
+        self.remoteCorrupt = dict((name, "changed") for name in files)
+        self.historyStart = len(self.request_mock.request_history)
+
+        self.clearLocalFiles(self.tempDir)
+        self.createLocalFiles(self.tempDir, {"Iceland Trip": files})
+        smugler.main(Args("sync", self.tempDir))
+
+        self.assertRequestCount("POST", "upload.smugmug.com", 3)
+        self.assertRequestCount("PATCH", "api.smugmug.com", 0)
+        self.assertEqual(self.remote["Trip"], files)
+
+    def testOnlyAlbumsOfSimilarSizeAreListed(self):
+        files = ["File1.jpg", "File2.jpg", "File3.jpg", "File4.jpg", "File5.jpg"]
+        self.remote = {"Trip": list(files), "Empty": []}
+        self.createLocalFiles(self.tempDir, {"Trip": files})
+        smugler.main(Args("sync", self.tempDir))
+        self.historyStart = len(self.request_mock.request_history)
+
+        self.clearLocalFiles(self.tempDir)
+        self.createLocalFiles(self.tempDir, {"Iceland Trip": files})
+        smugler.main(Args("sync", self.tempDir))
+
+        emptyAlbum = "/api/v2/album/%s" % testResponses.getItemId("Empty")
+        self.assertFalse(any(r.path.startswith(emptyAlbum) for r in self.request_mock.request_history[self.historyStart:]))
+        self.assertRequestCount("PATCH", "api.smugmug.com", 1)
+        self.assertEqual(self.remote["Iceland Trip"], files)
+
+class TestSmuglerStartup(TestSmuglerBase):
+
+    def testLazyImports(self):
+        code = ("import sys; import smugler; "
+            "print(','.join(m for m in ('requests', 'requests_oauthlib', 'requests_toolbelt', 'yaml', 'pickle') if m in sys.modules))")
+        output = subprocess.run([sys.executable, "-c", code], check=True, capture_output=True, text=True,
+            cwd=Path(__file__).parent.parent).stdout
+
+        self.assertEqual(output.strip(), "")
+
+    def testScanWithoutRemoteCalls(self):
+        self.createLocalFiles(self.tempDir, self.getTestStructure())
+        self.remote = self.getTestStructure()
+
+        smugler.main(Args("sync", self.tempDir))
+        callCount = self.request_mock.call_count
+
+        with self.assertLogs() as cm:
+            smugler.main(Args("scan", self.tempDir))
+
+        self.assertIn("INFO:root:All in sync", cm.output)
+        self.assertCallCount(callCount)
+
+    def testAuthenticateOnDemand(self):
+        self.createLocalFiles(self.tempDir, {"Album1": ["File1.jpg"]})
+        self.remote = {"Album1": ["File1.jpg"]}
+
+        smugler.main(Args("sync", self.tempDir))
+        self.createLocalFiles(self.tempDir, {"Album1": ["File1.jpg", "File2.jpg"]})
+
+        with self.assertLogs() as cm:
+            smugler.main(Args("sync", self.tempDir))
+
+        self.assertTrue(any("Successfully authorized" in line for line in cm.output))
+        self.assertUploadCount(1)
+
+def createJpeg(path, date):
+    tiff = b"II*\x00" + struct.pack("<I", 8)
+    tiff += struct.pack("<HHHII", 1, 0x8769, 4, 1, 26) + struct.pack("<I", 0)
+    tiff += struct.pack("<HHHII", 1, 0x9003, 2, 20, 44) + struct.pack("<I", 0)
+    tiff += date.strftime("%Y:%m:%d %H:%M:%S").encode("ascii") + b"\x00"
+    app1 = b"Exif\x00\x00" + tiff
+    with open(path, "wb") as fp:
+        fp.write(b"\xff\xd8\xff\xe1" + struct.pack(">H", len(app1) + 2) + app1 + b"\xff\xd9")
+
+def createMp4(path, date):
+    created = int((date - datetime.datetime(1904, 1, 1, tzinfo=datetime.timezone.utc)).total_seconds())
+    mvhd = b"\x00\x00\x00\x00" + struct.pack(">II", created, created) + b"\x00" * 88
+    mvhd = struct.pack(">I4s", len(mvhd) + 8, b"mvhd") + mvhd
+    moov = struct.pack(">I4s", len(mvhd) + 8, b"moov") + mvhd
+    ftyp = struct.pack(">I4s4s", 16, b"ftyp", b"isom") + b"\x00" * 4
+    mdat = struct.pack(">I4s", 12, b"mdat") + b"\x00" * 4
+    with open(path, "wb") as fp:
+        fp.write(ftyp + mdat + moov)
+
+class TestDateRouting(TestSmuglerBase):
+
+    def testCaptureDates(self):
+        jpeg = Path(self.tempDir) / "a.jpg"
+        createJpeg(jpeg, datetime.datetime(2020, 1, 15, 10, 0, 0))
+        mp4 = Path(self.tempDir) / "b.mp4"
+        date = datetime.datetime(2021, 5, 15, 12, 0, 0, tzinfo=datetime.timezone.utc)
+        createMp4(mp4, date)
+        other = Path(self.tempDir) / "c.png"
+        other.write_bytes(b"png")
+
+        self.assertEqual(metadata.captureDate(jpeg), datetime.datetime(2020, 1, 15, 10, 0, 0).timestamp())
+        self.assertEqual(metadata.captureDate(mp4), date.timestamp())
+        self.assertIsNone(metadata.captureDate(other))
+        self.assertEqual(routing.readCaptureDates([jpeg] * routing.MinFilesForPool, 2),
+            [metadata.captureDate(jpeg)] * routing.MinFilesForPool)
+
+    def testRouteByDate(self):
+        self.createConfig({"DateRouting": {"Folders": ["Dump"], "Album": "%Y-%m"}})
+        dump = Path(self.tempDir) / "Dump"
+        dump.mkdir()
+        createJpeg(dump / "a.jpg", datetime.datetime(2020, 1, 15, 10, 0, 0))
+        createJpeg(dump / "b.jpg", datetime.datetime(2020, 1, 20, 10, 0, 0))
+        createMp4(dump / "c.mp4", datetime.datetime(2021, 5, 15, 12, 0, 0, tzinfo=datetime.timezone.utc))
+        (dump / "d.png").write_bytes(b"png")
+        os.utime(dump / "d.png", (datetime.datetime(2019, 7, 10).timestamp(),) * 2)
+        self.createLocalFiles(self.tempDir, {"Album1": ["File1.jpg"]})
+
+        smugler.main(Args("sync", self.tempDir))
+
+        self.local = {"Album1": ["File1.jpg"], "Dump": {"2020-01": ["a.jpg", "b.jpg"], "2021-05": ["c.mp4"], "2019-07": ["d.png"]}}
+        self.assertLocalEqRemote()
+        self.assertUploadCount(5)
+
+        createJpeg(dump / "e.jpg", datetime.datetime(2021, 5, 16, 10, 0, 0))
+        dates = []
+        original = routing.captureDate
+        routing.captureDate = lambda p: dates.append(p.name) or original(p)
+        try:
+            smugler.main(Args("sync", self.tempDir))
+        finally:
+            routing.captureDate = original
+
+        self.assertEqual(dates, ["e.jpg"])
+        self.local["Dump"]["2021-05"].append("e.jpg")
+        self.assertLocalEqRemote()
+        self.assertUploadCount(6)
+
+class TestSmuglerSyncRemote(TestSmuglerBase):
+
+    def testScanRemoteWithDelete(self):
+
+        self.createLocalFiles(self.tempDir, {"Folder1": {"Album1": ["File1.jpg"]}, "Album2": ["File3.jpg", "Video1.mp4"]})
+        self.remote = {"Folder1": {"Album1": ["File1.jpg", "File2.jpg"]}, "Album2": ["File3.jpg", "File3.jpg", "Video1_mp4.MP4", "File4.jpg"]}
+
+        smugler.main(Args("syncRemote", self.tempDir, yes=True))
+
+        self.local["Album2"] = ["File3.jpg", "Video1_mp4.MP4"]
+        self.assertLocalEqRemote()
+
+        callCount = self.request_mock.call_count
+        smugler.main(Args("syncRemote", self.tempDir, yes=True))
+        deletes = [r for r in self.request_mock.request_history[callCount:] if r.method == "DELETE"]
+        self.assertEqual(deletes, [])
+
+    def testScanRemoteConfirmation(self):
+
+        self.createLocalFiles(self.tempDir, {"Album1": ["File1.jpg"], "Album2": ["File3.jpg"]})
+        self.remote = {"Album1": ["File1.jpg", "File2.jpg"], "Album2": ["File3.jpg", "File4.jpg"]}
+
+        with mock.patch("builtins.input", return_value="n") as prompt:
+            smugler.main(Args("syncRemote", self.tempDir))
+
+        prompt.assert_called_once()
+        self.assertEqual(self.remote, {"Album1": ["File1.jpg", "File2.jpg"], "Album2": ["File3.jpg", "File4.jpg"]})
+
+    def testDeleteImagesBulk(self):
+
+        self.remote = {"Album1": ["File%d.jpg" % i for i in range(50)]}
+        api = SmugMug(self.tokenFile, self.config)
+        rootFolder = Folder(api, lazy=True)
+        rootFolder.reload()
+        album = rootFolder.getChildrenByName("Album1")
+
+        deleted = album.deleteImages(album.getImages()[::2], workers=4)
+
+        self.assertEqual(len(deleted), 25)
+        self.assertEqual([i.getFileName() for i in album.getImages()], ["File%d.jpg" % i for i in range(1, 50, 2)])
+        self.assertEqual(sorted(self.remote["Album1"]), sorted("File%d.jpg" % i for i in range(1, 50, 2)))
+        self.assertFalse(album.hasImage(Path("File0.jpg")))
+
 class TestSmuglerScan(TestSmuglerBase):
 
     def testScan(self):
@@ -642,17 +2264,53 @@ class TestSmuglerScan(TestSmuglerBase):
 
         self.assertIn("INFO:root:Missing 2 files in Album1", cm.output)
 
+    def testScanPlan(self):
+
+        self.createLocalFiles(self.tempDir, {
+            "Album1": ["File1.jpg", "File2.jpg", "File3.jpg"],
+            "Folder1": {"Album2": ["File4.jpg"]}})
+        self.remote = {"Album1": ["File1.jpg"]}
+        planFile = os.path.join(self.tempDir, "plan.json")
+
+        smugler.main(Args("scan", self.tempDir, plan=planFile))
+
+        with open(planFile, encoding="utf-8") as fp:
+            plan = json.load(fp)
+
+        self.assertEqual(plan["files"], 3)
+        self.assertEqual(plan["bytes"], len("File2.jpg") + len("File3.jpg") + len("File4.jpg"))
+        self.assertEqual(plan["createFolders"], ["Folder1"])
+        self.assertEqual(plan["createAlbums"], ["Folder1/Album2"])
+        self.assertEqual(plan["requests"], 2 + 3 * smugler.RequestsPerUpload)
+        self.assertIsNone(plan["estimatedSeconds"])
+        self.assertIn({"path": "Album1", "files": 2, "bytes": 18, "exists": True}, plan["albums"])
+        self.assertUploadCount(0)
+
+    def testScanPlanEstimate(self):
+
+        self.createLocalFiles(self.tempDir, {"Album1": ["File1.jpg"]})
+        smugler.main(Args("sync", self.tempDir))
+        self.assertGreater(smugler.loadStats(Path(self.tempDir))["bytesPerSecond"], 0)
+
+        self.createLocalFiles(self.tempDir, {"Album1": ["File1.jpg", "File2.jpg"]})
+        with self.assertLogs() as cm:
+            plan = smugler.runJob(Args("scan", self.tempDir), Path(self.tempDir), self.tokenFile, self.config)
+
+        self.assertEqual(plan["files"], 1)
+        self.assertIsNotNone(plan["estimatedSeconds"])
+        self.assertTrue(any("Plan: upload 1 files" in line for line in cm.output))
+
 class TestSmugmugApi(TestSmuglerBase):
 
     def setUp(self):
         super(TestSmugmugApi, self).setUp()
-        SmugMug(self.tokenFile, self.config)
+        self.api = SmugMug(self.tokenFile, self.config)
   
     def testApiReloadFolder(self):
 
         self.remote = self.getTestStructure()
 
-        rootFolder = Folder(lazy=True)
+        rootFolder = Folder(self.api, lazy=True)
         rootFolder.reload()
         
         folder = rootFolder.getChildrenByName("Folder1")
@@ -665,7 +2323,7 @@ class TestSmugmugApi(TestSmuglerBase):
 
         self.remote = {"Album1": ["Video1.MP4", "Video2_mp4.MP4", "Picture1.jpg", "Picture2.JPG"]}
 
-        rootFolder = Folder(lazy=True)
+        rootFolder = Folder(self.api, lazy=True)
         rootFolder.reload()
 
         album = rootFolder.getChildrenByName("Album1")
@@ -681,14 +2339,127 @@ class TestSmugmugApi(TestSmuglerBase):
         self.assertTrue(album.hasImage(Path("Picture2.JPG")))
         self.assertFalse(album.hasImage(Path("Picture2.jpg")))
 
-    def NO_testScanRemoteWithDelete(self):
+    def testIncrementalFilenameCache(self):
 
-        self.createLocalFiles(self.tempDir, {"Folder1": {"Album1": ["File1.jpg"]}})
-        self.remote = {"Folder1": {"Album1": ["File1.jpg", "File2.jpg"]}}
+        self.remote = {"Album1": ["File1.jpg", "File2.jpg"]}
+        self.createLocalFiles(self.tempDir, {"Album1": ["File3.jpg"]})
 
-        smugler.main(Args("syncRemote", self.tempDir, refresh=True))
+        rootFolder = Folder(self.api, lazy=True)
+        rootFolder.reload()
+        album = rootFolder.getChildrenByName("Album1")
 
-        self.assertLocalEqRemote()
+        self.assertTrue(album.hasImage(Path("File1.jpg")))
+        cache = album._nameHashes
+
+        album.upload(Path(self.tempDir) / "Album1" / "File3.jpg")
+        self.assertTrue(album.hasImage(Path("File3.jpg")))
+
+        album.deleteImage(album.getImages()[0])
+        self.assertFalse(album.hasImage(Path("File1.jpg")))
+        self.assertTrue(album.hasImage(Path("File2.jpg")))
+        self.assertIs(album._nameHashes, cache)
+        self.assertEqual(self.remote, {"Album1": ["File2.jpg", "File3.jpg"]})
+
+    def testPersistedNameHashes(self):
+
+        self.remote = {"Album1": ["File%d.jpg" % i for i in range(1000)]}
+
+        rootFolder = Folder(self.api, lazy=True)
+        rootFolder.reload()
+        rootFolder.getChildrenByName("Album1").hasImage(Path("File1.jpg"))
+        smugler.saveContentToFile(Path(self.tempDir), rootFolder)
+
+        album = smugler.loadContentFromFile(Path(self.tempDir)).getChildrenByName("Album1")
+        # Membership tests only read the hashes, not the images
+        self.assertTrue(album.hasImage(Path("File999.jpg")))
+        self.assertTrue(album.hasImage(Path("File0.jpg")))
+        self.assertFalse(album.hasImage(Path("File1000.jpg")))
+        self.assertEqual(len(album._nameHashes), 1000)
+        self.assertEqual(album._images, [])
+        self.assertEqual(len(album.getImages()), 1000)
+
+    def testSnapshotRoundTrip(self):
+
+        self.remote = self.getTestStructure()
+
+        rootFolder = Folder(self.api, lazy=False)
+        smugler.saveContentToFile(Path(self.tempDir), rootFolder)
+        self.assertTrue(snapshot.isSnapshot(smugler.getContentFilePath(Path(self.tempDir))))
+
+        loaded = smugler.loadContentFromFile(Path(self.tempDir))
+        loaded.setApi(self.api)
+        self.assertEqual(loaded.toString(0), rootFolder.toString(0))
+
+        # Saving again copies the albums that weren't used
+        smugler.saveContentToFile(Path(self.tempDir), loaded)
+        self.assertEqual(smugler.loadContentFromFile(Path(self.tempDir)).toString(0), rootFolder.toString(0))
+
+    def testSnapshotOfOtherVersionIsIgnored(self):
+
+        self.remote = self.getTestStructure()
+        contentFile = smugler.getContentFilePath(Path(self.tempDir))
+        smugler.saveContentToFile(Path(self.tempDir), Folder(self.api, lazy=False))
+
+        data = bytearray(contentFile.read_bytes())
+        data[len(snapshot.Magic)] = snapshot.Version + 1
+        contentFile.write_bytes(data)
+
+        self.assertIsNone(smugler.loadContentFromFile(Path(self.tempDir)))
+
+    def testPickledContentIsLoaded(self):
+
+        self.remote = self.getTestStructure()
+        rootFolder = Folder(self.api, lazy=False)
+        with smugler.getContentFilePath(Path(self.tempDir)).open("wb") as fp:
+            pickle.dump(rootFolder, fp)
+
+        self.assertEqual(smugler.loadContentFromFile(Path(self.tempDir)).toString(0), rootFolder.toString(0))
+
+    def testUnchangedContentIsNotSaved(self):
+
+        self.createLocalFiles(self.tempDir, {"Album1": ["File1.jpg"]})
+        smugler.main(Args("sync", self.tempDir))
+
+        with mock.patch("lib.snapshot.save") as save:
+            smugler.main(Args("sync", self.tempDir))
+        save.assert_not_called()
+
+        self.createLocalFiles(self.tempDir, {"Album1": ["File1.jpg", "File2.jpg"]})
+        with mock.patch("lib.snapshot.save") as save:
+            smugler.main(Args("sync", self.tempDir))
+        save.assert_called_once()
+
+    def testPickledContentIsConverted(self):
+
+        self.remote = self.getTestStructure()
+        self.createLocalFiles(self.tempDir, self.getTestStructure())
+        contentFile = smugler.getContentFilePath(Path(self.tempDir))
+        with contentFile.open("wb") as fp:
+            pickle.dump(Folder(self.api, lazy=False), fp)
+
+        smugler.main(Args("sync", self.tempDir))
+        self.assertTrue(snapshot.isSnapshot(contentFile))
+
+    @unittest.skipUnless(snapshot.zstandard, "zstandard not installed")
+    def testCompressedSnapshot(self):
+
+        self.remote = self.getTestStructure()
+        rootFolder = Folder(self.api, lazy=False)
+        smugler.saveContentToFile(Path(self.tempDir), rootFolder, compress=True)
+
+        self.assertEqual(smugler.loadContentFromFile(Path(self.tempDir)).toString(0), rootFolder.toString(0))
+
+    def testFilenameCacheDuplicates(self):
+
+        self.remote = {"Album1": ["Video1.MP4", "Video1.mp4"]}
+
+        rootFolder = Folder(self.api, lazy=True)
+        rootFolder.reload()
+        album = rootFolder.getChildrenByName("Album1")
+
+        self.assertTrue(album.hasImage(Path("Video1.mp4")))
+        album.deleteImage(album.getImages()[0])
+        self.assertTrue(album.hasImage(Path("Video1.mp4")))
 
     # TODO: Test paging
 